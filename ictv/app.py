@@ -42,20 +42,28 @@ import ictv
 import ictv.common
 from ictv import database, pages
 from ictv.common import get_root_path
+from ictv.models.distribution_graph import DistributionGraph
 from ictv.models.log_stat import LogStat
+from ictv.models.object_cache import ObjectCache
 from ictv.models.role import UserPermissions
 from ictv.models.template import Template
 from ictv.models.user import User
 from ictv.common.feedbacks import rotate_feedbacks, get_feedbacks, pop_previous_form, get_next_feedbacks
 from ictv.common.logging import init_logger, load_loggers_stats
 from ictv.common.utils import make_tooltip, make_alert, generate_secret, pretty_print_size, timesince, is_test, sidebar, request_static
-from ictv.database import SQLObjectThreadConnection, close_database
+from ictv.database import SQLObjectThreadConnection, close_database, begin_thread_transaction, \
+    end_thread_transaction, setup_thread_connection
 from ictv.pages.utils import ICTVAuthPage, PermissionGate
 from ictv.pages.logs_page import LogsPage
+from ictv.pages.channel_renderer import ChannelsLastModified
+from ictv.pages.screen_renderer import RenderedScreensCache
 from ictv.plugin_manager.plugin_manager import PluginManager
 from ictv.renderer.renderer import ICTVRenderer
-from ictv.storage.cache_manager import CleanupScheduler
+from ictv.storage.blob_store import BlobStore
+from ictv.storage.cache_manager import CleanupScheduler, CacheManager
 from ictv.storage.download_manager import DownloadManager
+from ictv.storage.storage_manager import StorageManager
+from ictv.storage.storage_reconciler import StorageReconciler
 from ictv.storage.transcoding_queue import TranscodingQueue
 
 import ictv.flask.response as resp
@@ -73,9 +81,32 @@ def get_db_thread_preprocessor():
         #Avoid processing for static files
         if request_static():
             return
-        sqlhub.threadConnection = SQLObjectThreadConnection.get_conn()
+        view_class = getattr(flask.current_app.view_functions.get(flask.request.endpoint), 'view_class', None)
+        if getattr(view_class, 'transactional', True):
+            # The requests that may write lock the database first, so that they do not fail to write what they read
+            begin_thread_transaction(immediate=flask.request.method not in ('GET', 'HEAD', 'OPTIONS'))
+        else:
+            setup_thread_connection()
     return db_thread_preprocessor
 
+
+def get_db_thread_postprocessor():
+    def db_thread_postprocessor(response):
+        """ Commits the transaction of the request, or rolls it back if an error occurred. """
+        end_thread_transaction(commit=response.status_code < 500)
+        return response
+    return db_thread_postprocessor
+
+
+def get_db_thread_teardown():
+    def db_thread_teardown(exception):
+        """
+            Rolls back the transaction of the request if it was not ended, e.g. because a postprocessor raised an
+            exception, so that its database connection is always given back to the pool.
+        """
+        end_thread_transaction(commit=False)
+    return db_thread_teardown
+
 def database_error_handler(e):
     logging.getLogger('database').error('An error occured while executing queries for request %s', flask.request.path, exc_info=True)
 
@@ -86,6 +117,7 @@ def internal_error_handler(e):
 
 def load_templates_and_themes():
     Template.deleteMany(None)
+    ObjectCache.invalidate(Template)
     for template in next((os.walk(os.path.join(get_root_path(), 'renderer/templates/'))))[2]:
         Template(name=template.replace('.html', ''))
 
@@ -280,6 +312,7 @@ def get_app(config_path):
     config = get_config(config_path)
     if database.database_path is None:
         database.database_path = config['database_uri']
+    database.pool_config = config['database_pool']
 
     # Create a base flask application
     app = FrankenFlask(__name__)
@@ -342,14 +375,36 @@ def get_app(config_path):
     app.ictv_renderer = ICTVRenderer(app)
     # Init the plugin manager, used as a gateway between ICTV core and its plugins.
     app.plugin_manager = PluginManager(app)
-
+    # Init the cache of rendered screens, which serves the last page of a screen again when its content did not change
+    app.rendered_screens_cache = RenderedScreensCache()
+    # Init the last modification dates of the rendered channels, which never go back in time when their content changes
+    app.channels_last_modified = ChannelsLastModified()
+
+    # Share the identical asset files between assets if enabled
+    StorageManager.blob_store = BlobStore(os.path.join(get_root_path(), 'static', 'storage', 'blobs')) \
+        if app.config['asset_storage']['deduplication'] else None
+
+    # Init the cache of the instances of the read-mostly models
+    ObjectCache.configure(**app.config['object_cache'])
+    # Init the snapshot of the screens and channels used by the renderers
+    DistributionGraph.configure(**app.config['distribution_graph'])
     # Init the download manager, a download queue which asynchronously downloads assets from the network
-    app.download_manager = DownloadManager()
+    app.download_manager = DownloadManager(**app.config['download_manager'])
+    app.download_manager.resume_downloads()
     # Init the cleanup manager which will regularly cleanup unused cached assets
-    app.cleanup_scheduler = CleanupScheduler()
+    storage_config = app.config['asset_storage']
+    storage_reconciler = None
+    if storage_config['orphans_collection_interval']:
+        storage_reconciler = StorageReconciler(StorageManager._storage_path,
+                                               quarantine=storage_config['quarantine_orphans'])
+    app.cleanup_scheduler = CleanupScheduler(storage_reconciler=storage_reconciler,
+                                             reconciliation_interval=storage_config['orphans_collection_interval'],
+                                             **app.config['asset_cache'])
     app.cleanup_scheduler.start()
+    app.download_manager.on_download_completed = app.cleanup_scheduler.request_eviction
     # Init the video transcoding queue which will convert videos to WebM format using FFmpeg
-    app.transcoding_queue = TranscodingQueue()
+    app.transcoding_queue = TranscodingQueue(**app.config['transcoding'])
+    app.transcoding_queue.resume_tasks()
 
     # Add an general authentication processor to handle user authentication
     app.register_before_request(get_authentication_processor,cascade=True,needs_app=True)
@@ -362,6 +417,11 @@ def get_app(config_path):
     app.prepare_error_handler(DatabaseError,lambda:database_error_handler)
     app.prepare_error_handler(werkzeug.exceptions.InternalServerError,lambda:internal_error_handler)
 
+    # Add a hook to commit the transaction of each HTTP request once it is done
+    app.register_after_request(get_db_thread_postprocessor,cascade=True)
+    # and one to release its connection even if the hooks run before failed
+    app.register_teardown_request(get_db_thread_teardown,cascade=True)
+
     # Add a hook to clean feedbacks from the previous request and prepare next feedbacks to be shown to the user
     app.register_after_request(lambda:rotate_feedbacks,cascade=True,needs_app=False)
 
@@ -381,6 +441,9 @@ def close_app(app):
     app.download_manager.stop()
     app.cleanup_scheduler.stop()
     app.plugin_manager.stop()
+    CacheManager.clear_index()
+    ObjectCache.clear()
+    DistributionGraph.clear()
 
 
 def main(config_path, address_port):
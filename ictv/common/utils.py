@@ -20,11 +20,14 @@
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import collections.abc
 import os
+from copy import deepcopy
 from datetime import datetime
 import io
 import random
 import string
+import types
 
 import qrcode
 import qrcode.image.svg
@@ -193,6 +196,32 @@ def deep_update(d, u):
     return d
 
 
+def deep_overlay(d, u):
+    """
+        Returns the result of deep_update(deepcopy(d), u) without copying d nor modifying it: the mappings of d that
+        are not updated by u are shared with the result rather than copied.
+    """
+    result = dict(d)
+    for k, v in u.items():
+        if isinstance(v, collections.abc.Mapping):
+            overlaid = d.get(k)
+            result[k] = deep_overlay(overlaid if isinstance(overlaid, collections.abc.Mapping) else {}, v)
+        else:
+            result[k] = v
+    return result
+
+
+def deep_freeze(d):
+    """ Returns a read-only view of a copy of the given mapping and of its nested mappings. """
+    return types.MappingProxyType({k: deep_freeze(v) if isinstance(v, collections.abc.Mapping) else deepcopy(v)
+                                   for k, v in d.items()})
+
+
+def deep_thaw(d):
+    """ Returns a modifiable deep copy of the given mapping and of its nested mappings. """
+    return {k: deep_thaw(v) if isinstance(v, collections.abc.Mapping) else deepcopy(v) for k, v in d.items()}
+
+
 def timesince(dt, default="just now", when_none=Exception()):
     """
     Returns string representing "time since" e.g.
@@ -19,31 +19,46 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import tempfile
 import threading
 
 from sqlobject import connectionForURI
 from sqlobject import sqlhub
+from sqlobject.dberrors import OperationalError
+from sqlobject.sqlite.sqliteconnection import SQLiteConnection
 
+from ictv.migrations import migrations, get_pending_migrations, format_report
 from ictv.models.asset import Asset
+from ictv.models.asset_download import AssetDownload
 from ictv.models.building import Building
 from ictv.models.channel import Channel, PluginChannel, ChannelBundle
+from ictv.models.channel_bundle_closure import ChannelBundleClosure
+from ictv.models.distribution_graph import DistributionGraph
+from ictv.models.distribution_graph_version import DistributionGraphVersion
 from ictv.models.ictv_object import DBVersion
 from ictv.models.log_stat import LogStat
+from ictv.models.object_cache import ObjectCache
 from ictv.models.plugin import Plugin
 from ictv.models.plugin_param_access_rights import PluginParamAccessRights
 from ictv.models.role import Role
 from ictv.models.screen import Screen, ScreenMac
 from ictv.models.subscription import Subscription
 from ictv.models.template import Template
+from ictv.models.transcoding_job import TranscodingJob
 from ictv.models.user import User
 from ictv.common.utils import is_test
 
-database_version = 1
+database_version = migrations[-1].version
 if is_test():
     database_path = 'sqlite://' + tempfile.mkstemp()[1]
 else:
     database_path = None
+pool_config = {'size': 16, 'timeout': 30}
+sqlite_pragmas = ['PRAGMA foreign_keys = ON', 'PRAGMA busy_timeout = 100000', 'PRAGMA journal_mode = WAL',
+                  'PRAGMA synchronous = NORMAL', 'PRAGMA temp_store = MEMORY', 'PRAGMA cache_size = -16000']
+_sqlite_connections = {}
+logger = logging.getLogger('database')
 
 
 class SQLObjectThreadConnection(object):
@@ -57,16 +72,181 @@ class SQLObjectThreadConnection(object):
         return cls._local.conn
 
 
-def create_connection():
-    return setup_connection(connectionForURI(database_path, cache=False))
+def setup_thread_connection():
+    """ Makes the current thread use its own database connection. """
+    sqlhub.threadConnection = SQLObjectThreadConnection.get_conn()
 
 
-def setup_connection(conn):
+def create_connection():
     if database_path.startswith('sqlite:'):
-        conn.queryOne('PRAGMA foreign_keys = ON;')
-        assert conn.queryOne('PRAGMA foreign_keys;') == (1,)
-        conn.queryOne('PRAGMA busy_timeout = 100000;')
-    return conn
+        if database_path not in _sqlite_connections:
+            _sqlite_connections[database_path] = PooledSQLiteConnection.connectionFromURI(database_path)
+        return _sqlite_connections[database_path]
+    return connectionForURI(database_path, cache=False)
+
+
+class PooledSQLiteConnection(SQLiteConnection):
+    """
+        A SQLite connection sharing a bounded pool of database connections between all the threads, instead of opening
+        one connection per thread. Each database connection is set up with the pragmas of ICTV when it is opened.
+        A thread can run its queries in a transaction using begin_thread_transaction. The transaction takes a database
+        connection at its first query and keeps it until it is committed, so that a thread that does not query the
+        database or waits for other threads after committing does not hold a connection of the pool. The SQLObject
+        instances stay bound to this connection, so that they can still be used once the transaction is over.
+        A transaction that reads before writing must be immediate, as SQLite cannot let a deferred transaction write
+        once another transaction committed since its first read, and fails it with a "database is locked" error
+        instead of waiting for the lock.
+    """
+
+    def __init__(self, filename, **kw):
+        kw['check_same_thread'] = False  # The database connections are used by one thread at a time
+        kw.setdefault('cache', False)
+        super(PooledSQLiteConnection, self).__init__(filename, **kw)
+        self._pool_timeout = pool_config['timeout']
+        self._slots = threading.BoundedSemaphore(pool_config['size'])
+        self._idle_connections = []
+        self._leased_connections = set()
+        self._idle_lock = threading.Lock()
+        self._thread_transactions = threading.local()
+
+    def makeConnection(self):
+        conn = super(PooledSQLiteConnection, self).makeConnection()
+        for pragma in sqlite_pragmas:
+            conn.execute(pragma)
+        assert conn.execute('PRAGMA foreign_keys').fetchone() == (1,)
+        return conn
+
+    def getConnection(self):
+        if self._memory:
+            return super(PooledSQLiteConnection, self).getConnection()
+        transaction = self._thread_transactions.__dict__
+        conn = transaction.get('conn')
+        if conn is not None:
+            return conn
+        conn = self._lease_connection()
+        if transaction.get('active'):
+            try:
+                conn.execute('BEGIN IMMEDIATE' if transaction.get('immediate') else 'BEGIN')
+            except:
+                self.releaseConnection(conn, explicit=True)
+                raise
+            transaction['conn'] = conn
+        return conn
+
+    def _lease_connection(self):
+        if not self._slots.acquire(timeout=self._pool_timeout):
+            raise OperationalError('No database connection was released in the last %d seconds' % self._pool_timeout)
+        try:
+            with self._idle_lock:
+                conn = self._idle_connections.pop() if self._idle_connections else None
+            if conn is None:
+                conn = self.makeConnection()
+        except:
+            self._slots.release()
+            raise
+        with self._idle_lock:
+            self._leased_connections.add(conn)
+        return conn
+
+    def releaseConnection(self, conn, explicit=False):
+        if self._memory or conn is self._thread_transactions.__dict__.get('conn'):
+            return
+        with self._idle_lock:
+            if conn not in self._leased_connections:
+                return  # SQLObject may release a connection twice
+            self._leased_connections.remove(conn)
+        if conn.in_transaction:
+            conn.rollback()
+        with self._idle_lock:
+            self._idle_connections.append(conn)
+        self._slots.release()
+
+    def close(self):
+        super(PooledSQLiteConnection, self).close()
+        with self._idle_lock:
+            idle_connections, self._idle_connections = self._idle_connections, []
+        for conn in idle_connections:
+            conn.close()
+
+    def begin_thread_transaction(self, immediate=False):
+        """
+            Runs the following queries of the current thread in a transaction, until end_thread_transaction. An
+            immediate transaction takes the write lock of the database at its first query, waiting for the other
+            writers to commit.
+        """
+        self.end_thread_transaction(commit=False)
+        self._thread_transactions.active = True
+        self._thread_transactions.immediate = immediate
+
+    def call_after_commit(self, function):
+        """
+            Calls the given function once the transaction of the current thread is committed, or right away if the
+            current thread has no transaction. The function is not called if the transaction is rolled back.
+        """
+        transaction = self._thread_transactions.__dict__
+        if not transaction.get('active'):
+            function()
+            return
+        transaction.setdefault('after_commit', []).append(function)
+
+    def end_thread_transaction(self, commit=True):
+        """
+            Commits or rolls back the transaction of the current thread, if any, and releases its connection. Returns
+            whether the current thread had a transaction.
+        """
+        active = self._thread_transactions.__dict__.pop('active', False)
+        self._thread_transactions.__dict__.pop('immediate', None)
+        conn = self._thread_transactions.__dict__.pop('conn', None)
+        after_commit = self._thread_transactions.__dict__.pop('after_commit', [])
+        if conn is not None:
+            try:
+                if commit:
+                    conn.commit()
+                else:
+                    conn.rollback()
+            finally:
+                self.releaseConnection(conn, explicit=True)
+        if commit:
+            for function in after_commit:
+                try:
+                    function()
+                except Exception:
+                    logger.warning('An exception was encountered when running %r after a commit', function,
+                                   exc_info=True)
+        return active
+
+
+def begin_thread_transaction(immediate=False):
+    """
+        Makes the current thread run its queries in a transaction, when the database supports it. The transaction must
+        be immediate if it may write after having read.
+    """
+    conn = SQLObjectThreadConnection.get_conn()
+    sqlhub.threadConnection = conn
+    if isinstance(conn, PooledSQLiteConnection):
+        conn.begin_thread_transaction(immediate)
+
+
+def call_after_commit(function):
+    """
+        Calls the given function once the transaction of the current thread is committed, or right away if it has no
+        transaction. Rows written by a transaction must only be handed over to other threads this way, as they are not
+        visible to other threads until it is committed.
+    """
+    conn = SQLObjectThreadConnection.get_conn()
+    if isinstance(conn, PooledSQLiteConnection):
+        conn.call_after_commit(function)
+    else:
+        function()
+
+
+def end_thread_transaction(commit=True):
+    """ Commits or rolls back the transaction of the current thread, if any. """
+    conn = SQLObjectThreadConnection.get_conn()
+    if isinstance(conn, PooledSQLiteConnection):
+        if conn.end_thread_transaction(commit) and not commit:
+            ObjectCache.clear()  # The cached instances may hold values that were rolled back
+    DistributionGraph.end_transaction()
 
 
 def setup_database():
@@ -88,12 +268,17 @@ def create_database():
     User.createTable()
     PluginChannel.createTable()
     ChannelBundle.createTable()
+    ChannelBundleClosure.createTable()
+    DistributionGraphVersion.createTable()
+    DistributionGraphVersion()
     Role.createTable()
     Screen.createTable()
     ScreenMac.createTable()
     Subscription.createTable()
     Template.createTable()
     Asset.createTable()
+    AssetDownload.createTable()
+    TranscodingJob.createTable()
     PluginParamAccessRights.createTable()
     LogStat.createTable()
     DBVersion.createTable()
@@ -101,23 +286,36 @@ def create_database():
     User(username="admin", fullname="ICTV Admin", email="admin@ictv", super_admin=True, disabled=False)
 
 
-def update_database():
+def update_database(dry_run=False):
     sqlhub.processConnection = create_connection()
-    conn = sqlhub.processConnection
     if not DBVersion.tableExists():
         DBVersion.createTable()
         DBVersion(version=database_version)
-    db_version = DBVersion.select().getOne().version
-    if db_version < 1:
-        print('Updating database to version %d' % 1)
-        column_sql = PluginChannel.sqlmeta.getColumns()['drop_silently_non_complying_slides'].sqliteCreateSQL()
-        table = PluginChannel.sqlmeta.table
-        assert conn.queryOne('ALTER TABLE %s ADD %s' % (table, column_sql)) is None
-        column_sql = Plugin.sqlmeta.getColumns()['drop_silently_non_complying_slides_default'].sqliteCreateSQL()
-        table = Plugin.sqlmeta.table
-        assert conn.queryOne('ALTER TABLE %s ADD %s' % (table, column_sql)) is None
-        db_version = 1
-    DBVersion.select().getOne().set(version=db_version)
+    migrate_database(dry_run)
+
+
+def migrate_database(dry_run=False):
+    """
+        Applies the pending migrations to the database and returns their reports. Each migration is applied in its own
+        transaction when the database supports it. When dry_run is True, the pending migrations are only reported.
+    """
+    conn = sqlhub.processConnection
+    reports = []
+    for migration in get_pending_migrations(DBVersion.select().getOne().version):
+        if dry_run:
+            report = migration.apply(conn, dry_run=True)
+        else:
+            begin_thread_transaction(immediate=True)
+            try:
+                report = migration.apply(conn)
+                DBVersion.select().getOne().set(version=migration.version)
+            except Exception:
+                end_thread_transaction(commit=False)
+                raise
+            end_thread_transaction()
+        print(format_report(report, dry_run))
+        reports.append(report)
+    return reports
 
 
 def load_plugins():
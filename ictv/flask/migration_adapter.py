@@ -46,6 +46,7 @@ class FrankenFlask(Flask):
         self.plugins = {}
         self.pre_processors = []
         self.post_processors = []
+        self.teardown_processors = []
         self.error_handlers = []
         self.appset = set()
 
@@ -82,6 +83,10 @@ class FrankenFlask(Flask):
                 if (proc["cascade"]):
                     app.register_after_request(proc["factory"],proc["cascade"],proc["needs_app"])
 
+            for proc in self.teardown_processors:
+                if (proc["cascade"]):
+                    app.register_teardown_request(proc["factory"],proc["cascade"],proc["needs_app"])
+
             for proc in self.error_handlers:
                 if (proc["cascade"]):
                     app.prepare_error_handler(proc["error"],proc["handler_factory"],proc["cascade"],proc["needs_app"])
@@ -89,6 +94,7 @@ class FrankenFlask(Flask):
             app.apply_error_handlers()
             app.apply_pre_processors()
             app.apply_post_processors()
+            app.apply_teardown_processors()
 
 
         self.plugins[route] = app
@@ -104,6 +110,7 @@ class FrankenFlask(Flask):
         # Applying the processors to the current app instance
         self.apply_pre_processors()
         self.apply_post_processors()
+        self.apply_teardown_processors()
         self.apply_error_handlers()
 
         # It appears that there must be at least one mount when starting
@@ -142,6 +149,21 @@ class FrankenFlask(Flask):
             for value in self.appset:
                 value.register_after_request(factory,cascade,needs_app)
 
+    def register_teardown_request(self,factory,cascade=False,needs_app=False):
+        """
+            Save teardown processors factories in order to apply them with
+            app.apply_teardown_processors(). They are called at the end of
+            each request, even when a postprocessor raised an exception.
+            @params : - function factory: processor factory
+                      - bool cascade: whether this must be applied to the plugins
+                      - bool needs_app: whether the factory needs the app instance
+
+        """
+        self.teardown_processors.append({"factory":factory,"cascade":cascade,"needs_app":needs_app,"applied":False})
+        if (cascade):
+            for value in self.appset:
+                value.register_teardown_request(factory,cascade,needs_app)
+
     def prepare_error_handler(self,error,factory,cascade=True,needs_app=False):
         """
             Save error handlers in order to register them
@@ -183,6 +205,19 @@ class FrankenFlask(Flask):
             for value in self.appset:
                 value.apply_post_processors()
 
+    def apply_teardown_processors(self):
+        """
+            Calls the teardown_request for each app instance
+        """
+        for proc in self.teardown_processors:
+            # Prevent from applying twice the same processor:
+            if (not proc["applied"]):
+                proc["applied"]=True
+                self.teardown_request(proc["factory"]() if not proc["needs_app"] else proc["factory"](self))
+
+            for value in self.appset:
+                value.apply_teardown_processors()
+
     def apply_error_handlers(self):
         """
             Calls the register_error_handler for each app instance
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+    The schema migrations of the ICTV database, in the order of their version. A database created by create_database is
+    at the version of the last migration, the database of an older version is updated by applying the migrations of a
+    greater version in order.
+    A migration is a function registered using the migration decorator and receiving a Migrator, through which it makes
+    its changes so that they can be timed, reported and simulated in a dry-run.
+"""
+
+import time
+from collections import namedtuple
+
+from sqlobject import AND, sqlbuilder
+
+from ictv.models.asset import Asset
+from ictv.models.asset_download import AssetDownload
+from ictv.models.channel import PluginChannel, ChannelBundle
+from ictv.models.channel_bundle_closure import ChannelBundleClosure
+from ictv.models.distribution_graph_version import DistributionGraphVersion
+from ictv.models.plugin import Plugin
+from ictv.models.role import Role
+from ictv.models.screen import ScreenMac
+from ictv.models.subscription import Subscription
+from ictv.models.transcoding_job import TranscodingJob
+
+MigrationReport = namedtuple('MigrationReport', ['version', 'description', 'statements', 'plans', 'duration'])
+QueryPlan = namedtuple('QueryPlan', ['index', 'before', 'after'])
+
+
+class Migration(object):
+    def __init__(self, version, description, function):
+        self.version = version
+        self.description = description
+        self.function = function
+
+    def apply(self, conn, dry_run=False):
+        """
+            Applies this migration using the given connection and returns its MigrationReport. When dry_run is True,
+            the statements of the migration are only reported.
+        """
+        migrator = Migrator(conn, dry_run)
+        start = time.perf_counter()
+        self.function(migrator)
+        return MigrationReport(self.version, self.description, migrator.statements, migrator.plans,
+                               time.perf_counter() - start)
+
+
+class Migrator(object):
+    """ Makes the changes of a migration using the SQL dialect of the database and records them. """
+
+    def __init__(self, conn, dry_run=False):
+        self.conn = conn
+        self.dry_run = dry_run
+        self.statements = []
+        self.plans = []
+
+    def execute(self, sql):
+        self.statements.append(sql)
+        if not self.dry_run:
+            self.conn.query(sql)
+
+    def run(self, description, function):
+        """ Calls the given function, which changes the database without SQL statements of its own. """
+        self.statements.append('-- ' + description)
+        if not self.dry_run:
+            function()
+
+    def create_table(self, so_class):
+        """ Creates the table of the given class along with its indexes. """
+        self.statements.append(self.conn.createTableSQL(so_class)[0])
+        self.statements.extend(self.conn.createIndexSQL(so_class, index) for index in so_class.sqlmeta.indexes)
+        if not self.dry_run:
+            so_class.createTable(connection=self.conn)
+
+    def add_column(self, so_class, name):
+        """ Adds the column of the given class with the given name to its table. """
+        column = so_class.sqlmeta.columns[name]
+        self.execute('ALTER TABLE %s ADD %s' % (so_class.sqlmeta.table, self.conn.createColumn(so_class, column)))
+
+    def add_index(self, so_class, name, plan_query=None):
+        """
+            Creates the index of the given class declared under the given name. The query plans of the given query, if
+            any, are recorded before and after the index is created.
+        """
+        index = next(i for i in so_class.sqlmeta.indexes if i.name == name)
+        before = explain(self.conn, plan_query) if plan_query is not None else None
+        self.execute(self.conn.createIndexSQL(so_class, index))
+        if plan_query is not None:
+            after = explain(self.conn, plan_query) if not self.dry_run else None
+            self.plans.append(QueryPlan(get_index_name(self.conn, so_class, index), before, after))
+
+
+def get_index_name(conn, so_class, index):
+    """ Returns the name under which the given index of the given class is created in the given database. """
+    if conn.dbName == 'mysql':
+        return index.name  # MySQL indexes are named per table and are not prefixed by SQLObject
+    return '%s_%s' % (so_class.sqlmeta.table, index.name)
+
+
+def explain(conn, query):
+    """ Returns the plan of the given query as reported by the database. """
+    if conn.dbName == 'sqlite':
+        return '; '.join(row[-1] for row in conn.queryAll('EXPLAIN QUERY PLAN ' + query))
+    return '; '.join(' '.join(str(c) for c in row) for row in conn.queryAll('EXPLAIN ' + query))
+
+
+migrations = []
+
+
+def migration(version, description):
+    """ Registers the decorated function as the migration of the database to the given version. """
+    def decorator(function):
+        if migrations and version <= migrations[-1].version:
+            raise ValueError('Migration %d is registered after migration %d' % (version, migrations[-1].version))
+        migrations.append(Migration(version, description, function))
+        return function
+    return decorator
+
+
+def get_pending_migrations(version):
+    """ Returns the migrations to apply to a database of the given version, in order. """
+    return [m for m in migrations if m.version > version]
+
+
+def format_report(report, dry_run=False):
+    """ Returns a human-readable description of the given MigrationReport. """
+    lines = ['%s database to version %d: %s (%.3f s)' % ('Would update' if dry_run else 'Updated', report.version,
+                                                          report.description, report.duration)]
+    lines.extend('    ' + s.replace('\n', '\n    ') for s in report.statements)
+    for plan in report.plans:
+        lines.append('    Plan of the query using %s before: %s' % (plan.index, plan.before))
+        if plan.after is not None:
+            lines.append('    Plan of the query using %s after: %s%s' % (
+                plan.index, plan.after, '' if plan.index in plan.after else ' (the index is not used)'))
+    return '\n'.join(lines)
+
+
+@migration(1, 'Add the settings of the silent drop of non complying slides')
+def add_drop_silently_non_complying_slides(migrator):
+    migrator.add_column(PluginChannel, 'drop_silently_non_complying_slides')
+    migrator.add_column(Plugin, 'drop_silently_non_complying_slides_default')
+
+
+@migration(2, 'Add the downloads of the assets')
+def add_asset_downloads(migrator):
+    migrator.create_table(AssetDownload)
+
+
+@migration(3, 'Add the transcoding jobs')
+def add_transcoding_jobs(migrator):
+    migrator.create_table(TranscodingJob)
+
+
+@migration(4, 'Add the closure table of the bundles')
+def add_channel_bundle_closure(migrator):
+    migrator.create_table(ChannelBundleClosure)
+    migrator.run('Fill the closure table from the bundled channels', ChannelBundle.rebuild_closure)
+
+
+@migration(5, 'Add the indexes of the frequent lookups')
+def add_lookup_indexes(migrator):
+    def select(columns, where, **kwargs):
+        return migrator.conn.sqlrepr(sqlbuilder.Select(columns, where=where, **kwargs))
+
+    migrator.add_index(Asset, 'cached_index', select(
+        Asset.q.id, AND(Asset.q.plugin_channel == 1, Asset.q.is_cached == True, Asset.q.filename == '')))
+    migrator.add_index(Asset, 'last_reference_index', select(
+        Asset.q.id, AND(Asset.q.is_cached == True, Asset.q.in_flight == False), orderBy=Asset.q.last_reference))
+    migrator.add_index(Subscription, 'channel_index', select(Subscription.q.screen, Subscription.q.channel == 1))
+    migrator.add_index(Role, 'channel_index', select(
+        Role.q.user, AND(Role.q.channel == 1, Role.q.permission_level == 'channel_administrator')))
+    migrator.add_index(ScreenMac, 'screen_index', select(ScreenMac.q.mac, ScreenMac.q.screen == 1))
+
+
+@migration(6, 'Add the processes owning the downloads and the transcoding jobs')
+def add_download_and_transcoding_owners(migrator):
+    migrator.add_column(AssetDownload, 'owner')
+    migrator.add_column(TranscodingJob, 'owner')
+
+
+@migration(7, 'Add the errors of the transcoding jobs')
+def add_transcoding_errors(migrator):
+    migrator.add_column(TranscodingJob, 'error')
+
+
+@migration(8, 'Add the version of the distribution graph shared by the processes')
+def add_distribution_graph_version(migrator):
+    migrator.create_table(DistributionGraphVersion)
+    migrator.run('Insert the version of the distribution graph', DistributionGraphVersion)
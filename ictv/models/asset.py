@@ -21,7 +21,9 @@
 
 import os
 from datetime import datetime
-from sqlobject import ForeignKey, StringCol, BigIntCol, DateTimeCol, BoolCol
+from threading import Lock
+
+from sqlobject import ForeignKey, StringCol, BigIntCol, DateTimeCol, BoolCol, DatabaseIndex, sqlbuilder
 
 from ictv.common import get_root_path
 from ictv.models.ictv_object import ICTVObject
@@ -40,24 +42,69 @@ class Asset(ICTVObject):
     last_reference = DateTimeCol(default=DateTimeCol.now)
     in_flight = BoolCol(default=False)  # Is this asset being cached at the moment
     is_cached = BoolCol(default=False)  # Is this asset a cached asset from CacheManager
+    # MySQL can only index a prefix of the text columns, 191 characters fit in its smallest key size with utf8mb4
+    cached_index = DatabaseIndex('plugin_channel', 'is_cached', {'column': 'filename', 'length': 191})
+    last_reference_index = DatabaseIndex('last_reference')
+
+    # The references to assets are accumulated in memory and written to last_reference in batches by flush_references
+    _references = {}  # An asset id to last reference time mapping
+    _references_lock = Lock()
 
     def _get_path(self, force=False):
         """ Returns the path to the asset on the filesystem or None if the asset file is being cached. """
-        self.last_reference = datetime.now()
+        self.reference()
         if not force and self.in_flight:
             return None
-        elif force:
+        elif force and self.in_flight:
             self.in_flight = False  # Prevent failures in the caching process to block asset in flight mode
+        return self.get_storage_path()
+
+    def get_storage_path(self):
+        """ Returns the path to the asset on the filesystem, whether or not the asset file is being cached. """
         return os.path.join('static', 'storage',
-                            str(self.plugin_channel.id),
+                            str(self.plugin_channelID),
                             str(self.id) + (self.extension if self.extension is not None else ''))
 
+    def reference(self):
+        """ Records that this asset is being used. The reference is written to the database by flush_references. """
+        with Asset._references_lock:
+            Asset._references[self.id] = datetime.now()
+
+    @staticmethod
+    def reference_ids(asset_ids):
+        """ Records that the assets of the given ids are being used, without fetching them. """
+        now = datetime.now()
+        with Asset._references_lock:
+            for asset_id in asset_ids:
+                Asset._references[asset_id] = now
+
+    @classmethod
+    def flush_references(cls):
+        """
+            Writes the references recorded since the last flush to the last_reference column of the assets, using one
+            UPDATE per day of reference. Returns the number of assets updated.
+        """
+        with cls._references_lock:
+            references, cls._references = cls._references, {}
+        days = {}  # A date to (last reference time, asset ids) mapping
+        for asset_id, reference_time in references.items():
+            last_reference, ids = days.setdefault(reference_time.date(), (reference_time, []))
+            ids.append(asset_id)
+            days[reference_time.date()] = (max(last_reference, reference_time), ids)
+        conn = cls._connection
+        for last_reference, ids in days.values():
+            conn.query(conn.sqlrepr(sqlbuilder.Update(cls.sqlmeta.table, values={'last_reference': last_reference},
+                                                      where=sqlbuilder.IN(cls.q.id, ids))))
+        return len(references)
+
     def write_to_asset_file(self, content):
         """ Writes the content to the asset file. """
         asset_path = os.path.join(get_root_path(), self.path)
         os.makedirs(os.path.dirname(asset_path), exist_ok=True)
-        with open(asset_path, 'wb') as f:
+        # The file is replaced rather than overwritten, as it may be a link to content shared with other assets
+        with open(asset_path + '.tmp', 'wb') as f:
             f.write(content)
+        os.replace(asset_path + '.tmp', asset_path)
 
 
 def on_asset_deleted(instance, kwargs):
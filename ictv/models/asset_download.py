@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime, timedelta
+
+from sqlobject import ForeignKey, StringCol, EnumCol, IntCol, DateTimeCol, DatabaseIndex
+
+from ictv.models.ictv_object import ICTVObject, ProcessOwnedObject
+
+
+class AssetDownload(ProcessOwnedObject, ICTVObject):
+    """ Represents the download of a remote asset by the DownloadManager, until it succeeds. """
+    asset_download_id = DatabaseIndex('asset', unique=True)
+    asset = ForeignKey('Asset', notNone=True, cascade=True)
+    url = StringCol(notNone=True)
+    state = EnumCol(enumValues=['queued', 'running', 'failed'], default='queued')
+    attempts = IntCol(notNone=True, default=0)  # The number of failed attempts
+    error = StringCol(default=None)  # The error encountered by the last failed attempt
+    next_attempt = DateTimeCol(default=None)  # The time before which a failed download is not attempted again
+    last_update = DateTimeCol(default=DateTimeCol.now)
+    owner = StringCol(default=None)  # The process running this download, if it is not failed
+
+    def can_be_attempted(self, now=None):
+        """ Returns whether this download is not failed or can be attempted again. """
+        return self.state != 'failed' or self.next_attempt is None or self.next_attempt <= (now or datetime.now())
+
+    def set_failed(self, error, retry_delay, max_retry_delay):
+        """
+            Records a failed attempt of this download. The next attempt will be delayed by retry_delay seconds, doubled
+            after each failed attempt up to max_retry_delay seconds, and can be made by any process.
+        """
+        now = datetime.now()
+        delay = min(retry_delay * 2 ** self.attempts, max_retry_delay)
+        self.set(state='failed', attempts=self.attempts + 1, error=error[:255], last_update=now,
+                 next_attempt=now + timedelta(seconds=delay), owner=None)
@@ -22,8 +22,9 @@
 from sqlobject import StringCol
 
 from ictv.models.ictv_object import ICTVObject
+from ictv.models.object_cache import CachedObject
 
 
-class Building(ICTVObject):
+class Building(CachedObject, ICTVObject):
     name = StringCol(notNone=True, alternateID=True, length=100)
     city = StringCol(default=None)
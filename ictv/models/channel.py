@@ -25,17 +25,20 @@ from abc import abstractmethod
 import builtins
 from abc import abstractmethod
 
-import itertools
-from sqlobject import ForeignKey, StringCol, DatabaseIndex, SQLRelatedJoin, EnumCol, JSONCol, SQLMultipleJoin, BoolCol, IntCol
+from sqlobject import ForeignKey, StringCol, DatabaseIndex, SQLRelatedJoin, EnumCol, JSONCol, SQLMultipleJoin, BoolCol, IntCol, \
+    sqlbuilder
+from sqlobject.events import listen, RowDestroySignal
 from sqlobject.inheritance import InheritableSQLObject
 
 import ictv.common.utils as utils
+from ictv.models.channel_bundle_closure import ChannelBundleClosure
+from ictv.models.object_cache import CachedObject
 from ictv.models.plugin_param_access_rights import PluginParamAccessRights
 from ictv.models.role import Role, UserPermissions
 from ictv.models.user import User
 
 
-class Channel(InheritableSQLObject):
+class Channel(CachedObject, InheritableSQLObject):
     name = StringCol(notNone=True, unique=True, length=100)
     description = StringCol(default=None)
     enabled = BoolCol(notNone=True, default=True)
@@ -299,29 +302,127 @@ class ChannelBundle(Channel):
         """ Avoids channel duplication in bundled channels. """
         if channel not in self.bundled_channels and self.has_no_cycles(list(self.bundled_channels) + [channel]):
             self.addChannel(channel)
+            ChannelBundle._update_closure(self.get_bundles_containing([self.id]) | {self.id})
+            from ictv.models.distribution_graph import DistributionGraph
+            DistributionGraph.invalidate()  # The bundled channels are changed without any SQLObject signal
 
     def remove_channel(self, channel):
         if channel in self.bundled_channels:
             self.removeChannel(channel)
+            ChannelBundle._update_closure(self.get_bundles_containing([self.id]) | {self.id})
+            from ictv.models.distribution_graph import DistributionGraph
+            DistributionGraph.invalidate()
 
     def flatten(self, keep_disabled_channels=False):
-        channels_iterable_list = []
-        for channel in self.bundled_channels:
-            if channel.enabled or keep_disabled_channels:
-                channels_iterable_list.append(channel.flatten(keep_disabled_channels=keep_disabled_channels))
-        return itertools.chain.from_iterable(channels_iterable_list)
+        """
+            Returns the plugin channels reachable from this bundle, in the order of the bundled channels. The channels
+            and the bundles they are bundled in are fetched at once using the closure table.
+        """
+        channel_ids = self.get_reachable_channel_ids()
+        if not channel_ids:
+            return []
+        channels = {c.id: c for c in Channel.select(sqlbuilder.IN(Channel.q.id, list(channel_ids)))}
+        bundled_channel_ids = ChannelBundle._get_bundled_channel_ids(
+            [self.id] + [c.id for c in channels.values() if type(c) is ChannelBundle])
+
+        def visit(bundle_id):
+            for channel_id in bundled_channel_ids.get(bundle_id, []):
+                channel = channels[channel_id]
+                if channel.enabled or keep_disabled_channels:
+                    if type(channel) is ChannelBundle:
+                        yield from visit(channel_id)
+                    else:
+                        yield channel
+
+        return list(visit(self.id))
+
+    def get_reachable_channel_ids(self):
+        """ Returns the set of ids of the channels bundled in this bundle or in the bundles it contains. """
+        closure = ChannelBundleClosure
+        conn = self._connection
+        rows = conn.queryAll(conn.sqlrepr(sqlbuilder.Select(closure.q.channel,
+                                                            where=closure.q.bundle == self.id)))
+        return {channel_id for channel_id, in rows}
+
+    @classmethod
+    def get_bundles_containing(cls, channel_ids):
+        """ Returns the set of ids of the bundles from which at least one of the given channels is reachable. """
+        closure = ChannelBundleClosure
+        conn = cls._connection
+        rows = conn.queryAll(conn.sqlrepr(sqlbuilder.Select(closure.q.bundle, distinct=True,
+                                                            where=sqlbuilder.IN(closure.q.channel,
+                                                                                list(channel_ids)))))
+        return {bundle_id for bundle_id, in rows}
+
+    @classmethod
+    def _get_bundled_channel_ids(cls, bundle_ids=None):
+        """
+            Returns a mapping of the ids of the given bundles, or of all bundles, to the list of the ids of the channels
+            they directly bundle, in the order they were bundled.
+        """
+        conn = cls._connection
+        join = next(j for j in cls.sqlmeta.joins if j.joinMethodName == '_bundled_channels')
+        table = sqlbuilder.Table(join.intermediateTable)
+        bundle_column, channel_column = getattr(table, join.joinColumn), getattr(table, join.otherColumn)
+        where = sqlbuilder.IN(bundle_column, list(bundle_ids)) if bundle_ids is not None else sqlbuilder.NoDefault
+        rows = conn.queryAll(conn.sqlrepr(sqlbuilder.Select([bundle_column, channel_column], where=where)))
+        bundled_channel_ids = {}
+        for bundle_id, channel_id in rows:
+            bundled_channel_ids.setdefault(bundle_id, []).append(channel_id)
+        return bundled_channel_ids
+
+    @classmethod
+    def _update_closure(cls, bundle_ids, removed_bundle_ids=()):
+        """
+            Recomputes the rows of the closure table of the given bundles from the channels they bundle and drops the
+            rows of the removed bundles. The rows of a bundle must be recomputed along with the rows of all the bundles
+            it is reachable from.
+        """
+        closure = ChannelBundleClosure
+        conn = cls._connection
+        bundle_ids = set(bundle_ids) - set(removed_bundle_ids)
+        bundled_channel_ids = cls._get_bundled_channel_ids()
+        rows = []
+        for bundle_id in bundle_ids:
+            reachable, to_visit = set(), list(bundled_channel_ids.get(bundle_id, []))
+            while to_visit:
+                channel_id = to_visit.pop()
+                if channel_id not in reachable:
+                    reachable.add(channel_id)
+                    to_visit.extend(bundled_channel_ids.get(channel_id, []))
+            rows.extend((bundle_id, channel_id) for channel_id in sorted(reachable))
+        conn.query(conn.sqlrepr(sqlbuilder.Delete(closure.sqlmeta.table, where=sqlbuilder.IN(
+            closure.q.bundle, list(bundle_ids | set(removed_bundle_ids))))))
+        for i in range(0, len(rows), 500):
+            conn.query(conn.sqlrepr(sqlbuilder.Insert(closure.sqlmeta.table, template=['bundle_id', 'channel_id'],
+                                                      valueList=rows[i:i + 500])))
+
+    @classmethod
+    def rebuild_closure(cls):
+        """ Recomputes the whole closure table from the channels bundled in each bundle. """
+        conn = cls._connection
+        rows = conn.queryAll(conn.sqlrepr(sqlbuilder.Select(cls.q.id)))
+        cls._update_closure({bundle_id for bundle_id, in rows})
 
     def get_type_name(self):
         return 'Bundle'
 
-    def has_no_cycles(self, channels, marked=None):
-        if marked is None:
-            marked = set()
-        if self.id in marked:
+    def has_no_cycles(self, channels):
+        """
+            Returns True if bundling the given channels in this bundle does not create a cycle, raises a ValueError
+            otherwise.
+        """
+        bundle_ids = {c.id for c in channels if type(c) == ChannelBundle}
+        if self.id in bundle_ids or bundle_ids & ChannelBundle.get_bundles_containing([self.id]):
             raise ValueError('A cycle was found with channel %s' % self.name)
-        marked.add(self.id)
-        for c in channels:
-            if type(c) == ChannelBundle:
-                c.has_no_cycles(c.bundled_channels, marked)
-        marked.remove(self.id)
         return True
+
+
+def on_channel_destroy(instance, post_funcs):
+    """ Updates the closure table of the bundles from which this channel is reachable when it is deleted. """
+    bundle_ids = ChannelBundle.get_bundles_containing([instance.id])
+    channel_id = instance.id
+    post_funcs.append(lambda _: ChannelBundle._update_closure(bundle_ids, removed_bundle_ids=[channel_id]))
+
+# InheritableSQLObject deletes the Channel row of every subclass instance before deleting the row of the subclass
+listen(on_channel_destroy, Channel, RowDestroySignal)
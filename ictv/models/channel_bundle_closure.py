@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from sqlobject import ForeignKey, DatabaseIndex
+
+from ictv.models.ictv_object import ICTVObject
+
+
+class ChannelBundleClosure(ICTVObject):
+    """
+        Represents the reachability of a channel from a bundle, i.e. the channel is bundled in this bundle or in one of
+        the bundles it contains. The rows are maintained by ChannelBundle and must not be modified directly.
+    """
+    bundle_channel_index = DatabaseIndex('bundle', 'channel', unique=True)
+    channel_index = DatabaseIndex('channel')
+    bundle = ForeignKey('Channel', notNone=True, cascade=True)
+    channel = ForeignKey('Channel', notNone=True, cascade=True)
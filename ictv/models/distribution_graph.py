@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import itertools
+import random
+import threading
+import time
+from collections import namedtuple
+
+from sqlobject import sqlbuilder
+from sqlobject.events import listen, RowCreatedSignal, RowUpdateSignal, RowDestroySignal
+
+from ictv.models.channel import Channel, PluginChannel, ChannelBundle
+from ictv.models.distribution_graph_version import DistributionGraphVersion
+from ictv.models.plugin import Plugin
+from ictv.models.screen import Screen
+from ictv.models.subscription import Subscription
+
+PluginNode = namedtuple('PluginNode', ['id', 'name', 'activated'])
+PluginChannelNode = namedtuple('PluginChannelNode', ['id', 'name', 'enabled', 'secret', 'plugin', 'cache_activated',
+                                                     'cache_validity'])
+ChannelBundleNode = namedtuple('ChannelBundleNode', ['id', 'name', 'enabled', 'secret', 'bundled_channels'])
+
+
+class ScreenNode(namedtuple('ScreenNode', ['id', 'name', 'secret', 'shuffle', 'show_slide_number',
+                                           'plugin_channels'])):
+    """ The read-only counterpart of a Screen, whose plugin channels are resolved when the snapshot is built. """
+
+    def get_plugin_channels(self):
+        return list(self.plugin_channels)
+
+    def get_channels_content(self, app):
+        """ Returns all the capsules provided by the channels of this screen as an Iterable[PluginCapsule]. """
+        channels = DistributionGraph.resolve(self.plugin_channels)
+        screen_capsules = list(itertools.chain.from_iterable(app.plugin_manager.get_plugins_content(channels)))
+        if self.shuffle:
+            random.shuffle(screen_capsules)
+        return screen_capsules
+
+
+class DistributionGraph(object):
+    """
+        An immutable snapshot of the screens, their subscriptions, the bundles and the plugin channels with their
+        effective cache settings, which lets the renderers resolve what a screen or a channel shows without querying
+        the database.
+        The snapshot is built at once when first needed and replaced as a whole once the changes made to the graph are
+        committed. Changes made outside of SQLObject, e.g. by raw SQL queries, must be followed by a call to
+        invalidate. Each change also increments the version of the graph stored in the database, which is checked at
+        most every `poll_interval` seconds to see the changes committed by the other processes.
+    """
+    poll_interval = 1
+    builds = 0
+    _current = None
+    _version = 0  # Incremented each time the graph changes, a snapshot built for an older version is outdated
+    _build_lock = threading.Lock()
+    _changes = threading.local()  # Whether the transaction of the current thread changed the graph
+
+    def __init__(self, version, shared_version, screens, channels):
+        self.version = version
+        self.shared_version = shared_version
+        self.polled = time.monotonic()
+        self._screens = screens
+        self._channels = channels
+
+    def get_screen(self, screen_id):
+        """ Returns the ScreenNode with the given id, or None if no such screen exists. """
+        return self._screens.get(screen_id)
+
+    def get_channel(self, channel_id):
+        """ Returns the PluginChannelNode or the ChannelBundleNode with the given id, or None if none exists. """
+        return self._channels.get(channel_id)
+
+    def flatten(self, channel_id, keep_disabled_channels=False):
+        """ Returns the PluginChannelNodes contained in the given channel, as ChannelBundle.flatten does. """
+        channel = self._channels[channel_id]
+        if type(channel) is PluginChannelNode:
+            return [channel] if channel.enabled or keep_disabled_channels else []
+        return [c for bundled_channel_id in channel.bundled_channels
+                if self._channels[bundled_channel_id].enabled or keep_disabled_channels
+                for c in self.flatten(bundled_channel_id, keep_disabled_channels)]
+
+    @classmethod
+    def configure(cls, poll_interval=1):
+        cls.poll_interval = poll_interval
+        cls.clear()
+
+    @classmethod
+    def get(cls):
+        """ Returns the current snapshot of the graph, building it if it is outdated. """
+        graph = cls._current
+        if graph is not None and cls._is_current(graph):
+            return graph
+        with cls._build_lock:
+            graph = cls._current
+            if graph is None or not cls._is_current(graph):
+                graph = cls._current = cls.build(cls._version)
+            return graph
+
+    @classmethod
+    def _is_current(cls, graph):
+        """ Returns whether the given snapshot is not outdated, polling the version stored in the database if due. """
+        if graph.version != cls._version:
+            return False
+        now = time.monotonic()
+        if now - graph.polled < cls.poll_interval:
+            return True
+        if DistributionGraphVersion.get_version() != graph.shared_version:
+            return False
+        graph.polled = now
+        return True
+
+    @classmethod
+    def build(cls, version=None):
+        """ Reads the whole graph from the database and returns its snapshot. """
+        conn = Screen._connection
+        # The stored version is read first, so that a change committed meanwhile outdates the snapshot
+        shared_version = DistributionGraphVersion.get_version()
+
+        def select(*columns, **kwargs):
+            return conn.queryAll(conn.sqlrepr(sqlbuilder.Select(list(columns), **kwargs)))
+
+        plugins = {id: (PluginNode(id, name, activated), bool(cache_activated), cache_validity)
+                   for id, name, activated, cache_activated, cache_validity
+                   in select(Plugin.q.id, Plugin.q.name, Plugin.q.activated, Plugin.q.cache_activated_default,
+                             Plugin.q.cache_validity_default)}
+        plugin_channels = {id: (plugin_id, cache_activated, cache_validity)
+                           for id, plugin_id, cache_activated, cache_validity
+                           in select(PluginChannel.q.id, PluginChannel.q.plugin, PluginChannel.q.cache_activated,
+                                     PluginChannel.q.cache_validity)}
+        bundled_channels = ChannelBundle._get_bundled_channel_ids()
+        channels = {}
+        for id, name, enabled, secret in select(Channel.q.id, Channel.q.name, Channel.q.enabled, Channel.q.secret):
+            if id in plugin_channels:
+                plugin_id, cache_activated, cache_validity = plugin_channels[id]
+                plugin, cache_activated_default, cache_validity_default = plugins[plugin_id]
+                channels[id] = PluginChannelNode(
+                    id, name, bool(enabled), secret, plugin,
+                    bool(cache_activated) if cache_activated is not None else cache_activated_default,
+                    cache_validity if cache_validity is not None else cache_validity_default)
+            else:
+                channels[id] = ChannelBundleNode(id, name, bool(enabled), secret, tuple(bundled_channels.get(id, ())))
+        graph = cls(version, shared_version, {}, channels)
+
+        # The channels of a screen are ordered by subscription, as Screen.get_plugin_channels orders them
+        subscriptions = {}
+        for screen_id, channel_id in select(Subscription.q.screen, Subscription.q.channel,
+                                            orderBy=[Subscription.q.screen, Subscription.q.id]):
+            subscriptions.setdefault(screen_id, []).append(channel_id)
+        for id, name, secret, shuffle, show_slide_number in select(Screen.q.id, Screen.q.name, Screen.q.secret,
+                                                                   Screen.q.shuffle, Screen.q.show_slide_number):
+            plugin_channels = {}  # Ignores the duplicates while keeping the order of the channels
+            for channel_id in subscriptions.get(id, ()):
+                for c in graph.flatten(channel_id):
+                    plugin_channels.setdefault(c.id, c)
+            graph._screens[id] = ScreenNode(id, name, secret, bool(shuffle), bool(show_slide_number),
+                                            tuple(plugin_channels.values()))
+        cls.builds += 1
+        return graph
+
+    @staticmethod
+    def resolve(plugin_channels):
+        """ Returns the PluginChannel instances of the given PluginChannelNodes, in the same order. """
+        if not plugin_channels:
+            return []
+        instances = {c.id: c for c in PluginChannel.select(sqlbuilder.IN(PluginChannel.q.id,
+                                                                         [c.id for c in plugin_channels]))}
+        return [instances[c.id] for c in plugin_channels if c.id in instances]
+
+    @classmethod
+    def invalidate(cls):
+        """
+            Outdates the current snapshot in every process. It is outdated again in this process when the transaction
+            of the current thread ends.
+        """
+        DistributionGraphVersion.increment()
+        cls._version += 1
+        cls._changes.pending = True
+
+    @classmethod
+    def clear(cls):
+        """ Drops the current snapshot, without changing the version stored in the database. """
+        cls._version += 1
+        cls._current = None
+
+    @classmethod
+    def end_transaction(cls):
+        """
+            Outdates the current snapshot if the transaction of the current thread changed the graph, as a snapshot
+            built meanwhile by another thread could not see these changes.
+        """
+        if cls._changes.__dict__.pop('pending', False):
+            cls._version += 1
+
+    @classmethod
+    def get_statistics(cls):
+        graph = cls._current
+        return {'builds': cls.builds, 'screens': len(graph._screens) if graph is not None else 0,
+                'channels': len(graph._channels) if graph is not None else 0}
+
+
+def _on_graph_change(instance, *args):
+    DistributionGraph.invalidate()
+
+
+def _on_graph_update(instance, kwargs):
+    # The screens record each access of their cache daemon, which does not change the graph
+    if not set(kwargs) <= {'last_ip', 'last_access'}:
+        DistributionGraph.invalidate()
+
+
+for so_class in (Plugin, Channel, PluginChannel, ChannelBundle, Screen, Subscription):
+    listen(_on_graph_change, so_class, RowCreatedSignal)
+    listen(_on_graph_update, so_class, RowUpdateSignal)
+    listen(_on_graph_change, so_class, RowDestroySignal)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from sqlobject import IntCol, sqlbuilder
+
+from ictv.models.ictv_object import ICTVObject
+
+
+class DistributionGraphVersion(ICTVObject):
+    """
+        The version of the distribution graph shared by the processes using the database, held by a single row. It is
+        incremented by each change to the graph, so that the processes can tell whether their snapshot is outdated.
+    """
+    version = IntCol(notNone=True, default=0)
+
+    @classmethod
+    def get_version(cls):
+        conn = cls._connection
+        return conn.queryOne(conn.sqlrepr(sqlbuilder.Select(cls.q.version)))[0]
+
+    @classmethod
+    def increment(cls):
+        cls.update_where({'version': cls.q.version + 1}, sqlbuilder.NoDefault)
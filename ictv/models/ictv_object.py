@@ -19,7 +19,10 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlobject import SQLObject, IntCol
+import os
+import socket
+
+from sqlobject import SQLObject, IntCol, sqlbuilder
 
 
 class ICTVObject(SQLObject):
@@ -29,6 +32,62 @@ class ICTVObject(SQLObject):
             d[attr] = self.__getattribute__(attr)
         return d
 
+    @classmethod
+    def update_where(cls, values, where):
+        """ Updates the given values of the rows matching the given condition. Returns the number of rows updated. """
+        conn = cls._connection
+
+        def update(db_connection, query):
+            cursor = db_connection.cursor()
+            try:
+                conn._executeRetry(db_connection, cursor, query)
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+        return conn._runWithConnection(update, conn.sqlrepr(sqlbuilder.Update(cls.sqlmeta.table, values=values,
+                                                                              where=where)))
+
 
 class DBVersion(ICTVObject):
     version = IntCol()
+
+
+class ProcessOwnedObject(object):
+    """
+        A mixin for the rows processed by one of the processes of ICTV sharing the database, e.g. the mod_wsgi daemon
+        processes. The process processing a row is recorded in its owner column, as returned by get_process_name.
+    """
+
+    def claim(self):
+        """
+            Makes the current process the owner of this row, unless it is owned by another process that is still
+            running. Returns whether the row was claimed. A row is claimed atomically, so that only one of the
+            processes claiming it at the same time succeeds.
+        """
+        owner, process_name = self.owner, get_process_name()
+        if owner is not None and owner != process_name and is_process_running(owner):
+            return False
+        cls = type(self)
+        claimed = cls.update_where({'owner': process_name}, sqlbuilder.AND(cls.q.id == self.id, cls.q.owner == owner))
+        self.expire()
+        return claimed == 1
+
+
+def get_process_name():
+    """ Returns the name identifying the current process among the processes sharing the database. """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def is_process_running(process_name):
+    """ Returns whether the process of the given name is running. The processes of other hosts are assumed to be. """
+    host, _, pid = process_name.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # The process runs as another user
+    return True
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from threading import Lock
+
+from sqlobject import SQLObjectNotFound
+from sqlobject.dbconnection import Transaction
+from sqlobject.events import listen, RowUpdateSignal, RowDestroySignal
+
+
+class ObjectCache(object):
+    """
+        A process-wide cache of the instances of the read-mostly models, i.e. the subclasses of CachedObject. When
+        enabled, getting such an instance by its id or by an alternate id does not query the database as long as the
+        instance was retrieved less than `ttl` seconds ago.
+        The cached instances are updated in place by SQLObject and dropped from the cache when destroyed. Changes made
+        outside of SQLObject, e.g. by raw SQL queries, must be followed by a call to invalidate. Changes made by other
+        processes are seen once the cached instances expire.
+    """
+    enabled = False
+    ttl = 60
+    hits = 0
+    misses = 0
+    _entries = {}  # A (class, id) to (instance, expiry) mapping
+    _alternate_ids = {}  # A (class, column name, value) to id mapping
+    _lock = Lock()
+
+    @classmethod
+    def configure(cls, enabled=False, ttl=60):
+        cls.enabled = enabled
+        cls.ttl = ttl
+        cls.clear()
+
+    @classmethod
+    def get_instance(cls, so_class, id):
+        """ Returns the cached instance of the given class with the given id, or None if it is not cached. """
+        with cls._lock:
+            instance, expiry = cls._entries.get((so_class, id), (None, 0))
+            if instance is not None and expiry > time.monotonic():
+                cls.hits += 1
+                return instance
+            cls.misses += 1
+            if instance is not None:
+                del cls._entries[(so_class, id)]
+        if instance is not None:
+            instance.expire()  # Its values will be read again from the database as it may still be referenced
+        return None
+
+    @classmethod
+    def put_instance(cls, so_class, instance):
+        if isinstance(instance._connection, Transaction):
+            return  # The instance would be unusable once the transaction is over
+        with cls._lock:
+            cls._entries[(so_class, instance.id)] = (instance, time.monotonic() + cls.ttl)
+
+    @classmethod
+    def get_alternate_id(cls, so_class, name, value):
+        with cls._lock:
+            return cls._alternate_ids.get((so_class, name, value))
+
+    @classmethod
+    def put_alternate_id(cls, so_class, name, value, id):
+        with cls._lock:
+            cls._alternate_ids[(so_class, name, value)] = id
+
+    @classmethod
+    def invalidate(cls, so_class, id=None):
+        """
+            Drops the cached instances of the given class, or only the one with the given id, and expires them. The
+            instances cached for its parent classes and its subclasses are dropped as well.
+        """
+        for instance in cls._drop(so_class, id):
+            instance.expire()
+
+    @classmethod
+    def _drop(cls, so_class, id=None, alternate_ids_only=False):
+        def related(other_class):
+            return issubclass(other_class, so_class) or issubclass(so_class, other_class)
+
+        with cls._lock:
+            instances = []
+            if not alternate_ids_only:
+                keys = [k for k in cls._entries if related(k[0]) and id in (None, k[1])]
+                instances = [cls._entries.pop(k)[0] for k in keys]
+            for key in [k for k, i in cls._alternate_ids.items() if related(k[0]) and id in (None, i)]:
+                del cls._alternate_ids[key]
+        return instances
+
+    @classmethod
+    def clear(cls):
+        """ Drops all the cached instances and expires them, so that their values are read again from the database. """
+        with cls._lock:
+            entries = list(cls._entries.values())
+            cls._entries.clear()
+            cls._alternate_ids.clear()
+        for instance, _ in entries:
+            instance.expire()
+
+    @classmethod
+    def get_statistics(cls):
+        with cls._lock:
+            return {'hits': cls.hits, 'misses': cls.misses, 'instances': len(cls._entries)}
+
+
+def _on_row_update(instance, kwargs):
+    # The cached instance itself is updated by SQLObject, only its alternate ids may change
+    ObjectCache._drop(type(instance), instance.id, alternate_ids_only=True)
+
+
+def _on_row_destroy(instance, post_funcs):
+    ObjectCache._drop(type(instance), instance.id)
+
+
+class CachedObject(object):
+    """ A mixin for the SQLObject classes whose instances are kept in the ObjectCache. """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        listen(_on_row_update, cls, RowUpdateSignal)
+        listen(_on_row_destroy, cls, RowDestroySignal)
+
+    @classmethod
+    def get(cls, id, connection=None, selectResults=None, *args, **kwargs):
+        if not ObjectCache.enabled or selectResults is not None or args or kwargs \
+                or isinstance(connection, Transaction):
+            return super(CachedObject, cls).get(id, connection, selectResults, *args, **kwargs)
+        id = cls.sqlmeta.idType(id)
+        instance = ObjectCache.get_instance(cls, id)
+        if instance is None:
+            instance = super(CachedObject, cls).get(id, connection)
+            ObjectCache.put_instance(cls, instance)
+        return instance
+
+    @classmethod
+    def _SO_fetchAlternateID(cls, name, dbName, value, connection=None, idxName=None):
+        if not ObjectCache.enabled or isinstance(connection, Transaction):
+            return super(CachedObject, cls)._SO_fetchAlternateID(name, dbName, value, connection, idxName)
+        id = ObjectCache.get_alternate_id(cls, name, value)
+        if id is not None:
+            try:
+                return cls.get(id, connection)
+            except SQLObjectNotFound:
+                pass
+        instance = super(CachedObject, cls)._SO_fetchAlternateID(name, dbName, value, connection, idxName)
+        ObjectCache.put_alternate_id(cls, name, value, instance.id)
+        ObjectCache.put_instance(cls, instance)
+        return instance
@@ -29,11 +29,12 @@ from sqlobject import StringCol, BoolCol, EnumCol, SQLMultipleJoin, JSONCol, Int
 from ictv.common import get_root_path
 from ictv.models.channel import PluginChannel, ChannelBundle
 from ictv.models.ictv_object import ICTVObject
+from ictv.models.object_cache import CachedObject
 from ictv.models.plugin_param_access_rights import PluginParamAccessRights
 from ictv.models.subscription import Subscription
 
 
-class Plugin(ICTVObject):
+class Plugin(CachedObject, ICTVObject):
     name = StringCol(notNone=True, alternateID=True,length=50)
     description = StringCol(default=None)
     version = IntCol(notNone=True, default=0)
@@ -56,7 +57,9 @@ class Plugin(ICTVObject):
         """ Return the number of screens that are subscribed to channels of this plugin. """
         plugin_channels = PluginChannel.select().filter(PluginChannel.q.plugin == self)
         screens = set(plugin_channels.throughTo.subscriptions.throughTo.screen.distinct())
-        bundles = set(c for c in ChannelBundle.select() if any(bc.plugin == self for bc in c.flatten()))
+        candidate_bundles = ChannelBundle.get_bundles_containing([c.id for c in plugin_channels])
+        bundles = set(b for b in (ChannelBundle.get(id) for id in candidate_bundles)
+                      if any(bc.plugin == self for bc in b.flatten()))
         for b in bundles:
             screens |= set(Subscription.select().filter(Subscription.q.channel == b).throughTo.screen.distinct())
         return len(screens)
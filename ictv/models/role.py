@@ -27,6 +27,7 @@ from ictv.common.enum import FlagEnum
 
 class Role(ICTVObject):
     role_id = DatabaseIndex('user', 'channel', unique=True)
+    channel_index = DatabaseIndex('channel', 'permission_level')
     user = ForeignKey('User', cascade=True)
     channel = ForeignKey('PluginChannel', cascade=True)
     permission_level = EnumCol(enumValues=['channel_contributor', 'channel_administrator'])
@@ -29,10 +29,11 @@ import ictv.common.utils as utils
 from ictv.models.channel import PluginChannel, ChannelBundle
 from ictv.models.role import UserPermissions
 from ictv.models.ictv_object import ICTVObject
+from ictv.models.object_cache import CachedObject
 from ictv.models.subscription import Subscription
 
 
-class Screen(ICTVObject):
+class Screen(CachedObject, ICTVObject):
     name = StringCol(notNone=True, length =100)
     building = ForeignKey('Building', notNone=True, cascade=False)
     location = StringCol(default=None)  # A free text field to precise the screen location
@@ -116,23 +117,28 @@ class Screen(ICTVObject):
     def get_macs_string(self):
         return ';'.join(mac.get_pretty_mac() for mac in self.macs)
 
+    def get_plugin_channels(self):
+        """
+            Returns the plugin channels whose content is displayed by this screen as a list, in the order of its
+            subscriptions and ignoring channel duplicates.
+        """
+        plugin_channels = []
+        already_added_channels = set()
+        for sub in self.subscriptions:
+            for c in sub.channel.flatten():
+                # do not add duplicates
+                if c.id not in already_added_channels:
+                    plugin_channels.append(c)
+                    already_added_channels.add(c.id)
+        return plugin_channels
+
     def get_channels_content(self, app):
         """ 
             Returns all the capsules provided by the channels of this screen as an Iterable[PluginCapsule] 
             ignoring channel duplicates
         """
-        screen_capsules_iterables = []
-        already_added_channels = set()
         plugin_manager = app.plugin_manager
-
-        def add_content(channel):
-            for c in channel.flatten():
-                # do not add duplicates
-                if c.id not in already_added_channels:
-                    screen_capsules_iterables.append(plugin_manager.get_plugin_content(c))
-                    already_added_channels.add(c.id)
-        for sub in self.subscriptions:
-            add_content(sub.channel)
+        screen_capsules_iterables = plugin_manager.get_plugins_content(self.get_plugin_channels())
         screen_capsules = list(itertools.chain.from_iterable(screen_capsules_iterables))
         if self.shuffle:
             random.shuffle(screen_capsules)
@@ -143,6 +149,7 @@ class ScreenMac(ICTVObject):
     """ A simple class to associate multiple MACs to a screen. """
     screen = ForeignKey('Screen', cascade=True)
     mac = StringCol(unique=True,length=50)
+    screen_index = DatabaseIndex('screen')
 
     def get_pretty_mac(self):
         """ Returns the prettyfied version of the mac. """
@@ -28,5 +28,6 @@ class Subscription(ICTVObject):
     screen = ForeignKey('Screen', cascade=True)
     channel = ForeignKey('Channel', cascade=True)
     subscription_id = DatabaseIndex('screen', 'channel', unique=True)
+    channel_index = DatabaseIndex('channel')
     weight = IntCol(notNone=True, default=1)
     created_by = ForeignKey('User')
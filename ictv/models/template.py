@@ -22,7 +22,8 @@
 from sqlobject import StringCol
 
 from ictv.models.ictv_object import ICTVObject
+from ictv.models.object_cache import CachedObject
 
 
-class Template(ICTVObject):
+class Template(CachedObject, ICTVObject):
     name = StringCol(notNone=True, alternateID=True,length=100)
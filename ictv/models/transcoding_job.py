@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlobject import StringCol, EnumCol, IntCol, JSONCol, DateTimeCol
+
+from ictv.models.ictv_object import ICTVObject, ProcessOwnedObject
+
+
+class TranscodingJob(ProcessOwnedObject, ICTVObject):
+    """ Represents a video waiting to be transcoded or being transcoded by the TranscodingQueue. """
+    input_file = StringCol(notNone=True)
+    output_file = StringCol(notNone=True)
+    priority = IntCol(notNone=True, default=0)  # Jobs with a lower priority are transcoded first
+    duration = IntCol(default=None)  # The duration of the video in milliseconds, if known
+    state = EnumCol(enumValues=['queued', 'running'], default='queued')
+    callback = JSONCol(default=None)  # The module, name and arguments of the function called when the job is done
+    created = DateTimeCol(default=DateTimeCol.now)
+    owner = StringCol(default=None)  # The process transcoding this job
+    error = StringCol(default=None)  # The reason why this job failed without being transcoded, if it did
@@ -19,28 +19,84 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlobject import SQLObjectNotFound
+from datetime import datetime, timedelta, timezone
+from threading import Lock
 
-from ictv.models.channel import PluginChannel, Channel
-from ictv.pages.utils import ICTVPage
+import flask
+
+from ictv.models.distribution_graph import DistributionGraph
+from ictv.pages.utils import ICTVPage, get_content_fingerprint, get_content_last_modified, not_modified, \
+    with_validators
+
+import ictv.flask.response as resp
 
 
 class ChannelRenderer(ICTVPage):
+    transactional = False
+
     def get(self, channel_id, secret):
         """ Render the capsules of this channel. """
-        try:
-            channel = Channel.get(channel_id)
-            if channel.secret != secret:
-                resp.forbidden()
-        except SQLObjectNotFound:
+        graph = DistributionGraph.get()
+        channel = graph.get_channel(channel_id)
+        if channel is None:
             resp.notfound()
-        channel_capsules = []
+        if channel.secret != secret:
+            resp.forbidden()
+        plugin_channels = []
         already_added_channels = set()
-        for plugin_channel in channel.flatten(keep_disabled_channels=True):
+        for plugin_channel in graph.flatten(channel.id, keep_disabled_channels=True):
             if plugin_channel.id not in already_added_channels:
                 if plugin_channel.plugin.activated == 'yes':
-                    for capsule in self.plugin_manager.get_plugin_content(plugin_channel):
-                        if len(capsule.get_slides()) > 0:
-                            channel_capsules.append(capsule)
+                    plugin_channels.append(plugin_channel)
                 already_added_channels.add(plugin_channel.id)
-        return self.ictv_renderer.preview_capsules(channel_capsules, context='channel', auto_slide=True)
+        fingerprint = get_content_fingerprint(self.app, plugin_channels, 'channel', channel.id)
+        response = not_modified(fingerprint, self.app.channels_last_modified.get(channel.id, fingerprint))
+        if response is not None:
+            return response
+        channel_capsules = []
+        for content in self.plugin_manager.get_plugins_content(DistributionGraph.resolve(plugin_channels)):
+            for capsule in content:
+                if len(capsule.get_slides()) > 0:
+                    channel_capsules.append(capsule)
+        page = self.ictv_renderer.preview_capsules(channel_capsules, context='channel', auto_slide=True)
+        # The validators are computed again as the content of the channels may have been refreshed meanwhile
+        fingerprint = get_content_fingerprint(self.app, plugin_channels, 'channel', channel.id)
+        last_modified = None
+        if fingerprint is not None:
+            last_modified = self.app.channels_last_modified.put(channel.id, fingerprint,
+                                                                get_content_last_modified(self.app, plugin_channels))
+        return with_validators(flask.make_response(page), fingerprint, last_modified)
+
+
+class ChannelsLastModified(object):
+    """
+        Keeps the fingerprint of the last page rendered for each channel along with its last modification date, so that
+        a page with a new fingerprint is never dated before the one it replaces, e.g. after a channel was removed from
+        a bundle.
+    """
+
+    def __init__(self):
+        self._dates = {}  # A channel id to (fingerprint, last_modified) mapping
+        self._lock = Lock()
+
+    def get(self, channel_id, fingerprint):
+        """ Returns the last modification date of the page rendered for this channel with the given fingerprint. """
+        with self._lock:
+            stored_fingerprint, last_modified = self._dates.get(channel_id, (None, None))
+            return last_modified if fingerprint is not None and stored_fingerprint == fingerprint else None
+
+    def put(self, channel_id, fingerprint, last_modified):
+        """
+            Records the page rendered for this channel with the given fingerprint and returns its last modification
+            date. A page with a new fingerprint is always considered as more recent than the one it replaces.
+        """
+        with self._lock:
+            stored_fingerprint, stored_last_modified = self._dates.get(channel_id, (None, None))
+            if stored_fingerprint == fingerprint:
+                return stored_last_modified
+            if stored_fingerprint is not None \
+                    and last_modified.replace(microsecond=0) <= stored_last_modified.replace(microsecond=0):
+                # HTTP dates have a precision of a second
+                last_modified = max(datetime.now(timezone.utc), stored_last_modified + timedelta(seconds=1))
+            self._dates[channel_id] = (fingerprint, last_modified)
+            return last_modified
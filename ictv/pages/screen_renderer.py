@@ -20,42 +20,136 @@
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import random
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from threading import Lock
 
 import flask
-import ictv.flask.migration_adapter
 from sqlobject import SQLObjectNotFound
 
+from ictv.models.distribution_graph import DistributionGraph
 from ictv.models.screen import Screen
-from ictv.pages.utils import ICTVPage
+from ictv.pages.utils import ICTVPage, get_content_fingerprint, get_content_last_modified, not_modified, \
+    with_validators
+
+import ictv.flask.response as resp
 
 screens_logger = logging.getLogger('screens')
 
 
 class ScreenRenderer(ICTVPage):
+    transactional = False
+
     def get(self, screen_id, secret):
         """ Render the channels of this screen. """
-        try:
-            screen = Screen.get(screen_id)
-        except SQLObjectNotFound:
-            return migration_adapter.notfound()
+        screen = DistributionGraph.get().get_screen(screen_id)
+        if screen is None:
+            resp.notfound()
         if screen.secret != secret:
-            return migration_adapter.forbidden()
+            resp.forbidden()
         if flask.request.remote_addr is None:
             pass
         else:
             screens_logger.info("Request to the screen " + str(screen_id) + " has been done from:" + flask.request.remote_addr)
         if flask.request.headers.get('User-Agent') == 'cache_daemon.py':
-            screen.last_ip = flask.g.ip
-            screen.last_access = datetime.now()
-        return render_screen(screen, self.app)
+            try:
+                Screen.get(screen_id).set(last_ip=flask.g.ip, last_access=datetime.now())
+            except SQLObjectNotFound:
+                resp.notfound()
+        fingerprint = get_screen_fingerprint(screen, self.app)
+        response = not_modified(fingerprint, self.app.rendered_screens_cache.get_last_modified(screen.id, fingerprint))
+        if response is not None:
+            return response
+        page, fingerprint, last_modified = render_screen(screen, self.app, fingerprint)
+        return with_validators(flask.make_response(page), fingerprint, last_modified)
+
+
+class RenderedScreensCache(object):
+    """
+        Keeps the last rendered page of each screen along with the fingerprint of the content it was rendered from.
+        A page is served again as long as the fingerprint of the screen does not change, i.e. as long as its
+        subscriptions, the content generations of its channels, the theme and the templates stay the same.
+    """
+
+    def __init__(self):
+        self._pages = {}  # A screen id to (fingerprint, page, last_modified) mapping
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, screen_id, fingerprint):
+        """
+            Returns a tuple in the form (page, last_modified) for the page rendered for this screen with the given
+            fingerprint, or None if none is stored.
+        """
+        with self._lock:
+            stored_fingerprint, page, last_modified = self._pages.get(screen_id, (None, None, None))
+            if fingerprint is not None and stored_fingerprint == fingerprint:
+                self.hits += 1
+                return page, last_modified
+            self.misses += 1
+            return None
+
+    def get_last_modified(self, screen_id, fingerprint):
+        """ Returns the last modification date of the page stored for this screen with the given fingerprint. """
+        with self._lock:
+            stored_fingerprint, _, last_modified = self._pages.get(screen_id, (None, None, None))
+            return last_modified if fingerprint is not None and stored_fingerprint == fingerprint else None
+
+    def put(self, screen_id, fingerprint, page, last_modified):
+        """
+            Stores the page rendered for this screen with the given fingerprint and returns its last modification date.
+            A page with a new fingerprint is always considered as more recent than the one it replaces, even when the
+            content it is rendered from is not, e.g. after a change of subscriptions.
+        """
+        with self._lock:
+            stored_fingerprint, _, stored_last_modified = self._pages.get(screen_id, (None, None, None))
+            if stored_fingerprint is not None and stored_fingerprint != fingerprint \
+                    and last_modified.replace(microsecond=0) <= stored_last_modified.replace(microsecond=0):
+                # HTTP dates have a precision of a second
+                last_modified = max(datetime.now(timezone.utc), stored_last_modified + timedelta(seconds=1))
+            self._pages[screen_id] = (fingerprint, page, last_modified)
+            return last_modified
+
+    def invalidate(self, screen_id=None):
+        """ Drops the page stored for the given screen, or for all of them if no screen is given. """
+        with self._lock:
+            if screen_id is None:
+                self._pages.clear()
+            else:
+                self._pages.pop(screen_id, None)
+
+
+def get_screen_fingerprint(screen, app):
+    """
+        Returns a fingerprint of everything the rendered page of this screen depends on, or None if the page cannot be
+        cached, e.g. because the content of one of its channels has to be recomputed or because the screen is shuffled.
+    """
+    if screen.shuffle:
+        return None
+    return get_content_fingerprint(app, screen.get_plugin_channels(), screen.id, screen.show_slide_number)
 
 
-def render_screen(screen, app):
+def render_screen(screen, app, fingerprint=None):
+    """
+        Returns a tuple in the form (page, fingerprint, last_modified) for this screen. The fingerprint and the last
+        modification date of the page are None when it cannot be cached.
+    """
     try:
+        if fingerprint is None:
+            fingerprint = get_screen_fingerprint(screen, app)
+        cached = app.rendered_screens_cache.get(screen.id, fingerprint)
+        if cached is not None:
+            page, last_modified = cached
+            return page, fingerprint, last_modified
         screen_capsules = screen.get_channels_content(app)
-        return app.ictv_renderer.render_screen(screen_capsules, show_number=screen.show_slide_number)
+        page = app.ictv_renderer.render_screen(screen_capsules, show_number=screen.show_slide_number).encode()
+        # The fingerprint is computed again as the content of the channels may have been refreshed meanwhile
+        fingerprint = get_screen_fingerprint(screen, app)
+        last_modified = None
+        if fingerprint is not None:
+            last_modified = get_content_last_modified(app, screen.get_plugin_channels())
+            last_modified = app.rendered_screens_cache.put(screen.id, fingerprint, page, last_modified)
+        return page, fingerprint, last_modified
     except Exception:
         screens_logger.error('An Exception occured while rendering screen %s (%d)', screen.name, screen.id, exc_info=True)
         raise
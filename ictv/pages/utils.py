@@ -19,12 +19,15 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import re
+from datetime import date, datetime, timezone
 from functools import wraps
 from logging import getLogger
 
 import flask
 from flask.views import MethodView
+from werkzeug.http import is_resource_modified
 
 from ictv.flask.migration_adapter import Storage
 from ictv.models.role import UserPermissions
@@ -46,6 +49,10 @@ class ICTVPage(MethodView):
         DownloadManager, CleanupScheduler and ICTV config.
     """
 
+    # Whether the queries made by this page are run in a transaction. The pages rendering the content of channels do
+    # not run in a transaction, as the content is computed by other threads that would have to wait for it to commit.
+    transactional = True
+
     @property
     def app(self):
         """ Returns the web.py application singleton of ICTV Core. """
@@ -158,6 +165,51 @@ class ICTVPage(MethodView):
 
 
 
+def get_content_fingerprint(app, plugin_channels, *parameters):
+    """
+        Returns a fingerprint of the page rendered from the content of the given plugin channels with the given rendering
+        parameters, or None if the content of one of these channels has to be recomputed.
+        The date is part of the fingerprint so that the assets of a page keep being referenced each day.
+    """
+    generations = app.plugin_manager.get_content_generations(plugin_channels)
+    if generations is None:
+        return None
+    fingerprint = (parameters, app.config['default_theme'], app.ictv_renderer.get_templates_version(),
+                   date.today().isoformat(), generations)
+    return hashlib.sha1(repr(fingerprint).encode()).hexdigest()
+
+
+def get_content_last_modified(app, plugin_channels):
+    """ Returns the time of the last update of the content of the given plugin channels as an aware UTC datetime. """
+    last_updates = [app.plugin_manager.get_last_update(channel.id) for channel in plugin_channels]
+    last_update = max((u for u in last_updates if u is not None), default=None)
+    if last_update is None:
+        return datetime.now(timezone.utc)
+    return last_update.astimezone(timezone.utc)
+
+
+def not_modified(etag=None, last_modified=None):
+    """
+        Returns a 304 Not Modified response if the validators of the current request match the given ETag or
+        Last-Modified date, None otherwise.
+    """
+    if etag is None and last_modified is None:
+        return None
+    if is_resource_modified(flask.request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return with_validators(flask.Response(status=304), etag, last_modified)
+
+
+def with_validators(response, etag=None, last_modified=None):
+    """ Sets the given validators on this response and asks clients to revalidate it before reusing it. """
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
 class ICTVAuthPage(ICTVPage):
     """ A simple subclass to indicate that a subclassing page cannot be accessed without being authenticated. """
     pass
@@ -174,6 +226,8 @@ class DummyLogin(ICTVPage):
 
 
 class DummyRenderer(ICTVAuthPage):
+    transactional = False
+
     @ChannelGate.contributor
     def get(self, channelid, channel):
         return self.ictv_renderer.preview_capsules(self.plugin_manager.get_plugin_content(channel))
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import os
+import pickle
+import sqlite3
+import threading
+from abc import ABCMeta, abstractmethod
+from datetime import datetime
+from logging import getLogger
+
+from ictv.common import get_root_path
+
+logger = getLogger('plugin_manager')
+
+
+class ContentCache(metaclass=ABCMeta):
+    """
+        A store of the content computed for each channel.
+        Each entry is a dict with the following keys:
+            - content: the Iterable[PluginCapsule] computed for the channel
+            - retrieval_time: the datetime at which the computation of the content started
+            - generation: a number identifying this content, unique across all the entries ever stored
+            - complete: whether all the assets of the content are available on the filesystem
+            - served: whether the content was served since it was computed
+    """
+
+    @abstractmethod
+    def get(self, channel_id):
+        """ Returns the entry stored for this channel, or None if none exists. """
+        pass
+
+    @abstractmethod
+    def put(self, channel_id, content, retrieval_time):
+        """ Stores the given content for this channel under a new generation and returns the new entry. """
+        pass
+
+    @abstractmethod
+    def update(self, channel_id, generation, **fields):
+        """ Updates the given fields of the entry of this channel if it still holds the given generation. """
+        pass
+
+    @abstractmethod
+    def invalidate(self, channel_id):
+        """ Drops the entry stored for this channel. """
+        pass
+
+    def close(self):
+        """ Releases the resources used by this cache. """
+        pass
+
+
+class MemoryContentCache(ContentCache):
+    """ Stores the entries in the memory of the current process. """
+
+    def __init__(self):
+        self._entries = {}
+        self._generations = itertools.count(1)
+
+    def get(self, channel_id):
+        return self._entries.get(channel_id)
+
+    def put(self, channel_id, content, retrieval_time):
+        entry = {'retrieval_time': retrieval_time, 'content': content, 'generation': next(self._generations),
+                 'complete': False, 'served': False}
+        self._entries[channel_id] = entry
+        return entry
+
+    def update(self, channel_id, generation, **fields):
+        entry = self._entries.get(channel_id)
+        if entry is not None and entry['generation'] == generation:
+            entry.update(fields)
+
+    def invalidate(self, channel_id):
+        self._entries.pop(channel_id, None)
+
+
+class SQLiteContentCache(ContentCache):
+    """
+        Stores the entries in a SQLite database file, so that they are shared by all the processes of ICTV and survive
+        a restart.
+        The content of an entry is serialized using pickle. A content that cannot be serialized is only kept in the
+        memory of the process that computed it and is not written to the database, the other processes will then
+        compute it on their own without invalidating the content of each other.
+        The deserialized content of each entry is kept in memory as long as the generation of the entry does not change.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        self._contents = {}  # A channel id to (generation, content) mapping of deserialized contents
+        self._unserializable_entries = {}  # A channel id to entry mapping of the contents that cannot be serialized
+        self._lock = threading.Lock()
+        with self._get_conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS content_cache (channel_id INTEGER PRIMARY KEY, '
+                         'retrieval_time TEXT NOT NULL, generation INTEGER NOT NULL, complete INTEGER NOT NULL, '
+                         'served INTEGER NOT NULL, content BLOB)')
+            conn.execute('CREATE TABLE IF NOT EXISTS content_cache_generation (generation INTEGER NOT NULL)')
+            if conn.execute('SELECT COUNT(*) FROM content_cache_generation').fetchone()[0] == 0:
+                conn.execute('INSERT INTO content_cache_generation VALUES (0)')
+
+    def _get_conn(self):
+        if 'conn' not in self._local.__dict__:
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level='IMMEDIATE')
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+        return self._local.conn
+
+    def get(self, channel_id):
+        row = self._get_conn().execute('SELECT retrieval_time, generation, complete, served FROM content_cache '
+                                       'WHERE channel_id = ?', (channel_id,)).fetchone()
+        with self._lock:
+            entry = self._unserializable_entries.get(channel_id)
+            if entry is not None and (row is None or _parse_time(row[0]) <= entry['retrieval_time']):
+                return entry
+            self._unserializable_entries.pop(channel_id, None)  # A more recent content was stored by another process
+        if row is None:
+            return None
+        retrieval_time, generation, complete, served = row
+        with self._lock:
+            stored_generation, content = self._contents.get(channel_id, (None, None))
+        if stored_generation != generation:
+            serialized_content = self._get_conn().execute(
+                'SELECT content FROM content_cache WHERE channel_id = ? AND generation = ?',
+                (channel_id, generation)).fetchone()
+            if serialized_content is None or serialized_content[0] is None:
+                return None
+            content = pickle.loads(serialized_content[0])
+            with self._lock:
+                self._contents[channel_id] = (generation, content)
+        return {'retrieval_time': _parse_time(retrieval_time), 'content': content,
+                'generation': generation, 'complete': bool(complete), 'served': bool(served)}
+
+    def put(self, channel_id, content, retrieval_time):
+        try:
+            serialized_content = pickle.dumps(content, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.debug('The content of channel %d could not be serialized, it is only cached by this process',
+                         channel_id, exc_info=True)
+            serialized_content = None
+        with self._get_conn() as conn:
+            conn.execute('UPDATE content_cache_generation SET generation = generation + 1')
+            generation = conn.execute('SELECT generation FROM content_cache_generation').fetchone()[0]
+            if serialized_content is not None:
+                conn.execute('INSERT OR REPLACE INTO content_cache VALUES (?, ?, ?, 0, 0, ?)',
+                             (channel_id, retrieval_time.isoformat(), generation, serialized_content))
+        entry = {'retrieval_time': retrieval_time, 'content': content, 'generation': generation, 'complete': False,
+                 'served': False}
+        with self._lock:
+            if serialized_content is None:
+                self._unserializable_entries[channel_id] = entry
+            else:
+                self._unserializable_entries.pop(channel_id, None)
+                self._contents[channel_id] = (generation, content)
+        return entry
+
+    def update(self, channel_id, generation, **fields):
+        with self._lock:
+            entry = self._unserializable_entries.get(channel_id)
+            if entry is not None and entry['generation'] == generation:
+                entry.update(fields)
+                return
+        assignments = ', '.join('%s = ?' % field for field in fields if field in ('complete', 'served'))
+        if assignments:
+            with self._get_conn() as conn:
+                conn.execute('UPDATE content_cache SET %s WHERE channel_id = ? AND generation = ?' % assignments,
+                             [int(fields[f]) for f in fields if f in ('complete', 'served')] + [channel_id, generation])
+
+    def invalidate(self, channel_id):
+        with self._get_conn() as conn:
+            conn.execute('DELETE FROM content_cache WHERE channel_id = ?', (channel_id,))
+        with self._lock:
+            self._contents.pop(channel_id, None)
+            self._unserializable_entries.pop(channel_id, None)
+
+    def close(self):
+        if 'conn' in self._local.__dict__:
+            self._local.conn.close()
+            del self._local.conn
+
+
+def _parse_time(value):
+    """ Returns the datetime stored in the given string by datetime.isoformat. """
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def get_content_cache(config):
+    """ Returns the content cache described by the given content_cache configuration. """
+    backend = config.get('backend', 'memory')
+    if backend == 'memory':
+        return MemoryContentCache()
+    elif backend == 'sqlite':
+        path = config['path']
+        if not os.path.isabs(path):
+            path = os.path.join(get_root_path(), path)
+        return SQLiteContentCache(path)
+    raise ValueError('Unknown content cache backend: %s' % backend)
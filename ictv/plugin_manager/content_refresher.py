@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import sched
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Thread, Lock, Event
+
+from sqlobject import SQLObjectNotFound
+
+from ictv.database import setup_thread_connection, call_after_commit
+from ictv.models.channel import PluginChannel
+
+logger = getLogger('plugin_manager')
+
+
+class ContentRefresher(object):
+    """
+        Recomputes the content of the channels in the background shortly before their cache expires, so that screen
+        requests are always served the last computed content rather than waiting for the plugins.
+
+        A channel is scheduled for a refresh each time its content is computed. The refresh happens `advance` seconds
+        before the cache of the channel expires, minus a random delay of up to `jitter` seconds so that channels of a
+        same plugin do not reach its upstream at the same instant. Channels whose content was not served since its last
+        computation are not refreshed anymore, their content is then recomputed upon the next request.
+        The refreshes are run on a pool of `workers` threads.
+    """
+    def __init__(self, plugin_manager, workers=4, advance=30, jitter=30):
+        """
+            :param plugin_manager: The PluginManager computing the content of the channels
+            :param workers: The maximum number of channels refreshed at the same time
+            :param advance: The delay in seconds between the refresh of a channel and the expiry of its cache
+            :param jitter: The maximum random delay in seconds added to the advance of each refresh
+        """
+        self._plugin_manager = plugin_manager
+        self._advance = advance
+        self._jitter = jitter
+        self._s = sched.scheduler(timefunc=time.time)
+        self._events = {}  # A channel id to scheduled refresh mapping
+        self._pending = set()  # The ids of the channels being refreshed or waiting for a worker to do so
+        self._lock = Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='content_refresher')
+        self._wakeup = Event()
+        self._running = True
+        self._t = Thread(target=self._run_sched)
+        self._t.start()
+
+    def __del__(self):
+        self.stop()
+
+    def schedule(self, channel, retrieval_time):
+        """ Schedules the refresh of the given channel before the expiry of the content retrieved at the given time. """
+        expiry = time.mktime(retrieval_time.timetuple()) + channel.cache_validity * 60
+        refresh_time = max(time.time(), expiry - self._advance - random.uniform(0, self._jitter))
+        with self._lock:
+            self._cancel(channel.id)
+            self._events[channel.id] = self._enterabs(refresh_time, 1, self._submit, argument=(channel.id, True))
+
+    def refresh(self, channel):
+        """ Refreshes the content of the given channel as soon as possible, unless it is already being refreshed. """
+        with self._lock:
+            self._cancel(channel.id)
+        # The refresh must see the changes made to the channel by the current transaction
+        call_after_commit(lambda: self._submit(channel.id, False))
+
+    def _cancel(self, channel_id):
+        event = self._events.pop(channel_id, None)
+        if event is not None:
+            try:
+                self._s.cancel(event)
+            except ValueError:
+                pass  # The event is being run
+
+    def _submit(self, channel_id, scheduled):
+        with self._lock:
+            if scheduled:
+                self._events.pop(channel_id, None)
+            if channel_id in self._pending or not self._running:
+                return
+            self._pending.add(channel_id)
+        self._pool.submit(self._refresh, channel_id, scheduled)
+
+    def _refresh(self, channel_id, scheduled):
+        setup_thread_connection()
+        try:
+            channel = PluginChannel.get(channel_id)
+            if channel.plugin.activated != 'yes' or not channel.cache_activated:
+                return
+            if scheduled and not self._plugin_manager.was_served(channel.id):
+                logger.debug('Content for plugin %s and channel %d was not served since its last refresh',
+                             channel.plugin.name, channel.id)
+                return
+            logger.debug('Refreshing content for plugin %s and channel %d', channel.plugin.name, channel.id)
+            self._plugin_manager.refresh_plugin_content(channel)
+        except SQLObjectNotFound:
+            pass
+        except Exception:
+            logger.warning('An Exception was encountered when refreshing the content of channel %d', channel_id,
+                           exc_info=True)
+        finally:
+            with self._lock:
+                self._pending.discard(channel_id)
+
+    def _wait(self, delay):
+        """ Sleeps for the given delay or until a refresh is scheduled. """
+        if self._wakeup.wait(delay):
+            self._wakeup.clear()
+
+    def _run_sched(self):
+        while self._running:
+            self._wait(self._s.run(blocking=False))
+
+    def _enterabs(self, event_time, priority, action, argument):
+        event = self._s.enterabs(event_time, priority, action, argument=argument)
+        self._wakeup.set()
+        return event
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self._wakeup.set()
+            self._t.join()
+            self._pool.shutdown(wait=True)
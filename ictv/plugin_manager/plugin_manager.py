@@ -23,8 +23,11 @@ import importlib
 import logging
 import os
 import sys
+import time
 import pkgutil
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 from datetime import timedelta, datetime
+from threading import Lock
 from urllib.parse import urlparse
 
 import zlib
@@ -35,10 +38,13 @@ from ictv.models.asset import Asset
 from ictv.common.logging import StatHandler
 from ictv.common.utils import make_qrcode, is_test
 from ictv.common import get_root_path
+from ictv.database import setup_thread_connection
 from ictv.models.channel import PluginChannel
 from ictv.models.plugin import Plugin
 from ictv.models.role import Role
 from ictv.models.user import User
+from ictv.plugin_manager.content_cache import get_content_cache
+from ictv.plugin_manager.content_refresher import ContentRefresher
 from ictv.plugin_manager.email_digester import EmailDigester
 from ictv.plugin_manager.plugin_utils import MisconfiguredParameters
 from ictv.renderer.renderer import Templates
@@ -56,7 +62,11 @@ class PluginManager(object):
         self.plugins_modules = {}  # A plugin name to Python module mapping, containing all plugin modules loaded
         self.plugins_apps = {}  # A plugin name to web.py application mapping, containing all plugin webapp loaded
         self.app = app
-        self.cache = {}
+        self.cache = get_content_cache(app.config.get('content_cache', {}))
+        self._computations = {}  # A channel id to Future mapping, holding the content computations in progress
+        self._computations_lock = Lock()
+        self.computations = 0  # The number of content computations run
+        self.coalesced_computations = 0  # The number of content computations saved by waiting for one in progress
         alert_template_limits_config = app.config.get('alert_template_limits', {})
         self.template_limits_emailing_activated = alert_template_limits_config.get('activated', False)
         if self.template_limits_emailing_activated:
@@ -64,42 +74,179 @@ class PluginManager(object):
                 timedelta(hours=alert_template_limits_config['digest_hour_interval']),
                 subject=alert_template_limits_config['subject'])
         self.missing_dependencies = {}  # A plugin name to list of missing modules mapping
+        background_refresh_config = app.config.get('background_refresh', {})
+        self.content_refresher = None
+        if background_refresh_config.get('activated', False):
+            self.content_refresher = ContentRefresher(self, workers=background_refresh_config['workers'],
+                                                      advance=background_refresh_config['advance'],
+                                                      jitter=background_refresh_config['jitter'])
+        parallel_retrieval_config = app.config.get('parallel_retrieval', {})
+        self._retrieval_pool = None
+        if parallel_retrieval_config.get('activated', False):
+            self._retrieval_pool = ThreadPoolExecutor(max_workers=parallel_retrieval_config['workers'],
+                                                      thread_name_prefix='content_retrieval')
+            self._retrieval_timeout = parallel_retrieval_config['timeout']
+        self._last_content = {}  # A channel id to last content returned mapping
+        # A channel id to (content generation, ids of the assets used by this content) mapping
+        self._referenced_assets = {}
 
     def stop(self):
         if self.template_limits_emailing_activated:
             self.template_limits_email_digester.stop()
+        if self.content_refresher is not None:
+            self.content_refresher.stop()
+        if self._retrieval_pool is not None:
+            self._retrieval_pool.shutdown(wait=False)
+        self.cache.close()
 
     def get_plugin_content(self, channel):
         """
             Imports the channel plugin if needed and returns the channel content as an Iterable[PluginCapsule].
             If the channel has caching activated and the cache is still fresh, the content will be returned from cache
             for fast content retrieval rather than recomputed.
+            When the content is refreshed in background, an expired content is returned as is while a refresh of the
+            channel is triggered.
         """
-        logger_extra = {'channel_name': channel.name, 'channel_id': channel.id}
-        plugin_logger = get_logger(channel.plugin.name, channel)
         now = datetime.now()
-        if channel.id in self.cache \
-                and channel.cache_activated \
-                and self.cache[channel.id]['retrieval_time'] + timedelta(minutes=channel.cache_validity) > now:
-            content = self.cache[channel.id]['content']
+        cache_entry = self.cache.get(channel.id)
+        if self._is_cache_fresh(channel, cache_entry, now):
             logger.debug('Content for plugin %s and channel %d was served from cache', channel.plugin.name, channel.id)
+        elif cache_entry is not None and channel.cache_activated and self.content_refresher is not None:
+            logger.debug('Expired content for plugin %s and channel %d was served from cache', channel.plugin.name,
+                         channel.id)
+            self.content_refresher.refresh(channel)
         else:
-            try:
-                plugin = self.get_plugin(channel.plugin.name)
-                content = plugin.get_content(channel.id)
-                self.cache[channel.id] = {'retrieval_time': now, 'content': content}
-            except MisconfiguredParameters as e:
-                logger.warning('Plugin %s and channel %d reported %d faulty parameter(s)', channel.plugin.name, channel.id, len(e))
-                plugin_logger.warning('Some parameters were misconfigured', extra=logger_extra, exc_info=True)
+            cache_entry = self._compute_plugin_content(channel, now, cache_entry)
+            if cache_entry is None:
                 return []
-            except Exception as e:
+        self._update_cache_entry(channel.id, cache_entry, served=True)
+        content = self._post_process_content(channel, cache_entry)
+        self._last_content[channel.id] = content
+        return content
+
+    def get_plugins_content(self, channels):
+        """
+            Returns a list containing the content of each of the given channels, in the same order.
+            When parallel retrieval is activated, the contents are retrieved concurrently and a channel whose content
+            cannot be retrieved in time is given the last content returned for it, or no content at all.
+            Each channel is given the retrieval timeout from the moment its retrieval starts, so that a slow channel does
+            not shorten the time given to the others. A channel whose retrieval cannot start within the timeout, as all
+            the workers are busy, is not retrieved.
+        """
+        if self._retrieval_pool is None:
+            return [self.get_plugin_content(channel) for channel in channels]
+        submitted = time.monotonic()
+        starts = [None] * len(channels)  # The time at which the retrieval of each channel started
+        retrievals = [(channel, self._retrieval_pool.submit(self._retrieve_plugin_content, channel.id, starts, i))
+                      for i, channel in enumerate(channels)]
+        contents = []
+        for i, (channel, retrieval) in enumerate(retrievals):
+            try:
+                contents.append(self._wait_for_retrieval(retrieval, starts, i, submitted))
+            except TimeoutError:
+                logger.warning('Content for plugin %s and channel %d could not be retrieved in time, its last content '
+                               'was served instead', channel.plugin.name, channel.id)
+                contents.append(self._last_content.get(channel.id, []))
+            except Exception:
                 logger.warning('Encountered exception when retrieving content for plugin %s and channel %d',
-                               channel.plugin.name, channel.id)
-                plugin_logger.warning('Encountered exception when retrieving content:',
-                                      extra=logger_extra, exc_info=True)
-                return []
+                               channel.plugin.name, channel.id, exc_info=True)
+                contents.append([])
+        return contents
+
+    def _retrieve_plugin_content(self, channel_id, starts, index):
+        starts[index] = time.monotonic()
+        setup_thread_connection()
+        # The channel is fetched again to be bound to the connection of this thread
+        return self.get_plugin_content(PluginChannel.get(channel_id))
+
+    def _wait_for_retrieval(self, retrieval, starts, index, submitted):
+        """ Returns the result of this retrieval, or raises a TimeoutError if it did not complete in time. """
+        while True:
+            start = starts[index]
+            deadline = (start if start is not None else submitted) + self._retrieval_timeout
+            try:
+                return retrieval.result(timeout=max(0, deadline - time.monotonic()))
+            except TimeoutError:
+                if start is not None or retrieval.cancel():
+                    raise
+                # The retrieval started meanwhile, it is given the whole timeout from its start
+
+    def refresh_plugin_content(self, channel):
+        """ Recomputes the content of this channel and caches its assets ahead of its next request. """
+        cache_entry = self._compute_plugin_content(channel, datetime.now(), self.cache.get(channel.id))
+        if cache_entry is not None:
+            self._post_process_content(channel, cache_entry)
+
+    def was_served(self, channel_id):
+        """ Returns whether the cached content of this channel was served since it was computed. """
+        cache_entry = self.cache.get(channel_id)
+        return cache_entry is not None and cache_entry['served']
+
+    def _update_cache_entry(self, channel_id, cache_entry, **fields):
+        """ Updates the given fields of this cache entry, both in the given dict and in the cache. """
+        if any(cache_entry[field] != value for field, value in fields.items()):
+            cache_entry.update(fields)
+            self.cache.update(channel_id, cache_entry['generation'], **fields)
+
+    def _compute_plugin_content(self, channel, now, outdated_cache_entry):
+        """
+            Computes the content of this channel and stores it in cache. Returns the new cache entry, or None if the
+            content could not be computed.
+            Concurrent computations of the content of a same channel are coalesced: the first caller computes the
+            content while the others wait for its result. A caller that found the given outdated cache entry also
+            receives the result of a computation that has replaced it since then.
+        """
+        with self._computations_lock:
+            cache_entry = self.cache.get(channel.id)
+            if cache_entry is not None and (outdated_cache_entry is None
+                                            or cache_entry['generation'] != outdated_cache_entry['generation']):
+                self.coalesced_computations += 1
+                return cache_entry
+            computation = self._computations.get(channel.id)
+            coalesced = computation is not None
+            if coalesced:
+                self.coalesced_computations += 1
+            else:
+                computation = self._computations[channel.id] = Future()
+                self.computations += 1
+        if coalesced:
+            return computation.result()
+        cache_entry = None
+        try:
+            cache_entry = self._run_plugin_content_computation(channel, now)
+        finally:
+            with self._computations_lock:
+                del self._computations[channel.id]
+            computation.set_result(cache_entry)
+        return cache_entry
+
+    def _run_plugin_content_computation(self, channel, now):
+        logger_extra = {'channel_name': channel.name, 'channel_id': channel.id}
+        plugin_logger = get_logger(channel.plugin.name, channel)
+        try:
+            plugin = self.get_plugin(channel.plugin.name)
+            content = plugin.get_content(channel.id)
+            cache_entry = self.cache.put(channel.id, content, now)
+            if self.content_refresher is not None and channel.cache_activated:
+                self.content_refresher.schedule(channel, now)
+            return cache_entry
+        except MisconfiguredParameters as e:
+            logger.warning('Plugin %s and channel %d reported %d faulty parameter(s)', channel.plugin.name, channel.id, len(e))
+            plugin_logger.warning('Some parameters were misconfigured', extra=logger_extra, exc_info=True)
+            return None
+        except Exception as e:
+            logger.warning('Encountered exception when retrieving content for plugin %s and channel %d',
+                           channel.plugin.name, channel.id)
+            plugin_logger.warning('Encountered exception when retrieving content:',
+                                  extra=logger_extra, exc_info=True)
+            return None
+
+    def _post_process_content(self, channel, cache_entry):
+        """ Filters out the non complying capsules of this cache entry, dereferences and caches their assets. """
+        logger_extra = {'channel_name': channel.name, 'channel_id': channel.id}
+        plugin_logger = get_logger(channel.plugin.name, channel)
         try:
-            content, filtered_out_content = self.filter_non_complying_content(content,
+            content, filtered_out_content = self.filter_non_complying_content(cache_entry['content'],
                                                                               channel.keep_noncomplying_capsules)
 
             if filtered_out_content:
@@ -116,8 +263,11 @@ class PluginManager(object):
                 if self.template_limits_emailing_activated and ( not channel.drop_silently_non_complying_slides if channel.drop_silently_non_complying_slides is not None else not channel.plugin.drop_silently_non_complying_slides_default):
                     self.send_email_alert(channel, filtered_out_content)
 
-            self.dereference_assets(content)
-            self.cache_assets(content, channel.id)
+            asset_ids = set()
+            self.dereference_assets(content, asset_ids)
+            self._update_cache_entry(channel.id, cache_entry,
+                                     complete=self.cache_assets(content, channel.id, asset_ids))
+            self._reference_assets(channel.id, cache_entry, asset_ids)
             return content
         except Exception as e:
             logger.warning('Encountered exception when post-processing content for plugin %s and channel %d',
@@ -234,7 +384,7 @@ class PluginManager(object):
 
     def invalidate_cache(self, plugin_name, channel_id):
         """ Invalidates both Plugin Manager cache and the plugin's cache if it have one. """
-        self.cache.pop(channel_id, None)
+        self.cache.invalidate(channel_id)
         plugin = self.get_plugin(plugin_name)
         if hasattr(plugin, 'invalidate_cache'):
             try:
@@ -246,7 +396,55 @@ class PluginManager(object):
 
     def get_last_update(self, channel_id):
         """ Returns the timestamp of the last cached update for this channel, or None if none exists. """
-        return self.cache.get(channel_id, {}).get('retrieval_time')
+        cache_entry = self.cache.get(channel_id)
+        return cache_entry['retrieval_time'] if cache_entry is not None else None
+
+    def get_content_generations(self, channels):
+        """
+            Returns a list of (channel id, content generation) tuples for the given channels if the content of each of
+            them can be served from cache as is, or None if at least one of them has to be recomputed.
+            The content of a channel is not considered as servable as is while some of its assets are being cached.
+            The content of the channels is considered as served when their generations are returned, as rendered pages
+            can be served without retrieving it.
+        """
+        now = datetime.now()
+        cache_entries = [self.cache.get(channel.id) for channel in channels]
+        generations = []
+        for channel, cache_entry in zip(channels, cache_entries):
+            if not self._is_cache_servable(channel, cache_entry, now) or not cache_entry['complete']:
+                return None
+            generations.append((channel.id, cache_entry['generation']))
+        for channel, cache_entry in zip(channels, cache_entries):
+            self._update_cache_entry(channel.id, cache_entry, served=True)
+            self._reference_assets(channel.id, cache_entry)
+            if self.content_refresher is not None and not self._is_cache_fresh(channel, cache_entry, now):
+                self.content_refresher.refresh(channel)
+        return generations
+
+    def _reference_assets(self, channel_id, cache_entry, asset_ids=()):
+        """
+            Records that the assets used by the content of this cache entry are being used, along with the given ones
+            found in it. The assets are recorded when the content is post-processed, so that they are still referenced
+            when the rendered pages are served without it, and as they cannot be found again in the rewritten content.
+        """
+        generation, referenced_assets = self._referenced_assets.get(channel_id, (None, frozenset()))
+        if generation != cache_entry['generation']:
+            referenced_assets = frozenset()
+        referenced_assets = referenced_assets.union(asset_ids)
+        self._referenced_assets[channel_id] = (cache_entry['generation'], referenced_assets)
+        Asset.reference_ids(referenced_assets)
+
+    @staticmethod
+    def _is_cache_fresh(channel, cache_entry, now):
+        """ Returns whether this cache entry of the given channel exists and can still be served at the given time. """
+        return cache_entry is not None and channel.cache_activated \
+            and cache_entry['retrieval_time'] + timedelta(minutes=channel.cache_validity) > now
+
+    def _is_cache_servable(self, channel, cache_entry, now):
+        """ Returns whether this cache entry of the given channel would be served as is at the given time. """
+        if self.content_refresher is not None:
+            return cache_entry is not None and channel.cache_activated
+        return self._is_cache_fresh(channel, cache_entry, now)
 
     @staticmethod
     def get_plugins_modules():
@@ -263,11 +461,12 @@ class PluginManager(object):
         return modules_list
 
     @staticmethod
-    def dereference_assets(capsules):
+    def dereference_assets(capsules, asset_ids=None):
         """
             Dereference assets files contained in the given capsules.
             Replaces them with an input-type usable by the renderer.
             It also prefixes src attribute in an absolute path if a local path is detected.
+            The ids of the dereferenced assets are added to the given set, if any.
         """
         for capsule in capsules:
             for slide in capsule.get_slides():
@@ -276,6 +475,8 @@ class PluginManager(object):
                             'background-'):
                         file_ref = input_data.pop('file', None)
                         if file_ref is not None:
+                            if asset_ids is not None:
+                                asset_ids.add(file_ref)
                             input_type = 'video' if _is_video(file_ref) else 'src'
                             input_data[input_type] = '/' + StorageManager.get_asset_path(file_ref)
                         else:
@@ -286,9 +487,13 @@ class PluginManager(object):
                                     # Transform the local relative path to the root to an url relative to the domain
                                     input_data[input_type] = '/static/' + input_data[input_type]
 
-    def cache_assets(self, capsules, channel_id):
-        """ Caches both remote assets and QR codes. """
+    def cache_assets(self, capsules, channel_id, asset_ids=None):
+        """
+            Caches both remote assets and QR codes. Returns whether all the assets are available on the filesystem.
+            The ids of the cached assets are added to the given set, if any.
+        """
         cache_manager = CacheManager(channel_id, self.app.download_manager)
+        all_available = True
         for capsule in capsules:
             for slide in capsule.get_slides():
                 for field_type, input_data in slide.get_content().items():
@@ -304,8 +509,14 @@ class PluginManager(object):
                                 asset = cache_manager.cache_file(make_qrcode(input_data['qrcode']),
                                                                  qrcode_filename + os.extsep + 'svg')
                         if asset:
-                            input_data['src'] = ('/' + asset.path) if asset.path is not None else '/cache/' + str(
+                            if asset_ids is not None:
+                                asset_ids.add(asset.id)
+                            asset_path = asset.path
+                            if asset_path is None:
+                                all_available = False
+                            input_data['src'] = ('/' + asset_path) if asset_path is not None else '/cache/' + str(
                                 asset.id)
+        return all_available
 
     @staticmethod
     def filter_non_complying_content(capsules, keep_capsules=False):
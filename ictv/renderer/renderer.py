@@ -20,17 +20,23 @@
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
 import colorsys
+import hashlib
+import json
 import os
 import re
 import sys
-from copy import deepcopy
+import tempfile
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from html import unescape
+from threading import Lock
 
 
 import yaml
 
 from ictv.common import utils, get_root_path
-from ictv.common.utils import deep_update
+from ictv.common.utils import deep_update, deep_overlay, deep_freeze, deep_thaw
 from ictv.libs.html import HTML
 from ictv.plugin_manager.plugin_capsule import PluginCapsule
 from ictv.plugin_manager.plugin_slide import PluginSlide
@@ -40,9 +46,59 @@ from jinja2 import Environment, FileSystemLoader, nodes
 
 
 
+class FragmentCache(object):
+    """
+        A cache of the HTML fragments of rendered slides, keyed by the template, theme, duration and a digest of the
+        content of each slide. The least recently used fragments are evicted once their total size exceeds the given
+        number of bytes.
+    """
+
+    def __init__(self, max_size):
+        self._fragments = OrderedDict()
+        self._size = 0
+        self._max_size = max_size
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(slide, theme):
+        """ Returns the key of the fragment of the given slide rendered with the given theme. """
+        content_digest = hashlib.sha1(json.dumps(slide.get_content(), sort_keys=True, default=repr).encode()).hexdigest()
+        return slide.get_template(), theme, slide.get_duration(), content_digest
+
+    def get(self, key):
+        """ Returns the fragment stored under this key, or None if none is stored. """
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._fragments.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, key, fragment):
+        """ Stores this fragment under the given key, evicting the least recently used fragments if needed. """
+        if len(fragment) > self._max_size:
+            return
+        with self._lock:
+            if key in self._fragments:
+                self._size -= len(self._fragments.pop(key))
+            self._fragments[key] = fragment
+            self._size += len(fragment)
+            while self._size > self._max_size:
+                _, evicted_fragment = self._fragments.popitem(last=False)
+                self._size -= len(evicted_fragment)
+
+
 class SlideRenderer(object):
     """ A parameterizable slide renderer. All classes that render slide should extend it. """
 
+    templates_version_ttl = 5  # The number of seconds during which the version of the templates is not checked again
+    _templates_version = None
+    _templates_version_expiry = 0
+
     def __init__(self, renderer_globals, app):
         """
             Initializes a slide renderer with the given globals.
@@ -67,28 +123,43 @@ class SlideRenderer(object):
         ###########
 
         self.app = app
+        fragment_cache_size = app.config.get('fragment_cache', {}).get('max_megabytes', 0) if app is not None else 0
+        self.fragment_cache = FragmentCache(fragment_cache_size * 1024 * 1024) if fragment_cache_size > 0 else None
         super(SlideRenderer, self).__init__()
 
     def render_slide(self, slide, slide_defaults=None):
         """ Returns the complete HTML element representing the given slide rendered without any outer capsule."""
         if slide_defaults is None:
             slide_defaults = {}
-        deep_update(slide_defaults, slide.get_content())
+        content = deep_overlay(slide_defaults, slide.get_content())
 
-        return self.slide_renderer.__getattr__(slide.get_template())(slide=slide_defaults,slide_b=slide,base="base.html")
+        return self.slide_renderer.__getattr__(slide.get_template())(slide=content,slide_b=slide,base="base.html")
 
         #return self.slide_renderer.base(get_bg=get_bg,
         #    content=(self.slide_renderer.__getattr__(slide.get_template())(slide=slide_defaults)), slide=slide)
 
+    def render_themed_slide(self, slide, theme):
+        """
+            Returns the HTML element representing the given slide rendered with the defaults of the given theme, if any.
+            The element is served from the fragment cache when the same slide was already rendered with this theme.
+        """
+        if self.fragment_cache is None:
+            return str(self.render_slide(slide, Themes.get_frozen_slide_defaults(theme) if theme is not None else {}))
+        key = self.fragment_cache.get_key(slide, theme)
+        fragment = self.fragment_cache.get(key)
+        if fragment is None:
+            fragment = str(self.render_slide(slide, Themes.get_frozen_slide_defaults(theme) if theme is not None else {}))
+            self.fragment_cache.put(key, fragment)
+        return fragment
+
     def render_capsule(self, capsule):
         """ Returns the complete HTML element representing the given capsule. """
         content = ""
         capsule_theme = capsule.get_theme()
         if not capsule_theme or capsule_theme not in Themes:
             capsule_theme = self.app.config['default_theme']
-        slide_defaults = Themes.get_slide_defaults(capsule_theme)
         for s in capsule.get_slides():
-            content += str(self.render_slide(s, deepcopy(slide_defaults)))
+            content += self.render_themed_slide(s, capsule_theme)
         themes = Themes.prepare_for_css_inclusion([capsule_theme])
         return '<section class="%s">%s</section>' % (' '.join(themes), content)
 
@@ -124,14 +195,8 @@ class SlideRenderer(object):
 
     def preview_slide(self, slide, theme=None, small_size=False):
         """ Returns a full HTML page representing a preview of the given slide. """
-        if theme is None:
-            themes = []
-            slide_defaults = {}
-        else:
-            themes = Themes.prepare_for_css_inclusion([theme])
-            slide_defaults = Themes.get_slide_defaults(theme)
-        slide_html = str(self.render_slide(slide, slide_defaults=slide_defaults))
-        capsule = slide_html
+        themes = Themes.prepare_for_css_inclusion([theme]) if theme is not None else []
+        capsule = self.render_themed_slide(slide, theme)
         return self.preview_renderer.preview(content=capsule, themes=themes, controls=False, small_size=small_size)
 
     def preview_capsules(self, capsules, context=None, auto_slide=False):
@@ -149,6 +214,28 @@ class SlideRenderer(object):
         return self.preview_renderer.screen(content=content, themes=themes, controls=controls,
                                             force_page_reloading=force_page_reloading, show_number=show_number)
 
+    @staticmethod
+    def get_templates_version():
+        """
+            Returns a value that changes whenever one of the templates used to render slides and pages is modified.
+            The templates are only checked again once the last known version is older than templates_version_ttl seconds.
+        """
+        now = time.monotonic()
+        if SlideRenderer._templates_version is None or now >= SlideRenderer._templates_version_expiry:
+            SlideRenderer._templates_version = SlideRenderer._compute_templates_version()
+            SlideRenderer._templates_version_expiry = now + SlideRenderer.templates_version_ttl
+        return SlideRenderer._templates_version
+
+    @staticmethod
+    def _compute_templates_version():
+        version = 0
+        for directory in (os.path.join(get_root_path(), 'renderer'), os.path.join(get_root_path(), 'renderer/templates')):
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.html'):
+                        version = max(version, entry.stat().st_mtime_ns)
+        return version
+
     def render_screen_client(self, screen):
         """
             Return a full HTML page representing the HTML/JS client with smooth reloading and added features in the
@@ -186,33 +273,125 @@ def get_const_in_template(template_name):
 
     return variables
 
+# The name of the functions that render slide fields in templates, mapped to the type of the fields they render
+_field_functions = {'title': 'title', 'subtitle': 'subtitle', 'img': 'image', 'logo': 'logo', 'text': 'text',
+                    'background': 'background'}
+_templates_cache_version = 2
+
+
+def parse_template(template_name):
+    """
+        Returns a tuple in the form `fields, constants` describing the given template, obtained in a single pass over
+        its Jinja AST. `fields` is a list of (field id, field attributes) tuples in the order of their declaration,
+        `constants` is a dict of the constant variables declared at the top level of the template.
+        Returns None if a field is not declared using constant arguments or is declared in a conditional block, as only
+        rendering the template tells whether it is part of the template.
+    """
+    fields = []
+    constants = {}
+
+    def visit(node, top_level, conditional):
+        if top_level and type(node) is nodes.Assign and type(node.node) is nodes.Const:
+            constants[node.target.name] = node.node.value
+        if type(node) is nodes.Call and type(node.node) is nodes.Name and node.node.name in _field_functions:
+            kwargs = {kwarg.key: kwarg.value for kwarg in node.kwargs}
+            if conditional or 'number' not in kwargs or any(type(kwargs[k]) is not nodes.Const
+                                                            for k in ('number', 'max_chars') if k in kwargs):
+                return False
+            id = _field_functions[node.node.name] + '-' + str(kwargs['number'].value)
+            fields.append((id, {'max_chars': kwargs['max_chars'].value} if 'max_chars' in kwargs else {}))
+        conditional = conditional or type(node) is nodes.If
+        return all(visit(child, False, conditional) for child in node.iter_child_nodes())
+
+    parsed_content = Environment().parse(read_raw_template(template_name))
+    if not all(visit(element, True, False) for element in parsed_content.body):
+        return None
+    return fields, constants
+
+
+def render_template_fields(template_name):
+    """ Returns the fields of the given template, in the same form as parse_template, by rendering it. """
+    fields = []
+
+    def f(type):
+        def g(*args, **kwargs):
+            fields.append((type + '-' + str(kwargs['number']), {'max_chars': kwargs['max_chars']} if 'max_chars' in kwargs else {}))
+        return g
+
+    dummy_renderer = SlideRenderer({name: f(type) for name, type in _field_functions.items()}, None)
+    # Useful to set some attribute in the template
+    getattr(dummy_renderer.slide_renderer, template_name)(slide=None)
+    return fields
+
+
+def get_templates_cache_path():
+    """
+        Returns the path of the file caching the description of the templates. It is stored in the temporary directory,
+        as the package may be installed read-only, under a name proper to the user and to this installation of ICTV.
+    """
+    installation = hashlib.sha1(get_root_path().encode()).hexdigest()[:12]
+    user = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.path.join(tempfile.gettempdir(), 'ictv-templates-%s-%s.json' % (user, installation))
+
+
+def load_templates(cache_path=None):
+    """
+        Returns the description of the templates used to render slides, in the form documented in the Templates class.
+        Each template is parsed at most once: the result of its parsing is stored in the given cache file if any, along
+        with the modification time, size and hash of the template, and reused as long as the template does not change.
+        A template is only rendered when its fields cannot be found by parsing it.
+    """
+    templates_dir = os.path.join(get_root_path(), 'renderer/templates')
+    cache = {}
+    if cache_path is not None:
+        try:
+            with open(cache_path) as f:
+                # The temporary directory is shared, only a cache written by the current user is trusted
+                if not hasattr(os, 'getuid') or os.fstat(f.fileno()).st_uid == os.getuid():
+                    cache = json.load(f)
+            if cache.get('version') != _templates_cache_version:
+                cache = {}
+        except (OSError, ValueError):
+            cache = {}
+    cached_templates = cache.get('templates', {})
+
+    templates = {}
+    new_cache = {'version': _templates_cache_version, 'templates': {}}
+    for filename in os.listdir(templates_dir):
+        if filename == 'base.html':
+            continue
+        template = os.path.splitext(filename)[0]
+        stat = os.stat(os.path.join(templates_dir, filename))
+        entry = cached_templates.get(template)
+        if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            digest = hashlib.sha1(read_raw_template(template).encode()).hexdigest()
+            if entry is None or entry['sha1'] != digest:
+                parsed = parse_template(template)
+                if parsed is None:
+                    parsed = render_template_fields(template), get_const_in_template(template)
+                fields, constants = parsed
+                entry = {'sha1': digest, 'fields': fields, 'name': constants['name'],
+                         'description': constants['description']}
+            entry = dict(entry, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        new_cache['templates'][template] = entry
+        templates[template] = {id: dict(attributes) for id, attributes in entry['fields']}
+        templates[template]['name'] = entry['name']
+        templates[template]['description'] = entry['description']
+
+    if cache_path is not None and new_cache != cache:
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(cache_path), delete=False) as f:
+                json.dump(new_cache, f)
+            os.replace(f.name, cache_path)
+        except OSError:
+            pass  # The templates will be parsed again by the next process
+    return templates
+
+
 class TemplatesMeta(type):
     """ An utility class that constructs dynamically the Templates class. """
     def __init__(self, *args, **kwargs):
-        templates = {}
-        for template in os.listdir(os.path.join(get_root_path(), 'renderer/templates')):
-            if template != 'base.html':
-                templates[os.path.splitext(template)[0]] = {}
-
-        for template in templates:
-            def f(type):
-                def g(*args, **kwargs):
-                    id = type + '-' + str(kwargs['number'])
-                    templates[template][id] = {'max_chars': kwargs['max_chars']} if 'max_chars' in kwargs else {}
-                return g
-
-            dummy_renderer = SlideRenderer({'title': f('title'), 'subtitle': f('subtitle'),
-                            'img': f('image'),
-                            'logo': f('logo'), 'text': f('text'), 'background': f('background')}, None)
-
-            # Useful to set some attribute in the template
-            getattr(dummy_renderer.slide_renderer, template)(slide=None)
-
-            variables = get_const_in_template(template)
-            templates[template]['name'] = variables['name']
-            templates[template]['description'] = variables['description']
-
-        self._templates = templates
+        self._templates = load_templates(get_templates_cache_path())
         super().__init__(self)
 
     def __getitem__(self, item):
@@ -250,11 +429,42 @@ class Templates(object, metaclass=TemplatesMeta):
         """
         content = plugin_slide.get_content()
         template = plugin_slide.get_template()
-        non_complying_fields = []
-        for id in plugin_slide.get_content():
-            if id in cls[template] and 'text' in content[id] and len(remove_html_markup(content[id]['text'])) > cls[template][id]['max_chars']:
-                non_complying_fields.append((id, template, len(remove_html_markup(content[id]['text'])), cls[template][id]['max_chars'], content[id]['text']))
-        return non_complying_fields
+        texts = tuple((id, content[id]['text']) for id in content if id in cls[template] and 'text' in content[id])
+        return list(_get_non_complying_texts(template, texts))
+
+
+@lru_cache(maxsize=4096)
+def _get_non_complying_texts(template, texts):
+    """
+        Returns a tuple of the non complying fields of a slide of the given template whose text fields are the given
+        (id, text) tuples. The results are memoized as slides of a same channel are checked again on each request.
+    """
+    non_complying_fields = []
+    for id, text in texts:
+        text_length = len(remove_html_markup(text))
+        if text_length > Templates[template][id]['max_chars']:
+            non_complying_fields.append((id, template, text_length, Templates[template][id]['max_chars'], text))
+    return tuple(non_complying_fields)
+
+
+def compute_slide_defaults(themes):
+    """
+        Returns a theme name to read-only slide defaults mapping for the given themes, in which the defaults of each theme
+        are merged over the ones of its parents.
+    """
+    slide_defaults = {}
+
+    def resolve(theme):
+        if theme not in slide_defaults:
+            parent = themes[theme].get('parent')
+            defaults = deep_thaw(resolve(parent)) if parent else {}
+            deep_update(defaults, themes[theme].get('slide_defaults', {}))
+            slide_defaults[theme] = deep_freeze(defaults)
+        return slide_defaults[theme]
+
+    for theme in themes:
+        resolve(theme)
+    return slide_defaults
 
 
 class ThemesMeta(type):
@@ -319,6 +529,7 @@ class ThemesMeta(type):
         for theme in [t for t in self._themes.keys() if self._themes[t].get('parent') is None]:
             set_theme_level(theme)
 
+        self._slide_defaults = compute_slide_defaults(self._themes)
         super().__init__(self)
 
     def __getitem__(self, item):
@@ -377,13 +588,15 @@ class Themes(object, metaclass=ThemesMeta):
         """
             Returns the default values of slide elements based on the given theme and its parents
         """
-        parent = cls[theme].get('parent')
-        if parent:
-            defaults = cls.get_slide_defaults(parent)
-            deep_update(defaults, cls[theme].get('slide_defaults', {}))
-        else:
-            defaults = cls[theme].get('slide_defaults', {})
-        return deepcopy(defaults)
+        return deep_thaw(cls._slide_defaults[theme])
+
+    @classmethod
+    def get_frozen_slide_defaults(cls, theme):
+        """
+            Returns a read-only view of the default values of slide elements based on the given theme and its parents.
+            Unlike get_slide_defaults, it does not copy them.
+        """
+        return cls._slide_defaults[theme]
 
     @classmethod
     def get_sorted_themes(cls):
@@ -488,6 +701,8 @@ def get_no_content_capsule(app, theme, context):
                 {'get_slides': lambda: [get_no_content_slide()], 'get_theme': lambda: theme})
 
 
+_html_tags = re.compile(r'<.*?>')
+
+
 def remove_html_markup(text):
-    remove_tags = re.compile(r'<.*?>')
-    return unescape(remove_tags.sub('', text))
+    return unescape(_html_tags.sub('', text))
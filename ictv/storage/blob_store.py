@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import os
+import uuid
+
+logger = logging.getLogger('storage_manager')
+
+
+class BlobStore(object):
+    """
+        Stores the content of asset files once, keyed by its SHA-256, in a directory of blobs.
+        The asset files of the channels are hard links to these blobs, so that they are still served from their usual
+        path while sharing the same storage. The number of links of a blob counts the assets referencing it, a blob that
+        is not linked by any asset file anymore is removed by collect_garbage.
+    """
+    _chunk_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_blob_path(self, digest):
+        """ Returns the path of the blob with the given SHA-256 hex digest. """
+        return os.path.join(self.path, digest[:2], digest)
+
+    def deduplicate(self, file_path, digest=None):
+        """
+            Makes the given file a link to the blob of its content, creating the blob if needed. Returns the number of
+            bytes reclaimed, i.e. the size of the file if an identical blob already existed, 0 otherwise.
+        """
+        if digest is None:
+            digest = self.hash_file(file_path)
+        blob_path = self.get_blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        while True:
+            file_stat = os.stat(file_path)
+            try:
+                os.link(file_path, blob_path)
+                return 0
+            except FileExistsError:
+                pass
+            try:
+                blob_stat = os.stat(blob_path)
+                if os.path.samestat(file_stat, blob_stat):
+                    return 0
+                if blob_stat.st_size != file_stat.st_size:
+                    logger.warning('Blob %s does not match the size of %s, it will not be deduplicated',
+                                   blob_path, file_path)
+                    return 0
+                # Replace the file by a link to the blob atomically, so that the file is always available
+                link_path = os.path.join(os.path.dirname(file_path), '.link-' + uuid.uuid4().hex)
+                os.link(blob_path, link_path)
+            except FileNotFoundError:
+                continue  # The blob was garbage collected in the meantime
+            os.replace(link_path, file_path)
+            return file_stat.st_size if file_stat.st_nlink == 1 else 0
+
+    def deduplicate_directory(self, directory):
+        """
+            Deduplicates all the files found in the subdirectories of the given directory, except the blobs. Files that
+            are already linked are skipped. Returns the number of files deduplicated, the number of them that were
+            duplicates of another file and the number of bytes reclaimed.
+        """
+        files, duplicates, reclaimed = 0, 0, 0
+        for channel_entry in os.scandir(directory):
+            if not channel_entry.is_dir(follow_symlinks=False) or channel_entry.path == self.path:
+                continue
+            for entry in os.scandir(channel_entry.path):
+                if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.') \
+                        and entry.stat(follow_symlinks=False).st_nlink == 1:
+                    reclaimed += self.deduplicate(entry.path)
+                    files += 1
+                    # The file was replaced by a link to the blob of an identical file
+                    duplicates += not os.path.samestat(entry.stat(follow_symlinks=False), os.stat(entry.path))
+        return files, duplicates, reclaimed
+
+    def collect_garbage(self):
+        """ Removes the blobs that are not linked by any asset file anymore. Returns the number of bytes freed. """
+        freed = 0
+        if not os.path.isdir(self.path):
+            return freed
+        for prefix_entry in os.scandir(self.path):
+            if not prefix_entry.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(prefix_entry.path):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_nlink == 1:
+                    os.remove(entry.path)
+                    freed += stat.st_size
+        return freed
+
+    @classmethod
+    def hash_file(cls, file_path):
+        """ Returns the SHA-256 hex digest of the content of the given file. """
+        file_hash = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(cls._chunk_size), b''):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
@@ -24,12 +24,14 @@ import logging
 import time
 import os
 import sched
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 
 from urllib.error import URLError
 
-from sqlobject import AND, sqlhub, sqlbuilder
+from sqlobject import AND, sqlhub, sqlbuilder, SQLObjectNotFound
+from sqlobject.events import RowDestroyedSignal, listen
 
+from ictv.common import get_root_path
 from ictv.models.asset import Asset
 from ictv.common.utils import is_test
 from ictv.database import SQLObjectThreadConnection
@@ -39,6 +41,18 @@ logger = logging.getLogger('cache_manager')
 
 
 class CacheManager(StorageManager):
+    """
+        Caches files for a channel, either remote files downloaded by the DownloadManager or files generated by ICTV.
+        The cached assets of each channel are indexed by filename in memory, so that the cached version of a file is
+        found without querying the database. The index of a channel is loaded at once when first used and is kept
+        up to date when assets are cached or deleted. An asset whose file is missing is looked up again in the
+        database, as other processes may have deleted it during their cleanup. The index is also reset each day.
+    """
+
+    _index = {}  # A channel id to (filename to cached Asset mapping) mapping
+    _index_date = None
+    _index_lock = Lock()
+
     def __init__(self, channel_id, download_manager):
         super().__init__(channel_id)
         self.download_manager = download_manager
@@ -48,37 +62,91 @@ class CacheManager(StorageManager):
             Returns an Asset if this cache manager has a cached version of the given file for this channel
             or None if none exists.
         """
-        return Asset.selectBy(plugin_channel=self.channel_id, filename=filename, is_cached=True).getOne(None)
+        return self._get_indexed_asset(filename)
 
     def cache_file(self, content, filename):
         """ Caches the given file and return the corresponding Asset. """
         asset = self.store_file(content, filename)
         asset.is_cached = True
+        self._get_channel_index()[asset.filename] = asset
         return asset
 
     def cache_file_at_url(self, url):
         """ Caches the remote file or retrieves its cached version if one exists. Returns None if an error occurs. """
         filename, extension = os.path.splitext(url)
-        cache_asset_hash = hash(str(self.channel_id) + filename)
-        asset = Asset.selectBy(plugin_channel=self.channel_id, filename=filename, is_cached=True).getOne(None)
+        lock_name = (self.channel_id, filename)
+        asset = self._get_indexed_asset(filename)
         if asset is None:
-            if CacheManager._get_lock(cache_asset_hash, blocking=False):
+            if CacheManager._get_lock(lock_name, blocking=False):
                 try:
                     asset = Asset(plugin_channel=self.channel_id, filename=filename, user=None,
                                   extension=extension if extension is not None and len(extension) > 0 else None,
                                   is_cached=True)
+                    self._get_channel_index()[filename] = asset
                     self.download_manager.enqueue_asset(asset)
                 except (URLError, OSError):
                     logger.warning('Exception encountered when attempting to cache file at url %s', url, exc_info=True)
-                    CacheManager._release_lock(cache_asset_hash)
+                    CacheManager._release_lock(lock_name)
                     return None
-                CacheManager._release_lock(cache_asset_hash)
+                CacheManager._release_lock(lock_name)
             else:
-                CacheManager._get_lock(cache_asset_hash, blocking=True)
-                CacheManager._release_lock(cache_asset_hash)
-                asset = Asset.selectBy(plugin_channel=self.channel_id, filename=filename, is_cached=True).getOne(None)
+                CacheManager._get_lock(lock_name, blocking=True)
+                CacheManager._release_lock(lock_name)
+                asset = self._get_indexed_asset(filename)
+        elif asset.in_flight and not self.download_manager.has_pending_task_for_asset(asset.id):
+            # The download of the asset was interrupted or failed, try it again unless it failed recently
+            self.download_manager.enqueue_asset(asset)
+        return asset
+
+    def delete_all_assets(self):
+        super().delete_all_assets()
+        with CacheManager._index_lock:
+            CacheManager._index.pop(self.channel_id, None)
+
+    def _get_channel_index(self):
+        """ Returns the filename to cached Asset mapping of this channel, loading it if needed. """
+        today = datetime.date.today()
+        with CacheManager._index_lock:
+            if CacheManager._index_date != today:
+                CacheManager._index = {}
+                CacheManager._index_date = today
+            if self.channel_id not in CacheManager._index:
+                CacheManager._index[self.channel_id] = {
+                    asset.filename: asset for asset in Asset.selectBy(plugin_channel=self.channel_id, is_cached=True)
+                }
+            return CacheManager._index[self.channel_id]
+
+    def _get_indexed_asset(self, filename):
+        """
+            Returns the cached Asset of this channel for the given filename, or None if none exists.
+            The values of assets being downloaded are read again from the database until they are available, as well as
+            the values of assets whose file is missing, as they may have been deleted by another process.
+        """
+        index = self._get_channel_index()
+        asset = index.get(filename)
+        try:
+            if asset is not None and asset.in_flight:
+                asset = Asset.get(asset.id)
+                index[filename] = asset
+            elif asset is not None and not os.path.isfile(os.path.join(get_root_path(), asset.get_storage_path())):
+                asset.sync()
+        except SQLObjectNotFound:
+            index.pop(filename, None)
+            return None
         return asset
 
+    @classmethod
+    def remove_from_index(cls, channel_id, filename):
+        """ Removes the given file of the given channel from the index of cached assets. """
+        with cls._index_lock:
+            cls._index.get(channel_id, {}).pop(filename, None)
+
+    @classmethod
+    def clear_index(cls):
+        """ Clears the index of cached assets, so that it is loaded again from the database. """
+        with cls._index_lock:
+            cls._index = {}
+
     _name_to_lock = {}
     _master_lock = Lock()  # The lock of all locks
 
@@ -100,9 +168,48 @@ class CacheManager(StorageManager):
         cls._master_lock.release()
 
 
+def on_asset_deleted(instance, kwargs):
+    """ Removes the cached assets from the index of cached assets when they are deleted. """
+    if instance.is_cached:
+        CacheManager.remove_from_index(instance.plugin_channelID, instance.filename)
+
+listen(on_asset_deleted, Asset, RowDestroyedSignal)
+
+
 class CleanupScheduler(object):
-    def __init__(self):
+    """
+        Runs the maintenance of the cached assets in the background.
+        The cached assets are kept within a global quota of `max_bytes` bytes and a quota of `max_channel_bytes` bytes
+        per channel, 0 meaning no quota. When a quota is exceeded, the least recently referenced assets are evicted in
+        batches of `eviction_batch_size` assets until the cache fits it again. The quotas are checked every
+        `eviction_interval` seconds and each time request_eviction is called, e.g. when an asset was downloaded.
+        The tasks are run by a scheduler whose thread sleeps until the next task is due or a task is requested.
+    """
+    eviction_batch_size = 100
+
+    def __init__(self, flush_interval=60, max_megabytes=0, max_megabytes_per_channel=0, eviction_interval=300,
+                 storage_reconciler=None, reconciliation_interval=86400):
+        """
+            :param flush_interval: The delay in seconds between two writes of the references to assets
+            :param max_megabytes: The maximum size of all the cached assets, 0 for no limit
+            :param max_megabytes_per_channel: The maximum size of the cached assets of each channel, 0 for no limit
+            :param eviction_interval: The delay in seconds between two checks of the quotas
+            :param storage_reconciler: The StorageReconciler removing the orphaned files of the storage, if any
+            :param reconciliation_interval: The delay in seconds between two removals of the orphaned files
+        """
         self.conn = None
+        self.flush_interval = flush_interval
+        self.max_bytes = max_megabytes * 1024 * 1024
+        self.max_channel_bytes = max_megabytes_per_channel * 1024 * 1024
+        self.eviction_interval = eviction_interval
+        self.storage_reconciler = storage_reconciler
+        self.reconciliation_interval = reconciliation_interval
+        self.usage = 0  # The size of the cached assets at the last check of the quotas
+        self.channels_usage = {}  # A channel id to size of its cached assets mapping at the last check of the quotas
+        self.evicted_assets = 0
+        self.evicted_bytes = 0
+        self._eviction_requested = False
+        self._wakeup = Event()
         self.s = sched.scheduler(timefunc=time.time)
         self.running = True
         self.t = Thread(target=self._run_sched)
@@ -110,34 +217,139 @@ class CleanupScheduler(object):
     def __del__(self):
         self.stop()
 
+    def _wait(self, delay):
+        """ Sleeps for the given delay or until a task is scheduled. """
+        if self._wakeup.wait(delay):
+            self._wakeup.clear()
+
     def _run_sched(self):
         sqlhub.threadConnection = SQLObjectThreadConnection.get_conn()
         while self.running:
-            self.s.run(blocking=False)  # TODO: Is there a better way to run this ?
-            time.sleep(0.5)
+            self._wait(self.s.run(blocking=False))
+        self.flush_references()
+
+    def _enter(self, delay, priority, action):
+        event = self.s.enter(delay, priority, action)
+        self._wakeup.set()
+        return event
 
     def start(self):
         """ Starts the cleanup manager and run a first cleanup routine. """
         self.t.start()
-        self.s.enter(1, 1, self.cleanup_cache)
+        self._enter(1, 1, self.cleanup_cache)
+        self._enter(self.flush_interval, 2, self.flush_references_periodically)
+        if self.storage_reconciler is not None:
+            self._enter(60, 3, self.reconcile_storage)
 
     def stop(self):
         if self.running:
             self.running = False
-            self.t.join()
+            self._wakeup.set()
+            if self.t.is_alive():
+                self.t.join()
+
+    def request_eviction(self):
+        """ Checks the quotas of the cache as soon as possible. """
+        if self.running and (self.max_bytes or self.max_channel_bytes) and not self._eviction_requested:
+            self._eviction_requested = True
+            self._enter(0, 1, self.evict_assets)
+
+    def get_statistics(self):
+        """ Returns the usage of the cache and the counters of the evictions. """
+        return {'usage': self.usage, 'channels_usage': dict(self.channels_usage), 'max_bytes': self.max_bytes,
+                'max_channel_bytes': self.max_channel_bytes, 'evicted_assets': self.evicted_assets,
+                'evicted_bytes': self.evicted_bytes}
+
+    def flush_references(self):
+        """ Writes the references to assets recorded in memory to the database. """
+        try:
+            Asset.flush_references()
+        except Exception:
+            logger.warning('An exception was encountered when writing the references to assets', exc_info=True)
+
+    def flush_references_periodically(self):
+        self.flush_references()
+        self.s.enter(self.flush_interval, 2, self.flush_references_periodically)
 
     def cleanup_cache(self):
-        """ Cleans up the cached assets by deleting all assets not referenced during this day. """
-        today = datetime.date.today()
-        unused_assets = Asset.selectBy(is_cached=True).filter(Asset.q.last_reference < sqlbuilder.func.date(str(today)))
-        total_assets_size = 0
-        if unused_assets.count() > 0:
-            total_assets_size = int(unused_assets.sum(Asset.q.file_size))
-        Asset.deleteMany(AND(Asset.q.last_reference < sqlbuilder.func.date(str(today)), Asset.q.is_cached == True))
-        logger.info('Ran cache cleanup and deleted %d assets for a total size of %s', unused_assets.count(),
-                    CleanupScheduler._human_readable_size(total_assets_size))
-        next_cleanup = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time(hour=23, minute=55))
-        self.s.enterabs(time.mktime(next_cleanup.timetuple()), 1, self.cleanup_cache)
+        """ Evicts the assets exceeding the quotas of the cache and removes the unused blobs. """
+        self.evict_assets()
+        if StorageManager.blob_store is not None:
+            logger.info('Removed %s of unused blobs',
+                        CleanupScheduler._human_readable_size(StorageManager.blob_store.collect_garbage()))
+        self.s.enter(self.eviction_interval, 1, self.cleanup_cache)
+
+    def reconcile_storage(self):
+        """ Removes the files of the storage that do not belong to any asset. """
+        try:
+            orphans, size = self.storage_reconciler.reconcile()
+            logger.info('Removed %d orphaned files from the storage for a total size of %s', orphans,
+                        CleanupScheduler._human_readable_size(size))
+        except Exception:
+            logger.warning('An exception was encountered when removing the orphaned files', exc_info=True)
+        self.s.enter(self.reconciliation_interval, 3, self.reconcile_storage)
+
+    def evict_assets(self):
+        """
+            Evicts a batch of the least recently referenced cached assets from each channel exceeding its quota, then
+            from the whole cache if it exceeds the global quota. Schedules another batch if a quota is still exceeded.
+        """
+        self._eviction_requested = False
+        if not (self.max_bytes or self.max_channel_bytes):
+            return
+        self.flush_references()
+        self._update_usage()
+        evicted_assets, evicted_bytes = 0, 0
+        if self.max_channel_bytes:
+            for channel_id, usage in self.channels_usage.items():
+                if usage > self.max_channel_bytes:
+                    n, size = self._evict(usage - self.max_channel_bytes, Asset.q.plugin_channel == channel_id)
+                    evicted_assets, evicted_bytes = evicted_assets + n, evicted_bytes + size
+                    self.channels_usage[channel_id] -= size
+                    self.usage -= size
+        if self.max_bytes and self.usage > self.max_bytes:
+            n, size = self._evict(self.usage - self.max_bytes)
+            evicted_assets, evicted_bytes = evicted_assets + n, evicted_bytes + size
+            self.usage -= size
+        if evicted_assets:
+            self.evicted_assets += evicted_assets
+            self.evicted_bytes += evicted_bytes
+            logger.info('Evicted %d cached assets for a total size of %s, the cache now uses %s', evicted_assets,
+                        CleanupScheduler._human_readable_size(evicted_bytes),
+                        CleanupScheduler._human_readable_size(self.usage))
+            if self.running and (self.usage > self.max_bytes > 0 or
+                                 any(u > self.max_channel_bytes > 0 for u in self.channels_usage.values())):
+                self.request_eviction()  # Evict the next batch after letting the other tasks run
+
+    def _update_usage(self):
+        conn = Asset._connection
+        select = sqlbuilder.Select([Asset.q.plugin_channelID, sqlbuilder.func.SUM(Asset.q.file_size)],
+                                   where=AND(Asset.q.is_cached == True, Asset.q.in_flight == False),
+                                   groupBy=Asset.q.plugin_channelID)
+        self.channels_usage = {channel_id: int(usage or 0) for channel_id, usage in conn.queryAll(conn.sqlrepr(select))}
+        self.usage = sum(self.channels_usage.values())
+
+    def _evict(self, excess, where=None):
+        """
+            Deletes up to a batch of the least recently referenced cached assets matching the given clause, stopping
+            once their size reaches the given excess. Returns the number of assets deleted and their size.
+        """
+        clause = AND(Asset.q.is_cached == True, Asset.q.in_flight == False)
+        if where is not None:
+            clause = AND(clause, where)
+        evicted_assets, evicted_bytes = 0, 0
+        for asset in Asset.select(clause, orderBy=Asset.q.last_reference)[:self.eviction_batch_size]:
+            if evicted_bytes >= excess:
+                break
+            size = asset.file_size or 0
+            try:
+                asset.destroySelf()
+            except Exception:
+                logger.warning('An exception was encountered when evicting asset %d', asset.id, exc_info=True)
+                continue
+            evicted_assets += 1
+            evicted_bytes += size
+        return evicted_assets, evicted_bytes
 
     @staticmethod
     def _human_readable_size(byte_size):
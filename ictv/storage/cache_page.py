@@ -22,6 +22,7 @@
 from sqlobject import SQLObjectNotFound
 
 from ictv.models.asset import Asset
+from ictv.models.asset_download import AssetDownload
 from ictv.pages.utils import ICTVPage
 
 import ictv.flask.response as resp
@@ -31,9 +32,12 @@ class CachePage(ICTVPage):
         """ Waits for the given asset to be downloaded. Redirects the user to the asset when done. """
         try:
             asset_id = int(asset_id)
-            if self.download_manager.has_pending_task_for_asset(asset_id):
-                task = self.download_manager.get_pending_task_for_asset(asset_id)
-                task.result()
+            task = self.download_manager.get_pending_task_for_asset(asset_id)
+            if task is not None:
+                if task.exception() is not None:
+                    resp.notfound()
+            elif AssetDownload.selectBy(asset=asset_id, state='failed').count() > 0:
+                resp.notfound()  # The download failed recently, do not mark the asset as available
             resp.seeother('/' + Asset.get(asset_id)._get_path(force=True))  # Task is complete but asset may be still marked as in flight
         except SQLObjectNotFound:
             resp.notfound()
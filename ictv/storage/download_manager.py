@@ -20,54 +20,161 @@
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import functools
+import hashlib
+import logging
+import random
+import tempfile
+from datetime import datetime
 from queue import Queue
 
 import os
 import threading
+from urllib.parse import urlparse
 
 import aiohttp
 import magic
-from sqlobject import sqlhub
+from sqlobject import sqlhub, SQLObjectNotFound
+from sqlobject.dberrors import DuplicateEntryError
 
 from ictv.common import get_root_path
-from ictv.database import SQLObjectThreadConnection
+from ictv.database import SQLObjectThreadConnection, call_after_commit
+from ictv.models.asset import Asset
+from ictv.models.asset_download import AssetDownload
+from ictv.models.ictv_object import get_process_name
+from ictv.storage.storage_manager import StorageManager
+
+logger = logging.getLogger('download_manager')
+
+# The umask of the process, read once as it can only be read by changing it
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+class DownloadTooLarge(Exception):
+    """ Raised when a downloaded file exceeds the maximum size allowed. """
+    pass
 
 
 class DownloadManager(object):
-    def __init__(self):
+    """
+        Downloads assets from the network on an asyncio loop run by a dedicated thread.
+        All the downloads share a single HTTP session, so that connections to a same host are kept alive and reused.
+        At most `max_connections` downloads are run at the same time, and at most `max_connections_per_host` of them
+        target a same host, so that a burst of downloads from one host does not delay the downloads from other hosts.
+        Downloads failing with a network error, a timeout or a server error are retried up to `retries` times, after
+        an exponential backoff starting at `backoff` seconds.
+        Assets are streamed to a temporary file renamed to the asset file once complete, so that their content is never
+        held in memory and a partial download is never served. Downloads larger than `max_size` bytes are aborted.
+
+        Each download is persisted as an AssetDownload until it succeeds, so that the downloads interrupted by a restart
+        are resumed by resume_downloads. A download is owned by the process running it, so that the processes sharing
+        the database do not run the same download, and can only be resumed by another one once this process is over.
+        A failed download is not attempted again before `failure_delay` seconds,
+        doubled after each failure up to a day.
+    """
+
+    # The HTTP statuses indicating a transient failure worth retrying
+    _retried_statuses = {408, 429, 500, 502, 503, 504}
+    _chunk_size = 64 * 1024
+    _mime_sniffing_size = 8 * 1024  # The number of bytes at the beginning of a file from which its MIME type is guessed
+
+    def __init__(self, max_connections=32, max_connections_per_host=4, timeout=60, retries=3, backoff=1,
+                 max_size_megabytes=0, failure_delay=300):
+        """
+            :param max_connections: The maximum number of downloads run at the same time
+            :param max_connections_per_host: The maximum number of downloads from a same host run at the same time
+            :param timeout: The maximum duration in seconds of connecting to a host or of waiting for data from it
+            :param retries: The maximum number of times a failed download is attempted again
+            :param backoff: The delay in seconds before the first retry, doubled after each retry
+            :param max_size_megabytes: The maximum size of a downloaded asset, 0 for no limit
+            :param failure_delay: The delay in seconds before a failed download can be attempted again
+        """
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_size = max_size_megabytes * 1024 * 1024 or None
+        self.failure_delay = failure_delay
+        self.on_download_completed = None  # A function called after each asset successfully downloaded
+        self.queued = 0  # The number of downloads waiting for a connection
+        self.in_flight = 0  # The number of downloads being run
+        self.retried = 0  # The number of download attempts that were retried
+        self.failed = 0  # The number of downloads that failed after all their attempts
+        self._session = None
+        self._connection_slots = None
+        self._host_connection_slots = {}
         self._loop = asyncio.get_event_loop()
         self._thread = threading.Thread(target=self._run_loop)
         self._post_process_queue = Queue()
         self._post_processing_thread = threading.Thread(target=self._post_process_asset)
         self._thread.start()
         self._post_processing_thread.start()
-        self._pending_tasks = {}
+        self._pending_tasks = {}  # An asset id to download task mapping, the tasks are removed once post-processed
+        self._pending_tasks_lock = threading.Lock()
 
     def __del__(self):
         self.stop()
 
     def enqueue_asset(self, asset):
-        """ Enqueues the given asset to the download queue. Marks the asset as in flight when enqueued."""
-        if asset.id not in self._pending_tasks:
-            def enqueue_post_process_asset(task):
-                mime_type, file_size = task.result()
-                self._post_process_queue.put((mime_type, file_size, asset))
-
-            task = asyncio.run_coroutine_threadsafe(DownloadManager._cache_asset(asset.filename + (asset.extension or ''), asset.path), self._loop)
+        """
+            Enqueues the given asset to the download queue. Marks the asset as in flight when enqueued.
+            Returns whether the asset was enqueued, i.e. no process was downloading it and it did not recently fail.
+            The download starts once the transaction of the current thread is committed.
+        """
+        with self._pending_tasks_lock:
+            if asset.id in self._pending_tasks:
+                return False
+            url = asset.filename + (asset.extension or '')
+            download = AssetDownload.selectBy(asset=asset).getOne(None)
+            if download is None:
+                try:
+                    download = AssetDownload(asset=asset, url=url, owner=get_process_name())
+                except DuplicateEntryError:
+                    return False  # Another process enqueued the asset meanwhile
+            elif not download.can_be_attempted() or not download.claim():
+                return False
+            download.set(state='queued', last_update=datetime.now())
             asset.in_flight = True
-            task.add_done_callback(enqueue_post_process_asset)
-            self._pending_tasks[asset.id] = task
+        # The download must see the rows written by the current transaction
+        call_after_commit(functools.partial(self._start_download, asset.id, url, asset.get_storage_path()))
+        return True
+
+    def _start_download(self, asset_id, url, path):
+        with self._pending_tasks_lock:
+            if asset_id not in self._pending_tasks:
+                self._pending_tasks[asset_id] = asyncio.run_coroutine_threadsafe(
+                    self._download_asset(asset_id, url, path), self._loop)
+
+    def resume_downloads(self):
+        """ Enqueues the cached assets that are still in flight, e.g. because their download was interrupted. """
+        resumed = sum(self.enqueue_asset(asset) for asset in Asset.selectBy(is_cached=True, in_flight=True))
+        if resumed:
+            logger.info('Resumed the download of %d assets', resumed)
 
     def has_pending_task_for_asset(self, asset_id):
         """ Returns whether or not the download manager has a pending download task for the given asset. """
         return asset_id in self._pending_tasks
 
     def get_pending_task_for_asset(self, asset_id):
-        """ Returns the corresponding task to the given asset. """
-        return self._pending_tasks[asset_id]
+        """ Returns the corresponding task to the given asset, or None if there is no pending task for this asset. """
+        return self._pending_tasks.get(asset_id)
+
+    def get_statistics(self):
+        """ Returns the counters of the downloads of this manager. """
+        return {'queued': self.queued, 'in_flight': self.in_flight, 'retried': self.retried, 'failed': self.failed}
 
     def stop(self):
+        if self._post_processing_thread.is_alive():
+            self._post_process_queue.put(None)
+            self._post_processing_thread.join()
         if self._loop.is_running():
+            if self._session is not None:
+                try:
+                    asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result(timeout=5)
+                except Exception:
+                    logger.warning('An exception was encountered when closing the HTTP session', exc_info=True)
             self._loop.call_soon_threadsafe(self._loop.stop)
             self._thread.join()
 
@@ -81,20 +188,142 @@ class DownloadManager(object):
     def _post_process_asset(self):
         sqlhub.threadConnection = SQLObjectThreadConnection.get_conn()
         while True:
-            mime_type, file_size, asset = self._post_process_queue.get()
-            asset.in_flight = False
-            asset.mime_type = mime_type
-            asset.file_size = file_size
-
-    @staticmethod
-    async def _cache_asset(url, path):
-        content = await DownloadManager._get_content(url)
-        with open(os.path.join(get_root_path(), path), 'wb') as f:
-            f.write(content)
-        return magic.from_buffer(content, mime=True), len(content)
-
-    @staticmethod
-    async def _get_content(url):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                return await resp.read()
+            item = self._post_process_queue.get()
+            if item is None:
+                break
+            asset_id, state, result = item
+            try:
+                download = AssetDownload.selectBy(asset=asset_id).getOne(None)
+                if state == 'running':
+                    if download is not None:
+                        download.set(state='running', last_update=datetime.now())
+                elif state == 'done':
+                    mime_type, file_size, _ = result
+                    Asset.get(asset_id).set(in_flight=False, mime_type=mime_type, file_size=file_size)
+                    if download is not None:
+                        download.destroySelf()
+                    if self.on_download_completed is not None:
+                        self.on_download_completed()
+                elif download is not None:
+                    download.set_failed(result, self.failure_delay, 24 * 60 * 60)
+            except SQLObjectNotFound:
+                pass  # The asset was deleted in the meantime
+            except Exception:
+                logger.warning('An exception was encountered when post-processing the download of asset %d', asset_id,
+                               exc_info=True)
+            finally:
+                if state != 'running':
+                    with self._pending_tasks_lock:
+                        self._pending_tasks.pop(asset_id, None)
+                self._post_process_queue.task_done()
+
+    async def _download_asset(self, asset_id, url, path):
+        """ Downloads the given asset and reports the progress and the outcome of the download to be post-processed. """
+        try:
+            result = await self._cache_asset(url, path, on_start=lambda: self._post_process_queue.put(
+                (asset_id, 'running', None)))
+        except Exception as e:
+            logger.warning('Failed to download %s for asset %d: %s', url, asset_id, e)
+            self._post_process_queue.put((asset_id, 'failed', str(e) or type(e).__name__))
+            raise
+        self._post_process_queue.put((asset_id, 'done', result))
+        return result
+
+    async def _cache_asset(self, url, path, on_start=None):
+        """ Downloads the file at the given url to the given path. Returns its MIME type, its size and its SHA-256. """
+        return await self._fetch(url, lambda resp: self._write_response(resp, os.path.join(get_root_path(), path)),
+                                 on_start)
+
+    async def _write_response(self, resp, path):
+        if self.max_size is not None and resp.content_length is not None and resp.content_length > self.max_size:
+            raise DownloadTooLarge('%s is %d bytes long' % (resp.url, resp.content_length))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_size = 0
+        file_hash = hashlib.sha256()
+        head = b''
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.download-', delete=False) as f:
+            try:
+                async for chunk in resp.content.iter_chunked(self._chunk_size):
+                    file_size += len(chunk)
+                    if self.max_size is not None and file_size > self.max_size:
+                        raise DownloadTooLarge('%s is longer than %d bytes' % (resp.url, self.max_size))
+                    if len(head) < self._mime_sniffing_size:
+                        head += chunk[:self._mime_sniffing_size - len(head)]
+                    file_hash.update(chunk)
+                    await self._loop.run_in_executor(None, f.write, chunk)
+                os.chmod(f.name, 0o666 & ~_umask)  # The temporary file is only readable by its owner
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+        StorageManager.deduplicate(path, file_hash.hexdigest())
+        return magic.from_buffer(head, mime=True), file_size, file_hash.hexdigest()
+
+    def _get_session(self):
+        """ Returns the HTTP session of this manager. Must be called from its loop. """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._connection_slots = asyncio.Semaphore(self.max_connections)
+        return self._session
+
+    def _get_host_connection_slots(self, url):
+        host = urlparse(url).netloc
+        if host not in self._host_connection_slots:
+            self._host_connection_slots[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self._host_connection_slots[host]
+
+    async def _get_content(self, url):
+        """ Returns the content of the file at the given url. """
+        return await self._fetch(url, lambda resp: resp.read())
+
+    async def _fetch(self, url, handle_response, on_start=None):
+        """
+            Requests the given url and returns the result of the given coroutine function called with the response.
+            The given on_start function is called when the request is about to be sent.
+        """
+        session = self._get_session()
+        self.queued += 1
+        started = False
+        try:
+            # The slot of the host is acquired first, so that the downloads waiting for a busy host do not hold the
+            # slots that the downloads from other hosts could use
+            async with self._get_host_connection_slots(url):
+                async with self._connection_slots:
+                    self.queued -= 1
+                    started = True
+                    self.in_flight += 1
+                    if on_start is not None:
+                        on_start()
+                    try:
+                        return await self._fetch_with_retries(session, url, handle_response)
+                    finally:
+                        self.in_flight -= 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            if not started:
+                self.queued -= 1
+
+    async def _fetch_with_retries(self, session, url, handle_response):
+        attempt = 0
+        while True:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status in self._retried_statuses:
+                        raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status,
+                                                          message=resp.reason, headers=resp.headers)
+                    return await handle_response(resp)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.debug('Retrying the download of %s in %.1f seconds after: %s', url, delay, e)
+                attempt += 1
+                self.retried += 1
+                await asyncio.sleep(delay)
@@ -19,6 +19,7 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
 import os
 import magic
@@ -33,6 +34,7 @@ logger = logging.getLogger('storage_manager')
 
 class StorageManager(object):
     _storage_path = os.path.join(get_root_path(), 'static', 'storage')
+    blob_store = None  # The BlobStore deduplicating the content of asset files, if enabled
 
     def __init__(self, channel_id):
         super(StorageManager, self).__init__()
@@ -71,8 +73,18 @@ class StorageManager(object):
         asset = self.create_asset(filename, user, magic.from_buffer(content, mime=True))
         asset.file_size = len(content)
         asset.write_to_asset_file(content)
+        StorageManager.deduplicate(os.path.join(get_root_path(), asset.path), hashlib.sha256(content).hexdigest())
         return asset
 
+    @staticmethod
+    def deduplicate(file_path, digest):
+        """ Shares the given asset file with the identical files of other assets if deduplication is enabled. """
+        if StorageManager.blob_store is not None:
+            try:
+                StorageManager.blob_store.deduplicate(file_path, digest)
+            except OSError:
+                logger.warning('Could not deduplicate file %s', file_path, exc_info=True)
+
     def delete_all_assets(self):
         """ Deletes all assets of this channel and corresponding files on the filesystem. """
         Asset.deleteBy(plugin_channel=self.channel_id)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import time
+from datetime import datetime
+
+from sqlobject import sqlbuilder
+
+from ictv.models.asset import Asset
+
+logger = logging.getLogger('storage_manager')
+
+
+class StorageReconciler(object):
+    """
+        Finds the files of the storage directory that do not belong to any asset anymore, e.g. because their asset was
+        deleted along with its channel, and deletes them or moves them to a quarantine directory.
+        Each channel directory is listed and compared to the assets of the channel, fetched in a single query. Files
+        modified less than `min_age` seconds ago are ignored, as they may be being written for a new asset.
+    """
+    blobs_directory = 'blobs'
+    quarantine_directory = '.quarantine'
+
+    def __init__(self, storage_path, quarantine=False, min_age=3600, report_every=500):
+        """
+            :param storage_path: The path to the storage directory
+            :param quarantine: Whether the orphaned files are moved to the quarantine directory rather than deleted
+            :param min_age: The minimum delay in seconds since the last modification of an orphaned file
+            :param report_every: The number of orphaned files removed between two reports of the progress
+        """
+        self.storage_path = storage_path
+        self.quarantine = quarantine
+        self.min_age = min_age
+        self.report_every = report_every
+
+    def find_orphans(self):
+        """ Yields the (channel directory name, DirEntry) pairs of the orphaned files of the storage directory. """
+        if not os.path.isdir(self.storage_path):
+            return
+        max_mtime = time.time() - self.min_age
+        for channel_entry in os.scandir(self.storage_path):
+            if not channel_entry.is_dir(follow_symlinks=False) or not channel_entry.name.isdigit():
+                continue  # Skips the blobs and the quarantine directories
+            files = {entry.name: entry for entry in os.scandir(channel_entry.path)
+                     if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < max_mtime}
+            for name in files.keys() - self._get_asset_filenames(int(channel_entry.name)):
+                yield channel_entry.name, files[name]
+
+    @staticmethod
+    def _get_asset_filenames(channel_id):
+        conn = Asset._connection
+        select = sqlbuilder.Select([Asset.q.id, Asset.q.extension], where=Asset.q.plugin_channelID == channel_id)
+        return {str(asset_id) + (extension or '') for asset_id, extension in conn.queryAll(conn.sqlrepr(select))}
+
+    def reconcile(self, dry_run=False):
+        """
+            Deletes or quarantines the orphaned files of the storage directory, or only reports them if dry_run is set.
+            Returns the number of orphaned files found and their size in bytes.
+        """
+        orphans, reclaimed = 0, 0
+        quarantine_path = os.path.join(self.storage_path, self.quarantine_directory, datetime.now().strftime('%Y%m%d'))
+        for channel_name, entry in self.find_orphans():
+            size = entry.stat(follow_symlinks=False).st_size
+            if not dry_run:
+                try:
+                    if self.quarantine:
+                        os.makedirs(os.path.join(quarantine_path, channel_name), exist_ok=True)
+                        os.replace(entry.path, os.path.join(quarantine_path, channel_name, entry.name))
+                    else:
+                        os.remove(entry.path)
+                except OSError:
+                    logger.warning('Could not remove orphaned file %s', entry.path, exc_info=True)
+                    continue
+            orphans += 1
+            reclaimed += size
+            if orphans % self.report_every == 0:
+                logger.info('%s %d orphaned files so far', 'Found' if dry_run else 'Removed', orphans)
+        return orphans, reclaimed
@@ -19,95 +19,311 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
+import importlib
+import itertools
+import json
 import os
-import re
-import shlex
+import tempfile
 import threading
-from queue import Queue, Empty
-from subprocess import Popen, PIPE
+from queue import PriorityQueue, Empty
+from subprocess import Popen, PIPE, DEVNULL
 
 import logging
 from pymediainfo import MediaInfo
-from sqlobject import sqlhub
+from sqlobject import sqlhub, SQLObjectNotFound
 
-from ictv.database import SQLObjectThreadConnection
+from ictv.database import SQLObjectThreadConnection, call_after_commit
+from ictv.models.ictv_object import get_process_name
+from ictv.models.transcoding_job import TranscodingJob
 
 logger = logging.getLogger('transcoding_queue')
 
 
 class TranscodingQueue:
-    def __init__(self):
+    """
+        Transcodes videos to WebM using FFmpeg, running up to `workers` jobs at the same time. The `threads` FFmpeg
+        threads allowed in total are shared by the running jobs: a job is given an even share of them between the jobs
+        running when it starts, within the threads left unused by the others, and at least one.
+        Jobs are started by increasing priority, e.g. the videos uploaded by users before the batch re-encodes, then by
+        increasing duration of their video, so that short clips are not delayed by long videos.
+        The jobs are persisted as TranscodingJob until they are done, so that the jobs interrupted by a restart are
+        resumed by resume_tasks. Their callback is persisted as well when it is a module-level function or a
+        functools.partial of one with JSON-serializable arguments. A job is owned by the process transcoding it, so
+        that it is only resumed by one of the processes sharing the database, once this process is over.
+    """
+    INTERACTIVE = 0
+    BATCH = 10
+
+    def __init__(self, workers=2, threads=0):
+        """
+            :param workers: The maximum number of videos transcoded at the same time
+            :param threads: The number of FFmpeg threads shared by the jobs, 0 for the number of CPUs minus one
+        """
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 2) - 1)
         self._running = True
-        self._thread = threading.Thread(target=self._run_loop)
-        self._task_queue = Queue()
+        self._task_queue = PriorityQueue()
+        self._counter = itertools.count()  # Orders the jobs of same priority and duration by insertion
         self._pending_tasks = {}  # A map of path to progress in pc
-        self._thread.start()
+        self._jobs = {}  # An output file to job mapping of the jobs queued or running
+        self._lock = threading.Lock()
+        self._running_jobs = 0
+        self._used_threads = 0  # The number of FFmpeg threads given to the running jobs
+        self._threads = [threading.Thread(target=self._run_loop) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
 
     def __del__(self):
         self.stop()
 
     def stop(self):
+        """ Stops the workers, interrupting the running jobs. They will be resumed by resume_tasks after a restart. """
         self._running = False
-        self._thread.join()
+        with self._lock:
+            for job in self._jobs.values():
+                job.interrupt()
+        for thread in self._threads:
+            thread.join()
 
-    def enqueue_task(self, input_file, output_file, callback):
-        logger.info('[Job %s -> %s] Added to queue', input_file, output_file)
-        self._task_queue.put((input_file, output_file, callback))
-        self._pending_tasks[output_file] = 0
+    def enqueue_task(self, input_file, output_file, callback, priority=INTERACTIVE, duration=None):
+        """
+            Enqueues the transcoding of the input file to the output file. The callback is called with whether the
+            transcoding succeeded once it is done. The job is queued once the transaction of the current thread is
+            committed.
+            :param priority: The priority of the job, INTERACTIVE or BATCH
+            :param duration: The duration of the video in milliseconds, read from the file if not given
+        """
+        if duration is None:
+            duration = get_duration(input_file)
+        job = TranscodingJob(input_file=input_file, output_file=output_file, priority=priority, duration=duration,
+                             callback=_serialize_callback(callback), owner=get_process_name())
+        # The workers must see the rows written by the current transaction
+        call_after_commit(functools.partial(self._enqueue, job.id, input_file, output_file, callback, priority,
+                                            duration))
+
+    def resume_tasks(self):
+        """
+            Enqueues again the jobs that were interrupted by a restart and that neither this queue nor another process
+            is running. The jobs whose callback cannot be restored are marked as failed instead, as their outcome could
+            not be reported.
+        """
+        with self._lock:
+            queued = {job.id for job in self._jobs.values()}
+        resumed = 0
+        for job in list(TranscodingJob.select(TranscodingJob.q.error == None)):
+            if job.id in queued or not job.claim():
+                continue
+            callback = _deserialize_callback(job.callback)
+            if callback is None:
+                logger.error('[Job %s -> %s] The callback of this job could not be restored, it is marked as failed',
+                             job.input_file, job.output_file)
+                job.set(error='The callback could not be restored', owner=None)
+                continue
+            job.state = 'queued'
+            self._enqueue(job.id, job.input_file, job.output_file, callback, job.priority, job.duration)
+            resumed += 1
+        if resumed:
+            logger.info('Resumed %d transcoding jobs', resumed)
+
+    def cancel_task(self, output_file):
+        """ Cancels the transcoding to the given output file. Returns whether a job was found. """
+        with self._lock:
+            job = self._jobs.get(output_file)
+            if job is None:
+                return False
+            job.cancel()
+        logger.info('[Job %s -> %s] Cancelled', job.input_file, output_file)
+        return True
 
     def get_progress(self, path):
         return self._pending_tasks.get(path)
 
+    def _enqueue(self, job_id, input_file, output_file, callback, priority, duration):
+        job = _Job(job_id, input_file, output_file, callback, duration)
+        with self._lock:
+            self._jobs[output_file] = job
+        self._pending_tasks[output_file] = 0
+        logger.info('[Job %s -> %s] Added to queue', input_file, output_file)
+        self._task_queue.put((priority, duration if duration is not None else float('inf'), next(self._counter), job))
+
     def _run_loop(self):
         sqlhub.threadConnection = SQLObjectThreadConnection.get_conn()
         while self._running:
             try:
-                input_file, output_file, callback = self._task_queue.get(timeout=0.5)
+                _, _, _, job = self._task_queue.get(timeout=0.5)
+            except Empty:
+                continue
+            if job.cancelled:
+                self._finish(job, False)
+                continue
+            if not self._running:
+                break  # The job stays persisted and will be resumed
 
-                def update_progress(progress):
-                    self._pending_tasks[output_file] = progress
+            def update_progress(progress):
+                self._pending_tasks[job.output_file] = progress
 
+            try:
+                TranscodingJob.get(job.id).state = 'running'
+                threads = self._acquire_threads()
                 try:
-                    logger.info('[Job %s -> %s] Started transcoding', input_file, output_file)
-                    transcode_to_webm(input_file, output_file, update_progress)
-                    callback(True)
-                except:
-                    logger.warning('[Job %s -> %s] Exception occured', input_file, output_file, exc_info=True)
-                    callback(False)
-            except Empty:
-                continue
+                    logger.info('[Job %s -> %s] Started transcoding using %d threads', job.input_file,
+                                job.output_file, threads)
+                    transcode_to_webm(job.input_file, job.output_file, update_progress, threads=threads,
+                                      process_callback=job.set_process, duration=job.duration)
+                finally:
+                    self._release_threads(threads)
+                self._finish(job, True)
+            except:
+                if not self._running and not job.cancelled:
+                    logger.info('[Job %s -> %s] Interrupted', job.input_file, job.output_file)
+                    continue
+                logger.warning('[Job %s -> %s] Exception occured', job.input_file, job.output_file, exc_info=True)
+                self._finish(job, False)
+
+    def _acquire_threads(self):
+        """ Returns the number of FFmpeg threads given to a job starting now and records them as used. """
+        with self._lock:
+            self._running_jobs += 1
+            threads = max(1, min(self.threads // self._running_jobs, self.threads - self._used_threads))
+            self._used_threads += threads
+            return threads
+
+    def _release_threads(self, threads):
+        """ Gives back the given number of FFmpeg threads used by a job that is over. """
+        with self._lock:
+            self._running_jobs -= 1
+            self._used_threads -= threads
 
+    def _finish(self, job, success):
+        with self._lock:
+            self._jobs.pop(job.output_file, None)
+        if job.cancelled:
+            self._pending_tasks.pop(job.output_file, None)
+        try:
+            TranscodingJob.get(job.id).destroySelf()
+        except SQLObjectNotFound:
+            pass
+        try:
+            job.callback(success)
+        except:
+            logger.warning('[Job %s -> %s] Exception occured in callback', job.input_file, job.output_file,
+                           exc_info=True)
 
-def transcode_to_webm(input_file, output_file, progress_callback):
-    video_info = MediaInfo.parse(input_file)
-    frame_count = int(video_info.tracks[0].frame_count)
 
-    threads = (os.cpu_count() or 2) - 1
+class _Job(object):
+    def __init__(self, id, input_file, output_file, callback, duration):
+        self.id = id
+        self.input_file = input_file
+        self.output_file = output_file
+        self.callback = callback
+        self.duration = duration
+        self.cancelled = False
+        self._process = None
+
+    def set_process(self, process):
+        self._process = process
+        if self.cancelled:
+            process.terminate()
+
+    def cancel(self):
+        self.cancelled = True
+        self.interrupt()
+
+    def interrupt(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+
+
+def _serialize_callback(callback):
+    """ Returns a JSON-serializable description of the given callback, or None if it cannot be restored later. """
+    args, kwargs = (), {}
+    if isinstance(callback, functools.partial):
+        callback, args, kwargs = callback.func, callback.args, callback.keywords
+    module, name = getattr(callback, '__module__', None), getattr(callback, '__qualname__', '')
+    if module is None or '<' in name or '.' in name:
+        return None  # Lambdas, closures and methods cannot be restored
+    description = {'module': module, 'name': name, 'args': list(args), 'kwargs': dict(kwargs)}
+    try:
+        json.dumps(description)
+    except TypeError:
+        return None
+    return description
+
+
+def _deserialize_callback(description):
+    if description is None:
+        return None
+    try:
+        function = getattr(importlib.import_module(description['module']), description['name'])
+    except (ImportError, AttributeError):
+        return None
+    return functools.partial(function, *description['args'], **description['kwargs'])
+
+
+def get_duration(input_file):
+    """ Returns the duration in milliseconds of the given video, or None if it cannot be found. """
+    try:
+        for track in MediaInfo.parse(input_file).tracks:
+            if track.duration is not None:
+                return int(float(track.duration))
+    except Exception:
+        logger.debug('Could not read the duration of %s', input_file, exc_info=True)
+    return None
+
+
+def transcode_to_webm(input_file, output_file, progress_callback, threads=None, process_callback=None, duration=None):
+    """
+        Transcodes the input file to WebM using FFmpeg. The progress of the transcoding, from 0 to 1, is reported to
+        progress_callback based on the time of the video transcoded so far.
+        :param threads: The number of threads FFmpeg may use, the number of CPUs minus one if not given
+        :param process_callback: A function called with the FFmpeg process once it is started
+        :param duration: The duration of the video in milliseconds, read from the file if not given
+    """
+    if duration is None:
+        duration = get_duration(input_file)
+
+    threads = threads or (os.cpu_count() or 2) - 1
     video_crf = 31
     audio_rate = '192k'
-    ffmpeg_args = ['ffmpeg', '-hide_banner', '-loglevel', 'warning', '-stats',
-                   '-i', shlex.quote(input_file), '-c:v', 'libvpx-vp9', '-crf', str(video_crf), '-b:v', '0', '-b:a',
-                   audio_rate, '-threads', str(threads), shlex.quote(output_file)]
-    ffmpeg_job = Popen(' '.join(ffmpeg_args), shell=True, stdout=PIPE, stderr=PIPE, bufsize=0, universal_newlines=False)
-
-    line = []
-    frame_regex = re.compile(r'frame=\s*(\d+)\s*fps')
-    while ffmpeg_job.poll() is None:
-        c = ffmpeg_job.stderr.read(1)
-        if c == b'\r' or c == b'\n':
-            line = ''.join(line)
-            try:
-                current_frame = int(frame_regex.match(line).group(1))
-                progress_callback(current_frame / frame_count)
-            except:
-                logger.warning('[Job %s -> %s] stderr: %s', input_file, output_file, line)
-            line = []
-        else:
-            line.append(c.decode())
+    ffmpeg_args = ['ffmpeg', '-hide_banner', '-loglevel', 'warning', '-nostats', '-progress', 'pipe:1', '-y',
+                   '-i', input_file, '-c:v', 'libvpx-vp9', '-crf', str(video_crf), '-b:v', '0', '-b:a', audio_rate,
+                   '-threads', str(threads), output_file]
+    with tempfile.TemporaryFile() as stderr:
+        ffmpeg_job = Popen(ffmpeg_args, stdin=DEVNULL, stdout=PIPE, stderr=stderr)
+        if process_callback is not None:
+            process_callback(ffmpeg_job)
+        with ffmpeg_job.stdout:
+            read_progress(ffmpeg_job.stdout, duration, progress_callback)
+        ffmpeg_job.wait()
 
-    if ffmpeg_job.returncode is not 0:
-        logger.warning('[Job %s -> %s] stdout: %s', input_file, output_file,''.join(c.decode() for c in ffmpeg_job.stdout.readlines()))
-        logger.warning('[Job %s -> %s] stderr: %s', input_file, output_file, ''.join(c.decode() for c in ffmpeg_job.stderr.readlines()))
-        raise IOError('Transcoding failed with return code %d' % ffmpeg_job.returncode)
+        if ffmpeg_job.returncode != 0:
+            stderr.seek(0)
+            logger.warning('[Job %s -> %s] stderr: %s', input_file, output_file,
+                           stderr.read().decode(errors='replace'))
+            raise IOError('Transcoding failed with return code %d' % ffmpeg_job.returncode)
 
     logger.info('[Job %s -> %s] Transcoding completed', input_file, output_file)
+
+
+def read_progress(stream, duration, progress_callback):
+    """
+        Reads the key=value lines written by the -progress option of FFmpeg from the given binary stream and reports
+        the time transcoded so far over the given duration in milliseconds to progress_callback. Without a duration,
+        the progress is only reported once the transcoding ends.
+    """
+    last_progress = None
+    for line in stream:
+        key, _, value = line.partition(b'=')
+        if key == b'out_time_us' and duration:
+            try:
+                progress = min(max(int(value) / (duration * 1000), 0), 1)
+            except ValueError:
+                continue  # FFmpeg writes N/A before the first frame
+        elif key == b'progress' and value.strip() == b'end':
+            progress = 1
+        else:
+            continue
+        if progress != last_progress:
+            progress_callback(progress)
+            last_progress = progress
@@ -21,6 +21,9 @@
 
 import os
 import shutil
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
 
 import paste
 import unittest
@@ -77,6 +80,8 @@ class ICTVTestCase(unittest.TestCase):
             f()
 
     def setUp(self, middleware=lambda: None):
+        # Start from an empty database, even if a previous test failed before removing its own
+        open(database_path.replace('sqlite://', ''), 'w').close()
         setup_database()
         create_database()
         load_plugins()
@@ -189,3 +194,29 @@ class FakePluginTestCase(ICTVTestCase):
     def tearDown(self):
         shutil.rmtree(self.fake_plugin_root)
         super(FakePluginTestCase, self).tearDown()
+
+
+class BackgroundHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+        An HTTP server listening on a free local port and handling each request in a thread while it is used as a
+        context manager, as http.server.ThreadingHTTPServer only exists since Python 3.7.
+    """
+    daemon_threads = True
+
+    def __init__(self, handler_class):
+        super(BackgroundHTTPServer, self).__init__(('127.0.0.1', 0), handler_class)
+        self.url = 'http://127.0.0.1:%d' % self.server_port
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class QuietHTTPRequestHandler(BaseHTTPRequestHandler):
+    """ A request handler that does not log the requests it handles. """
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Micro-benchmarks of the hot paths of ICTV Core.
+    Run them using `python -m ictv.tests.benchmarks`.
+"""
+
+import re
+import timeit
+import tracemalloc
+from copy import deepcopy
+from html import unescape
+
+from ictv.plugin_manager.plugin_capsule import PluginCapsule
+from ictv.plugin_manager.plugin_manager import PluginManager
+from ictv.plugin_manager.plugin_slide import PluginSlide
+from ictv.common.utils import deep_update, deep_overlay
+from ictv.renderer.renderer import Templates, compute_slide_defaults
+
+
+class BenchmarkSlide(PluginSlide):
+    def __init__(self, content, template):
+        self._content = content
+        self._template = template
+
+    def get_duration(self):
+        return 5000
+
+    def get_content(self):
+        return self._content
+
+    def get_template(self):
+        return self._template
+
+
+class BenchmarkCapsule(PluginCapsule):
+    def __init__(self, slides):
+        self._slides = slides
+
+    def get_slides(self):
+        return self._slides
+
+    def get_theme(self):
+        return None
+
+
+def make_channel_content(slides=1000, slides_per_capsule=10):
+    """ Returns the content of a synthetic channel made of the given number of slides, a tenth of them not complying. """
+    capsules = []
+    for i in range(0, slides, slides_per_capsule):
+        capsule_slides = []
+        for j in range(i, min(i + slides_per_capsule, slides)):
+            title = '<b>Slide&nbsp;%d</b>' % j if j % 10 else 'A title that is way too long for slide %d' % j
+            content = {'title-1': {'text': title},
+                       'text-1': {'text': '<p>%s</p>' % ' '.join('Lorem ipsum &amp; dolor %d' % k for k in range(20))},
+                       'background-1': {'src': 'http://localhost/%d.png' % j, 'size': 'contain'}}
+            capsule_slides.append(BenchmarkSlide(content, 'template-background-text-center'))
+        capsules.append(BenchmarkCapsule(capsule_slides))
+    return capsules
+
+
+def _reference_non_complying_fields(plugin_slide):
+    """ The check of template limits as it was implemented before being memoized. """
+    def remove_html_markup(text):
+        remove_tags = re.compile(r'<.*?>')
+        return unescape(remove_tags.sub('', text))
+    content = plugin_slide.get_content()
+    template = plugin_slide.get_template()
+    non_complying_fields = []
+    for id in plugin_slide.get_content():
+        if id in Templates[template] and 'text' in content[id] and len(remove_html_markup(content[id]['text'])) > Templates[template][id]['max_chars']:
+            non_complying_fields.append((id, template, len(remove_html_markup(content[id]['text'])), Templates[template][id]['max_chars'], content[id]['text']))
+    return non_complying_fields
+
+
+def benchmark_filter_non_complying_content(slides=1000, number=20):
+    """ Measures PluginManager.filter_non_complying_content over a synthetic channel. """
+    capsules = make_channel_content(slides)
+    all_slides = [slide for capsule in capsules for slide in capsule.get_slides()]
+    assert all(Templates.get_non_complying_fields(s) == _reference_non_complying_fields(s) for s in all_slides)
+
+    reference = timeit.timeit(lambda: [_reference_non_complying_fields(s) for s in all_slides], number=number) / number
+    memoized = timeit.timeit(lambda: PluginManager.filter_non_complying_content(capsules), number=number) / number
+    print('filter_non_complying_content over %d slides: %.2f ms (%.2f ms without memoization)'
+          % (slides, memoized * 1000, reference * 1000))
+
+
+def make_theme_hierarchy(depth=10, elements=20):
+    """ Returns a chain of themes of the given depth, each one overriding a few of the slide defaults of its parent. """
+    themes = {}
+    for i in range(depth):
+        slide_defaults = {'element-%d' % e: {'color': '#%06x' % (i * e), 'font': {'family': 'Theme %d' % i, 'size': e}}
+                          for e in range(elements) if e % depth >= i}
+        themes['theme-%d' % i] = {'parent': 'theme-%d' % (i - 1) if i else None, 'slide_defaults': slide_defaults}
+    return themes
+
+
+def _reference_slide_defaults(themes, theme):
+    """ The resolution of theme defaults as it was implemented before being computed once per theme. """
+    parent = themes[theme].get('parent')
+    if parent:
+        defaults = _reference_slide_defaults(themes, parent)
+        deep_update(defaults, themes[theme].get('slide_defaults', {}))
+    else:
+        defaults = themes[theme].get('slide_defaults', {})
+    return deepcopy(defaults)
+
+
+def benchmark_slide_defaults(depth=10, slides=1000):
+    """ Measures the memory allocated when merging the content of slides over the defaults of a deep theme. """
+    themes = make_theme_hierarchy(depth)
+    theme = 'theme-%d' % (depth - 1)
+    frozen_defaults = compute_slide_defaults(themes)[theme]
+    contents = [{'element-%d' % (i % 5): {'text': 'Slide %d' % i}} for i in range(slides)]
+    assert all(deep_overlay(frozen_defaults, c) == deep_update(_reference_slide_defaults(themes, theme), c)
+               for c in contents)
+
+    def measure(merge):
+        tracemalloc.start()
+        merged = [merge(c) for c in contents]
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del merged
+        return allocated
+
+    def reference_merge(content):
+        return deep_update(_reference_slide_defaults(themes, theme), content)
+
+    def overlay_merge(content):
+        return deep_overlay(frozen_defaults, content)
+
+    reference = timeit.timeit(lambda: [reference_merge(c) for c in contents], number=1)
+    overlay = timeit.timeit(lambda: [overlay_merge(c) for c in contents], number=1)
+    print('slide defaults of a %d-level theme over %d slides: %.2f ms (%.2f ms with deep copies), '
+          '%d bytes retained per slide (%d bytes with deep copies)'
+          % (depth, slides, overlay * 1000, reference * 1000, measure(overlay_merge) / slides,
+             measure(reference_merge) / slides))
+
+
+if __name__ == '__main__':
+    benchmark_filter_non_complying_content()
+    benchmark_slide_defaults()
@@ -19,7 +19,7 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
-from ictv.models.channel import PluginChannel, Channel
+from ictv.models.channel import PluginChannel, Channel, ChannelBundle
 from ictv.models.plugin import Plugin
 from ictv.tests import FakePluginTestCase
 
@@ -35,3 +35,43 @@ class ChannelRendererPageTest(FakePluginTestCase):
         assert b"Reveal.toggleAutoSlide(true);" in body
         assert self.testApp.get(plugin_channel.get_preview_link() + 'incorrect_secret', status=403)
         assert self.testApp.get('/preview/channels/%d/incorrect_secret' % (plugin_channel.id + 42), status=404)
+
+
+class ChannelRendererConditionalTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the ChannelRenderer page answers conditional requests. """
+        Channel.deleteMany(None)
+        fake_plugin = Plugin.byName('fake_plugin')
+        plugin_channel = PluginChannel(plugin=fake_plugin, name='This is a cool channel', subscription_right='public')
+        r = self.testApp.get(plugin_channel.get_preview_link(), status=200)
+        etag = r.header('ETag')
+        assert r.header('Last-Modified')
+        assert self.testApp.get(plugin_channel.get_preview_link(), headers={'If-None-Match': etag}, status=304)
+        self.ictv_app.plugin_manager.invalidate_cache(fake_plugin.name, plugin_channel.id)
+        r = self.testApp.get(plugin_channel.get_preview_link(), headers={'If-None-Match': etag}, status=200)
+        assert b'This is a cool channel' in r.body
+
+
+class ChannelRendererBundleLastModifiedTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the last modification date of a bundle does not go back when one of its channels is removed. """
+        Channel.deleteMany(None)
+        fake_plugin = Plugin.byName('fake_plugin')
+        channel = PluginChannel(name='First channel', plugin=fake_plugin, subscription_right='public')
+        channel2 = PluginChannel(name='Second channel', plugin=fake_plugin, subscription_right='public')
+        bundle = ChannelBundle(name='Bundle', subscription_right='public')
+        bundle.add_channel(channel)
+        link = '/preview/channels/%d/%s' % (bundle.id, bundle.secret)
+
+        self.testApp.get(link, status=200)
+        bundle.add_channel(channel2)
+        r = self.testApp.get(link, status=200)
+        last_modified = r.header('Last-Modified')
+        self.testApp.get(link, headers={'If-Modified-Since': last_modified}, status=304)
+
+        # The content of the remaining channel was retrieved before, the page is still more recent than the previous
+        bundle.remove_channel(channel2)
+        r = self.testApp.get(link, headers={'If-Modified-Since': last_modified}, status=200)
+        assert b'Second channel' not in r.body
+        assert r.header('Last-Modified') != last_modified
+        self.testApp.get(link, headers={'If-Modified-Since': r.header('Last-Modified')}, status=304)
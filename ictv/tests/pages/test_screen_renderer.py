@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from ictv.models.asset import Asset
+from ictv.models.building import Building
+from ictv.models.channel import PluginChannel, Channel
+from ictv.models.plugin import Plugin
+from ictv.models.screen import Screen
+from ictv.models.user import User
+from ictv.storage.storage_manager import StorageManager
+from ictv.tests import FakePluginTestCase
+
+
+class ScreenRendererCacheTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that rendered screens are served from cache until their content changes. """
+        Channel.deleteMany(None)
+        fake_plugin = Plugin.byName('fake_plugin')
+        user = User(fullname='User', email='test@localhost')
+        channel = PluginChannel(name='Cached channel', plugin=fake_plugin, subscription_right='public')
+        channel2 = PluginChannel(name='Other channel', plugin=fake_plugin, subscription_right='public')
+        sc = Screen(name='A', building=Building(name='A'))
+        sc.subscribe_to(user, channel)
+        cache = self.ictv_app.rendered_screens_cache
+
+        r = self.testApp.get(sc.get_view_link(), status=200)
+        assert b'Cached channel' in r.body
+        assert cache.hits == 0
+        r2 = self.testApp.get(sc.get_view_link(), status=200)
+        assert cache.hits == 1
+        assert r.body == r2.body
+
+        # Invalidating the content of a channel renders the screen again
+        self.ictv_app.plugin_manager.invalidate_cache(fake_plugin.name, channel.id)
+        self.testApp.get(sc.get_view_link(), status=200)
+        assert cache.hits == 1
+        self.testApp.get(sc.get_view_link(), status=200)
+        assert cache.hits == 2
+
+        # Changing the subscriptions renders the screen again
+        sc.subscribe_to(user, channel2)
+        r = self.testApp.get(sc.get_view_link(), status=200)
+        assert cache.hits == 2
+        assert b'Other channel' in r.body
+
+        # Shuffled screens are never served from cache
+        sc.shuffle = True
+        self.testApp.get(sc.get_view_link(), status=200)
+        self.testApp.get(sc.get_view_link(), status=200)
+        assert cache.hits == 2
+
+
+class ScreenRendererConditionalTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that screens answer conditional requests with 304 as long as their content does not change. """
+        Channel.deleteMany(None)
+        fake_plugin = Plugin.byName('fake_plugin')
+        user = User(fullname='User', email='test@localhost')
+        channel = PluginChannel(name='Cached channel', plugin=fake_plugin, subscription_right='public')
+        channel2 = PluginChannel(name='Other channel', plugin=fake_plugin, subscription_right='public')
+        sc = Screen(name='A', building=Building(name='A'))
+        sc.subscribe_to(user, channel)
+        cache = self.ictv_app.rendered_screens_cache
+
+        r = self.testApp.get(sc.get_view_link(), status=200)
+        etag, last_modified = r.header('ETag'), r.header('Last-Modified')
+        r = self.testApp.get(sc.get_view_link(), headers={'If-None-Match': etag}, status=304)
+        assert r.body == b''
+        assert r.header('ETag') == etag
+        self.testApp.get(sc.get_view_link(), headers={'If-Modified-Since': last_modified}, status=304)
+        # Conditional requests are answered without touching the rendered pages
+        assert cache.hits + cache.misses == 1
+
+        # Changing the subscriptions changes both validators
+        sc.subscribe_to(user, channel2)
+        r = self.testApp.get(sc.get_view_link(), headers={'If-Modified-Since': last_modified}, status=200)
+        assert b'Other channel' in r.body
+        assert r.header('ETag') != etag
+        assert r.header('Last-Modified') != last_modified
+        self.testApp.get(sc.get_view_link(), headers={'If-None-Match': etag}, status=200)
+
+        # Shuffled screens are never validated
+        sc.shuffle = True
+        r = self.testApp.get(sc.get_view_link(), status=200)
+        assert r.header('ETag', None) is None
+
+
+class ScreenRendererAssetReferencesTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the assets of a screen keep being referenced when its page is served from cache or as 304. """
+        Channel.deleteMany(None)
+        fake_plugin = Plugin.byName('fake_plugin')
+        user = User(fullname='User', email='test@localhost')
+        channel = PluginChannel(name='Channel with an asset', plugin=fake_plugin, subscription_right='public')
+        sc = Screen(name='A', building=Building(name='A'))
+        sc.subscribe_to(user, channel)
+        asset = StorageManager(channel.id).store_file(b'GIF89a', 'background.gif')
+        plugin_module = self.ictv_app.plugin_manager.get_plugin(fake_plugin.name)
+        get_content = plugin_module.get_content
+
+        def get_content_with_asset(channel_id):
+            content = get_content(channel_id)
+            content[0].get_slides()[0].get_content()['background-1'] = {'file': asset.id, 'size': 'contain'}
+            return content
+
+        plugin_module.get_content = get_content_with_asset
+        try:
+            r = self.testApp.get(sc.get_view_link(), status=200)
+        finally:
+            plugin_module.get_content = get_content
+        assert asset.path.encode() in r.body
+
+        Asset._references.clear()
+        self.testApp.get(sc.get_view_link(), status=200)
+        assert self.ictv_app.rendered_screens_cache.hits == 1
+        assert asset.id in Asset._references
+
+        Asset._references.clear()
+        self.testApp.get(sc.get_view_link(), headers={'If-None-Match': r.header('ETag')}, status=304)
+        assert asset.id in Asset._references
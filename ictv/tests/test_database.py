@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from threading import Thread, Event
+
+from nose.tools import *
+from paste.fixture import TestApp
+from sqlobject import sqlhub
+from sqlobject.dberrors import OperationalError
+from sqlobject.mysql.mysqlconnection import MySQLConnection
+
+from ictv import database
+from ictv.database import SQLObjectThreadConnection, PooledSQLiteConnection, begin_thread_transaction, \
+    end_thread_transaction, call_after_commit
+from ictv.migrations import migration, get_pending_migrations, get_index_name
+from ictv.models.asset import Asset
+from ictv.models.asset_download import AssetDownload
+from ictv.models.building import Building
+from ictv.models.distribution_graph_version import DistributionGraphVersion
+from ictv.models.ictv_object import DBVersion
+from ictv.models.screen import Screen
+from ictv.models.transcoding_job import TranscodingJob
+from ictv.tests import ICTVTestCase
+
+
+class ConnectionPoolTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests the pool of SQLite connections and the transactions of the threads. """
+        conn = SQLObjectThreadConnection.get_conn()
+        assert_is_instance(conn, PooledSQLiteConnection)
+
+        def query_in_thread(query):
+            result = []
+            thread = Thread(target=lambda: result.append(conn.queryOne(query)))
+            thread.start()
+            thread.join()
+            return result[0]
+
+        assert_equal(query_in_thread('PRAGMA foreign_keys'), (1,))
+        assert_equal(query_in_thread('PRAGMA journal_mode'), ('wal',))
+
+        begin_thread_transaction()
+        building = Building(name='Rolled back')
+        assert_equal(Building.selectBy(name='Rolled back').count(), 1)
+        assert_equal(query_in_thread("SELECT COUNT(*) FROM building WHERE name = 'Rolled back'"), (0,))
+        end_thread_transaction(commit=False)
+        assert_equal(Building.selectBy(name='Rolled back').count(), 0)
+
+        begin_thread_transaction()
+        building = Building(name='Committed')
+        building.name = 'Committed twice'
+        end_thread_transaction()
+        assert_equal(query_in_thread("SELECT COUNT(*) FROM building WHERE name = 'Committed twice'"), (1,))
+        building.name = 'Updated after the transaction'  # The instance is still bound to a usable connection
+        assert_equal(Building.selectBy(name='Updated after the transaction').count(), 1)
+
+        self.testApp.get('/screens/redirect/000000000000', expect_errors=True)
+        assert_not_in('conn', conn._thread_transactions.__dict__)
+
+        # The functions handing rows over to other threads are called once the rows are committed
+        calls = []
+        call_after_commit(lambda: calls.append('no transaction'))
+        begin_thread_transaction()
+        Building(name='Handed over')
+        call_after_commit(lambda: calls.append(query_in_thread("SELECT COUNT(*) FROM building WHERE name = 'Handed over'")))
+        call_after_commit(lambda: 1 / 0)  # A failing function does not prevent the others from being called
+        call_after_commit(lambda: calls.append('committed'))
+        assert_equal(calls, ['no transaction'])
+        end_thread_transaction()
+        assert_equal(calls, ['no transaction', (1,), 'committed'])
+        begin_thread_transaction()
+        call_after_commit(lambda: calls.append('rolled back'))
+        end_thread_transaction(commit=False)
+        begin_thread_transaction()
+        end_thread_transaction()
+        assert_equal(len(calls), 3)
+
+        pool_config = database.pool_config
+        database.pool_config = {'size': 2, 'timeout': 0.1}
+        try:
+            pool = PooledSQLiteConnection(conn.filename)
+            connections = [pool.getConnection(), pool.getConnection()]
+            assert_raises(OperationalError, pool.getConnection)
+            pool.releaseConnection(connections[0])
+            pool.releaseConnection(connections[0])
+            assert_is(pool.getConnection(), connections[0])
+            assert_raises(OperationalError, pool.getConnection)
+            for c in connections:
+                pool.releaseConnection(c)
+
+            # Requests handing work over to workers once committed do not hold the connections the workers need
+            worker_results = []
+
+            def worker():
+                worker_results.append(pool.queryOne('SELECT 1'))
+
+            def request():
+                pool.begin_thread_transaction()
+                pool.queryOne('SELECT COUNT(*) FROM building')
+                workers = [Thread(target=worker) for _ in range(2)]
+                for t in workers:
+                    pool.call_after_commit(t.start)
+                pool.end_thread_transaction()
+                for t in workers:
+                    t.join()
+
+            requests = [Thread(target=request) for _ in range(2)]
+            for t in requests:
+                t.start()
+            for t in requests:
+                t.join()
+            assert_equal(worker_results, [(1,)] * 4)
+            pool.begin_thread_transaction()  # A transaction without any query does not hold a connection
+            def transactional_worker():
+                pool.begin_thread_transaction()
+                worker()
+                pool.end_thread_transaction()
+
+            workers = [Thread(target=transactional_worker) for _ in range(2)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            assert_equal(len(worker_results), 6)
+            pool.end_thread_transaction()
+            pool.close()
+        finally:
+            database.pool_config = pool_config
+
+
+class ImmediateTransactionTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests that an immediate transaction can write what it read while another thread writes concurrently. """
+        read = Event()
+
+        def write_in_thread(name):
+            read.wait()
+            Building(name=name)
+
+        # A deferred transaction cannot write once another thread committed since its first read
+        begin_thread_transaction()
+        writer = Thread(target=write_in_thread, args=('Concurrent',))
+        writer.start()
+        assert_equal(Building.select().count(), 0)
+        read.set()
+        writer.join()
+        with assert_raises(OperationalError):
+            Building(name='Deferred')
+        end_thread_transaction(commit=False)
+
+        # An immediate transaction makes the other thread wait for it to commit instead
+        read.clear()
+        begin_thread_transaction(immediate=True)
+        writer = Thread(target=write_in_thread, args=('Waiting',))
+        writer.start()
+        assert_equal(Building.select().count(), 1)
+        read.set()
+        writer.join(timeout=0.2)
+        assert_true(writer.is_alive())  # The other thread waits for the write lock
+        Building(name='Immediate')
+        end_thread_transaction()
+        writer.join()
+        assert_equal(sorted(b.name for b in Building.select()), ['Concurrent', 'Immediate', 'Waiting'])
+
+
+class RequestTransactionTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests the transactions of the requests and that their connection is always given back to the pool. """
+        conn = SQLObjectThreadConnection.get_conn()
+        screen = Screen(name='Transaction', building=Building(name='Transaction'))
+
+        transactions = []
+        failing = []
+
+        def postprocessor(response):
+            transactions.append(dict(conn._thread_transactions.__dict__))
+            if failing:
+                raise RuntimeError('The postprocessor failed')
+            return response
+
+        self.ictv_app.register_after_request(lambda: postprocessor)
+        self.ictv_app.secret_key = 'secret'  # The dispatcher applies the postprocessors writing to the session
+        test_app = TestApp(self.ictv_app.get_app_dispatcher())
+
+        # The pages rendering the content of channels do not run in a transaction
+        test_app.get('/screens/%d/view/%s' % (screen.id, screen.secret))
+        test_app.get('/screens/redirect/000000000000', expect_errors=True)
+        assert_equal(transactions[0], {})
+        assert_true(transactions[1]['active'])
+
+        failing.append(True)
+        with assert_raises(Exception):
+            test_app.get('/screens/redirect/000000000000')
+        assert_equal(conn._thread_transactions.__dict__, {})
+        assert_not_in(conn, conn._leased_connections)
+
+
+class MigrationTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests that the pending migrations are reported in a dry-run and applied in order otherwise. """
+        conn = sqlhub.processConnection
+        indexes = ['asset_cached_index', 'asset_last_reference_index', 'subscription_channel_index',
+                   'role_channel_index', 'screen_mac_screen_index']
+        for index in indexes:
+            conn.query('DROP INDEX %s' % index)
+        # The tables of the downloads and of the transcoding jobs are created again without the columns added since
+        for so_class in (AssetDownload, TranscodingJob):
+            create_table = conn.createTableSQL(so_class)[0]
+            conn.query('DROP TABLE %s' % so_class.sqlmeta.table)
+            conn.query(create_table.replace(',\n    owner TEXT', '').replace(',\n    error TEXT', ''))
+            for index in so_class.sqlmeta.indexes:
+                conn.query(conn.createIndexSQL(so_class, index))
+        DistributionGraphVersion.dropTable()
+        DBVersion.select().getOne().set(version=4)
+
+        reports = database.migrate_database(dry_run=True)
+        assert_equal([r.version for r in reports], [5, 6, 7, 8])
+        assert_equal(len(reports[0].statements), len(indexes))
+        assert_true(all(p.after is None and p.index not in p.before for p in reports[0].plans))
+        assert_equal(len(reports[1].statements), 2)
+        assert_equal(DBVersion.select().getOne().version, 4)
+
+        reports = database.migrate_database()
+        assert_equal([p.index for p in reports[0].plans], indexes)
+        assert_equal(AssetDownload.select(AssetDownload.q.owner == 'migrated').count(), 0)
+        job = TranscodingJob(input_file='migrated', output_file='migrated.webm', owner='migrated')
+        assert_equal(job.owner, 'migrated')
+        assert_equal(DistributionGraphVersion.get_version(), 0)
+        assert_true(all(p.index in p.after for p in reports[0].plans))
+        assert_equal(DBVersion.select().getOne().version, database.database_version)
+        assert_equal(database.migrate_database(), [])
+
+        cached_index = next(i for i in Asset.sqlmeta.indexes if i.name == 'cached_index')
+        assert_equal(get_index_name(conn, Asset, cached_index), 'asset_cached_index')
+        assert_equal(get_index_name(MySQLConnection, Asset, cached_index), 'cached_index')
+        assert_in('filename(191)', cached_index.mysqlCreateIndexSQL(Asset))
+
+        with assert_raises(ValueError):
+            migration(database.database_version, 'Out of order')(lambda migrator: None)
+        assert_equal(get_pending_migrations(0)[-1].version, database.database_version)
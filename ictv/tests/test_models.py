@@ -25,16 +25,22 @@ import os
 import time
 
 import pytest
+from sqlobject import SQLObjectNotFound, sqlhub
 
 from ictv.common import get_root_path
+from ictv.database import begin_thread_transaction, end_thread_transaction
 from ictv.models.asset import Asset
 from ictv.models.building import Building
 from ictv.models.channel import PluginChannel, Channel, ChannelBundle
+from ictv.models.distribution_graph import DistributionGraph
+from ictv.models.distribution_graph_version import DistributionGraphVersion
 from ictv.models.log_stat import LogStat
+from ictv.models.object_cache import ObjectCache
 from ictv.models.plugin import Plugin
 from ictv.models.plugin_param_access_rights import PluginParamAccessRights
 from ictv.models.role import UserPermissions, Role
 from ictv.models.screen import Screen, ScreenMac
+from ictv.models.template import Template
 from ictv.models.user import User
 from ictv.tests import ICTVTestCase, create_fake_plugin, FakePluginTestCase
 
@@ -49,7 +55,12 @@ class AssetObjectTest(ICTVTestCase):
         last_ref_a1 = a1.last_reference
         time.sleep(1)
         assert a1.path == os.path.join('static', 'storage', str(asset_channel.id), str(a1.id) + '.txt')
+        a1.sync()
+        assert a1.last_reference == last_ref_a1
+        assert Asset.flush_references() == 1
+        a1.sync()
         assert a1.last_reference > last_ref_a1
+        assert Asset.flush_references() == 0
 
         a2 = Asset(plugin_channel=asset_channel, user=None, filename='path_test')
         assert a2.path == os.path.join('static', 'storage', str(asset_channel.id), str(a2.id))
@@ -829,4 +840,189 @@ class LogStatTestLoad(ICTVTestCase):
         my_stats["test_stat_2"]["n_entries"] = 0
 
         # Now load the inserted stats and check that everything has been correctly loaded
-        assert LogStat.load_log_stats() == my_stats
\ No newline at end of file
+        assert LogStat.load_log_stats() == my_stats
+
+
+class ObjectCacheTest(ICTVTestCase):
+    config = dict(ICTVTestCase.config, object_cache={'enabled': True})
+
+    def runTest(self):
+        """ Tests that the instances of the read-mostly models are served from the object cache until they change. """
+        building = Building(name='Cached')
+        screen = Screen(name='Cached', building=building)
+        plugin = Plugin(name='cached_plugin', activated='no')
+        channel = PluginChannel(name='Cached', plugin=plugin, subscription_right='public')
+
+        def lookup():
+            return (Screen.get(screen.id).building.name, Plugin.byName('cached_plugin').id,
+                    PluginChannel.get(channel.id).plugin.name, Channel.get(channel.id).name,
+                    Template.byName('template-text-center').name)
+
+        expected = lookup()
+        queries = []
+        conn = sqlhub.processConnection
+        execute = conn._executeRetry
+        conn._executeRetry = lambda *args: queries.append(args[2]) or execute(*args)
+        try:
+            hits = ObjectCache.get_statistics()['hits']
+            assert lookup() == expected
+            assert queries == []
+            assert ObjectCache.get_statistics()['hits'] - hits >= 7
+        finally:
+            conn._executeRetry = execute
+
+        # Updates and deletions invalidate the cached instances
+        building.name = 'Renamed'
+        assert Building.byName('Renamed').id == building.id
+        with pytest.raises(SQLObjectNotFound):
+            Building.byName('Cached')
+        Channel.get(channel.id).name = 'Renamed'
+        assert PluginChannel.get(channel.id).name == 'Renamed'
+        screen_id = screen.id
+        screen.destroySelf()
+        del screen  # SQLObject keeps returning the destroyed instance as long as it is referenced
+        with pytest.raises(SQLObjectNotFound):
+            Screen.get(screen_id)
+
+        # Changes made by raw SQL queries are seen once explicitly invalidated
+        conn.query("UPDATE plugin SET description = 'Raw' WHERE id = %d" % plugin.id)
+        assert Plugin.get(plugin.id).description is None
+        ObjectCache.invalidate(Plugin, plugin.id)
+        assert Plugin.get(plugin.id).description == 'Raw'
+
+        # Changes that are rolled back are not kept in cache
+        begin_thread_transaction()
+        Building.get(building.id).name = 'Rolled back'
+        end_thread_transaction(commit=False)
+        assert Building.get(building.id).name == 'Renamed'
+
+
+class ChannelBundleClosureTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the closure table of the bundles follows the changes made to them. """
+        fake_plugin = Plugin.byName('fake_plugin')
+        pc1 = PluginChannel(name='Closure 1', plugin=fake_plugin, subscription_right='public')
+        pc2 = PluginChannel(name='Closure 2', plugin=fake_plugin, subscription_right='public')
+        bundles = [ChannelBundle(name='Closure bundle %d' % i, subscription_right='public') for i in range(5)]
+        for outer, inner in zip(bundles, bundles[1:]):
+            outer.add_channel(inner)
+        bundles[-1].add_channel(pc2)
+        bundles[-1].add_channel(pc1)
+        bundles[2].add_channel(pc2)
+        assert bundles[0].get_reachable_channel_ids() == {b.id for b in bundles[1:]} | {pc1.id, pc2.id}
+        assert ChannelBundle.get_bundles_containing([pc1.id]) == {b.id for b in bundles}
+        assert ChannelBundle.get_bundles_containing([bundles[3].id]) == {b.id for b in bundles[:3]}
+
+        # Flattening does not depend on the depth of the bundles
+        queries = []
+        conn = sqlhub.processConnection
+        execute = conn._executeRetry
+        conn._executeRetry = lambda *args: queries.append(args[2]) or execute(*args)
+        try:
+            assert bundles[0].flatten() == [pc2, pc1, pc2]
+        finally:
+            conn._executeRetry = execute
+        assert len(queries) <= 5
+
+        bundles[3].enabled = False
+        assert bundles[0].flatten() == [pc2]
+        assert bundles[0].flatten(keep_disabled_channels=True) == [pc2, pc1, pc2]
+        bundles[3].enabled = True
+
+        with pytest.raises(ValueError):
+            bundles[4].add_channel(bundles[1])
+        with pytest.raises(ValueError):
+            bundles[2].add_channel(bundles[2])
+        bundles[2].remove_channel(bundles[3])
+        assert ChannelBundle.get_bundles_containing([pc1.id]) == {bundles[3].id, bundles[4].id}
+        bundles[4].add_channel(bundles[1])
+        assert ChannelBundle.get_bundles_containing([bundles[1].id]) == {bundles[0].id, bundles[3].id, bundles[4].id}
+
+        # Deleted channels and bundles are removed from the closure of the bundles they were reachable from
+        pc2.destroySelf()
+        assert bundles[1].flatten() == []
+        assert bundles[3].flatten() == [pc1]
+        bundles[4].destroySelf()
+        assert bundles[3].get_reachable_channel_ids() == set()
+        assert ChannelBundle.get_bundles_containing([pc1.id]) == set()
+        ChannelBundle.rebuild_closure()
+        assert bundles[0].get_reachable_channel_ids() == {bundles[1].id, bundles[2].id}
+
+
+class DistributionGraphTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the snapshot of the screens and channels follows the changes made to them. """
+        fake_plugin = Plugin.byName('fake_plugin')
+        user = User(username='graph', fullname='graph', email='graph@localhost', super_admin=True, disabled=False)
+        pc1 = PluginChannel(name='Graph 1', plugin=fake_plugin, subscription_right='public')
+        pc2 = PluginChannel(name='Graph 2', plugin=fake_plugin, subscription_right='public', cache_validity=5)
+        bundle = ChannelBundle(name='Graph bundle', subscription_right='public')
+        bundle.add_channel(pc2)
+        bundle.add_channel(pc1)
+        screen = Screen(name='Graph', building=Building(name='Graph'))
+        screen.subscribe_to(user, pc2)
+        screen.subscribe_to(user, bundle)
+        other_screen = Screen(name='Other graph', building=screen.building)
+        other_screen.subscribe_to(user, pc2)
+        other_screen.subscribe_to(user, pc1)
+
+        graph = DistributionGraph.get()
+        node = graph.get_screen(screen.id)
+        assert [c.id for c in node.get_plugin_channels()] == [c.id for c in screen.get_plugin_channels()]
+        # The channels are ordered by subscription and in the order they were bundled
+        assert [c.id for c in graph.get_screen(other_screen.id).plugin_channels] == [pc2.id, pc1.id]
+        assert graph.get_channel(pc2.id).cache_validity == 5
+        assert graph.get_channel(pc1.id).cache_validity == fake_plugin.cache_validity_default
+        assert graph.get_channel(pc1.id).plugin.activated == 'yes'
+        assert list(bundle.bundled_channels) == [pc2, pc1]
+        assert [c.id for c in graph.flatten(bundle.id)] == [c.id for c in bundle.flatten()] == [pc2.id, pc1.id]
+        assert DistributionGraph.resolve(graph.flatten(bundle.id)) == [pc2, pc1]
+        assert graph.get_screen(other_screen.id + 1) is None
+
+        # The current snapshot is served without querying the database
+        queries = []
+        conn = sqlhub.processConnection
+        execute = conn._executeRetry
+        conn._executeRetry = lambda *args: queries.append(args[2]) or execute(*args)
+        try:
+            assert DistributionGraph.get() is graph
+            screen.last_access = datetime.datetime.now()
+            assert DistributionGraph.get() is graph
+        finally:
+            conn._executeRetry = execute
+        assert len(queries) == 1
+
+        # Each change to the graph replaces the snapshot
+        pc1.enabled = False
+        assert [c.id for c in DistributionGraph.get().get_screen(screen.id).plugin_channels] == [pc2.id]
+        flattened_bundle = DistributionGraph.get().flatten(bundle.id, keep_disabled_channels=True)
+        assert [c.id for c in flattened_bundle] == [pc2.id, pc1.id]
+        bundle.remove_channel(pc2)
+        assert DistributionGraph.get().flatten(bundle.id, keep_disabled_channels=True)[0].id == pc1.id
+        screen.unsubscribe_from(user, pc2)
+        assert DistributionGraph.get().get_screen(screen.id).plugin_channels == ()
+        fake_plugin.cache_validity_default = 30
+        assert DistributionGraph.get().get_channel(pc1.id).cache_validity == 30
+
+        # A snapshot built while a transaction changes the graph is replaced once it ends
+        begin_thread_transaction()
+        screen = Screen.get(screen.id)
+        screen.name = 'Renamed'
+        graph = DistributionGraph.get()
+        end_thread_transaction()
+        assert DistributionGraph.get() is not graph
+        assert DistributionGraph.get().get_screen(screen.id).name == 'Renamed'
+
+        # A change made by another process is seen once the version stored in the database is polled
+        graph = DistributionGraph.get()
+        DistributionGraphVersion.increment()
+        assert DistributionGraph.get() is graph
+        graph.polled -= DistributionGraph.poll_interval
+        assert DistributionGraph.get() is not graph
+        graph = DistributionGraph.get()
+        graph.polled -= DistributionGraph.poll_interval
+        assert DistributionGraph.get() is graph
+
+        self.testApp.get('/screens/%d/view/%s' % (screen.id, screen.secret), status=200)
+        self.testApp.get('/screens/%d/view/wrong' % screen.id, status=403)
+        self.testApp.get('/preview/channels/%d/%s' % (bundle.id, bundle.secret), status=200)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from threading import Thread, Event, Semaphore
+
+from nose.tools import *
+
+from ictv.models.channel import PluginChannel, Channel
+from ictv.models.plugin import Plugin
+from ictv.plugin_manager import plugin_manager as plugin_manager_module
+from ictv.plugin_manager.content_cache import SQLiteContentCache
+from ictv.tests import ICTVTestCase, FakePluginTestCase
+
+
+class BackgroundRefreshTest(FakePluginTestCase):
+    config = dict(ICTVTestCase.config, background_refresh={'activated': True, 'workers': 2, 'advance': 0, 'jitter': 0})
+
+    def runTest(self):
+        """ Tests that expired content is served while being refreshed in background. """
+        Channel.deleteMany(None)
+        fake_plugin = Plugin.byName('fake_plugin')
+        channel = PluginChannel(name='Refreshed channel', plugin=fake_plugin, subscription_right='public')
+        plugin_manager = self.ictv_app.plugin_manager
+        assert plugin_manager.content_refresher is not None
+        refreshed = Event()
+        refresh_plugin_content = plugin_manager.refresh_plugin_content
+        plugin_manager.refresh_plugin_content = lambda c: refresh_plugin_content(c) or refreshed.set()
+
+        content = plugin_manager.get_plugin_content(channel)
+        assert_equal(content[0].get_slides()[0].get_content()['title-1']['text'], 'Refreshed channel')
+        generation = plugin_manager.cache.get(channel.id)['generation']
+
+        # Expire the content and change what the plugin will return
+        plugin_manager.cache.get(channel.id)['retrieval_time'] -= timedelta(minutes=channel.cache_validity + 1)
+        channel.name = 'Refreshed channel 2'
+        content = plugin_manager.get_plugin_content(channel)
+        assert_equal(content[0].get_slides()[0].get_content()['title-1']['text'], 'Refreshed channel')
+
+        assert_true(refreshed.wait(10))
+        assert plugin_manager.cache.get(channel.id)['generation'] != generation
+        assert_false(plugin_manager.was_served(channel.id))
+        content = plugin_manager.get_plugin_content(channel)
+        assert_equal(content[0].get_slides()[0].get_content()['title-1']['text'], 'Refreshed channel 2')
+        assert_true(plugin_manager.was_served(channel.id))
+
+
+class ContentComputationCoalescingTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that concurrent computations of the content of a channel are coalesced. """
+        Channel.deleteMany(None)
+        fake_plugin = Plugin.byName('fake_plugin')
+        channel = PluginChannel(name='Coalesced channel', plugin=fake_plugin, subscription_right='public')
+        plugin_manager = self.ictv_app.plugin_manager
+        plugin_module = plugin_manager.get_plugin(fake_plugin.name)
+        get_content = plugin_module.get_content
+        calls = []
+        all_callers_waiting = Event()
+
+        class Computations(dict):
+            """ Lets the computation complete once every caller has looked for it. """
+            lookups = 0
+
+            def get(self, *args):
+                Computations.lookups += 1
+                if Computations.lookups == 5:
+                    all_callers_waiting.set()
+                return super(Computations, self).get(*args)
+
+        def slow_get_content(channel_id):
+            calls.append(channel_id)
+            all_callers_waiting.wait(10)
+            return get_content(channel_id)
+
+        computations = plugin_manager._computations
+        plugin_manager._computations = Computations()
+        plugin_module.get_content = slow_get_content
+        try:
+            contents = []
+            threads = [Thread(target=lambda: contents.append(plugin_manager.get_plugin_content(channel)))
+                       for _ in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            plugin_module.get_content = get_content
+            plugin_manager._computations = computations
+        assert_true(all_callers_waiting.is_set())
+        assert_equal(calls, [channel.id])
+        assert_equal(len(contents), 5)
+        for content in contents:
+            assert_equal(content[0].get_slides()[0].get_content()['title-1']['text'], 'Coalesced channel')
+        assert_equal(plugin_manager.computations, 1)
+        assert_equal(plugin_manager.coalesced_computations, 4)
+
+
+class FakeClock(object):
+    """ A monotonic clock that only moves when told to. """
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+
+class ParallelRetrievalTest(FakePluginTestCase):
+    config = dict(ICTVTestCase.config, parallel_retrieval={'activated': True, 'workers': 4, 'timeout': 1})
+
+    def runTest(self):
+        """ Tests that the content of channels retrieved concurrently is returned in order and in time. """
+        Channel.deleteMany(None)
+        fake_plugin = Plugin.byName('fake_plugin')
+        channels = [PluginChannel(name='Channel %d' % i, plugin=fake_plugin, subscription_right='public',
+                                  cache_activated=False) for i in range(5)]
+        plugin_manager = self.ictv_app.plugin_manager
+        plugin_module = plugin_manager.get_plugin(fake_plugin.name)
+        get_content = plugin_module.get_content
+
+        def get_titles(contents):
+            return [content[0].get_slides()[0].get_content()['title-1']['text'] for content in contents]
+
+        assert_equal(get_titles(plugin_manager.get_plugins_content(channels)), ['Channel %d' % i for i in range(5)])
+
+        slow_release, release = Event(), Event()
+        clock = FakeClock()
+        try:
+            # A slow channel is given its last content once the timeout expired
+            slow_retrievals = []
+
+            def slow_get_content(channel_id):
+                if channel_id == channels[2].id:
+                    slow_release.wait(10)
+                    slow_retrievals.append(channel_id)
+                return get_content(channel_id)
+
+            plugin_module.get_content = slow_get_content
+            channels[2].name = 'Slow channel'
+            assert_equal(get_titles(plugin_manager.get_plugins_content(channels)), ['Channel %d' % i for i in range(5)])
+            assert_equal(slow_retrievals, [])
+            slow_release.set()
+            plugin_manager.get_plugin_content(channels[2])  # Waits for the slow computation to complete
+
+            # A channel waiting for a worker is given the whole timeout once its retrieval starts
+            plugin_manager_module.time = clock
+            started = Semaphore(0)
+            queued_started, queued_release = Event(), Event()
+
+            def busy_get_content(channel_id):
+                if channel_id == channels[4].id:
+                    queued_started.set()
+                    queued_release.wait(10)
+                else:
+                    started.release()
+                    release.wait(10)
+                return get_content(channel_id)
+
+            def run_retrievals():
+                for _ in range(4):
+                    started.acquire(timeout=10)
+                clock.now = 0.5
+                release.set()
+                queued_started.wait(10)
+                clock.now = 1.2  # The timeout has expired since the submission but not since the start of the retrieval
+                queued_release.set()
+
+            plugin_module.get_content = busy_get_content
+            channels[4].name = 'Queued channel'
+            Thread(target=run_retrievals, daemon=True).start()
+            assert_equal(get_titles(plugin_manager.get_plugins_content(channels))[4], 'Queued channel')
+        finally:
+            slow_release.set()
+            release.set()
+            plugin_module.get_content = get_content
+            plugin_manager_module.time = time
+
+
+class SQLiteContentCacheTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the SQLite content cache is shared by its instances and survives them. """
+        fake_plugin = Plugin.byName('fake_plugin')
+        channel = PluginChannel(name='Shared channel', plugin=fake_plugin, subscription_right='public')
+        content = self.ictv_app.plugin_manager.get_plugin(fake_plugin.name).get_content(channel.id)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        cache, other_cache = SQLiteContentCache(path), SQLiteContentCache(path)
+        try:
+            now = datetime.now()
+            entry = cache.put(channel.id, content, now)
+            other_entry = other_cache.get(channel.id)
+            assert_equal(other_entry['generation'], entry['generation'])
+            assert_equal(other_entry['retrieval_time'], now)
+            assert_equal(other_entry['content'], content)
+            assert_false(other_entry['complete'])
+
+            other_cache.update(channel.id, entry['generation'], complete=True)
+            assert_true(cache.get(channel.id)['complete'])
+            assert other_cache.put(channel.id, content, now)['generation'] > entry['generation']
+            # Updates of a previous generation are ignored
+            cache.update(channel.id, entry['generation'], served=True)
+            assert_false(other_cache.get(channel.id)['served'])
+            assert_equal(SQLiteContentCache(path).get(channel.id)['content'], content)
+
+            cache.invalidate(channel.id)
+            assert_equal(other_cache.get(channel.id), None)
+
+            # A content that cannot be serialized is only cached by the instance that computed it
+            unserializable_content = [lambda: None]
+            cache.put(channel.id, unserializable_content, now)
+            assert_equal(cache.get(channel.id)['content'], unserializable_content)
+            assert_equal(other_cache.get(channel.id), None)
+            # and does not replace the content stored by the others
+            entry = other_cache.put(channel.id, content, now.replace(microsecond=0))
+            cache.put(channel.id, unserializable_content, now)
+            assert_equal(other_cache.get(channel.id)['generation'], entry['generation'])
+            assert_equal(other_cache.get(channel.id)['retrieval_time'], now.replace(microsecond=0))
+            assert_equal(cache.get(channel.id)['content'], unserializable_content)
+            other_cache.put(channel.id, content, now + timedelta(seconds=1))
+            assert_equal(cache.get(channel.id)['content'], content)
+        finally:
+            cache.close()
+            other_cache.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+
+from nose.tools import *
+
+from ictv.common.utils import deep_update, deep_overlay
+from ictv.models.channel import PluginChannel
+from ictv.models.plugin import Plugin
+from ictv.plugin_manager.plugin_slide import PluginSlide
+from ictv.renderer import renderer
+from ictv.renderer.renderer import Templates, FragmentCache, SlideRenderer, compute_slide_defaults
+from ictv.tests import ICTVTestCase, FakePluginTestCase
+
+
+class TemplatesLimitsTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests the check of the templates limits on slides. """
+        content = {'title-1': {'text': '<b>%s</b>' % ('&amp;' * 35)}, 'text-1': {'text': 'Text'},
+                   'background-1': {'src': '', 'size': 'contain'}}
+        slide = type('Slide', (PluginSlide,), {'get_duration': lambda self: 5000, 'get_content': lambda self: content,
+                                               'get_template': lambda self: 'template-background-text-center'})()
+        assert_equal(Templates.get_non_complying_fields(slide), [])
+        content['title-1']['text'] += 'a'
+        non_complying_fields = Templates.get_non_complying_fields(slide)
+        assert_equal(non_complying_fields, [('title-1', 'template-background-text-center', 36, 35,
+                                             content['title-1']['text'])])
+        non_complying_fields.clear()
+        assert_equal(len(Templates.get_non_complying_fields(slide)), 1)
+
+
+class TemplatesRegistryTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests that the templates are parsed once and described as when they are rendered. """
+        for template in Templates:
+            rendered_fields = renderer.render_template_fields(template)
+            assert_equal([(id, attributes) for id, attributes in Templates[template].items()
+                          if id not in ('name', 'description')], rendered_fields)
+            parsed = renderer.parse_template(template)
+            if parsed is not None:
+                assert_equal(parsed[0], rendered_fields)
+                assert_equal(parsed[1]['name'], Templates[template]['name'])
+        # The text of this template is in a conditional block and is not rendered without a slide
+        assert_is_none(renderer.parse_template('template-background-text-qr'))
+        assert_not_in('text-1', Templates['template-background-text-qr'])
+
+        parse_template = renderer.parse_template
+        parsed_templates = []
+        renderer.parse_template = lambda template: parsed_templates.append(template) or parse_template(template)
+        fd, cache_path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            assert_equal(renderer.load_templates(), {t: Templates[t] for t in Templates})
+            assert_equal(sorted(parsed_templates), sorted(Templates))
+            # Warm starts find the description of the templates in the cache file
+            del parsed_templates[:]
+            assert_equal(renderer.load_templates(cache_path), {t: Templates[t] for t in Templates})
+            assert_equal(len(parsed_templates), len(Templates._templates))
+            assert_equal(renderer.load_templates(cache_path), {t: Templates[t] for t in Templates})
+            assert_equal(len(parsed_templates), len(Templates._templates))
+        finally:
+            renderer.parse_template = parse_template
+            os.unlink(cache_path)
+        assert_true(renderer.get_templates_cache_path().startswith(tempfile.gettempdir()))
+
+
+class FragmentCacheTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that rendered slides are served from the fragment cache until their content changes. """
+        fake_plugin = Plugin.byName('fake_plugin')
+        channel = PluginChannel(name='Fragments', plugin=fake_plugin, subscription_right='public')
+        ictv_renderer = self.ictv_app.ictv_renderer
+        fragment_cache = ictv_renderer.fragment_cache
+        capsules = self.ictv_app.plugin_manager.get_plugin_content(channel)
+        slide = capsules[0].get_slides()[0]
+
+        page = ictv_renderer.render_screen(capsules)
+        assert_equal(fragment_cache.hits, 0)
+        assert_equal(ictv_renderer.preview_capsules(capsules).count(ictv_renderer.render_themed_slide(slide, 'ictv')), 1)
+        assert_equal(fragment_cache.hits, 2)
+        assert_equal(ictv_renderer.render_screen(capsules), page)
+        ictv_renderer.preview_slide(slide, theme='ictv')
+        assert_equal(fragment_cache.hits, 4)
+
+        # Changing the content or the theme renders the slide again
+        slide.get_content()['title-1']['text'] = 'Changed'
+        assert 'Changed' in ictv_renderer.render_themed_slide(slide, 'ictv')
+        ictv_renderer.preview_slide(slide)
+        assert_equal(fragment_cache.hits, 4)
+
+        # The least recently used fragments are evicted first
+        cache = FragmentCache(10)
+        cache.put('a', '12345')
+        cache.put('b', '12345')
+        cache.get('a')
+        cache.put('c', '12345')
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('a'), '12345')
+        cache.put('d', '12345678901')
+        assert_equal(cache.get('d'), None)
+
+
+class TemplatesVersionTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests that the templates are only scanned again once their last known version expired. """
+        scans = []
+        compute_templates_version = SlideRenderer._compute_templates_version
+        SlideRenderer._compute_templates_version = staticmethod(lambda: scans.append(1) or compute_templates_version())
+        try:
+            SlideRenderer._templates_version = None
+            version = self.ictv_app.ictv_renderer.get_templates_version()
+            assert_equal(SlideRenderer.get_templates_version(), version)
+            assert_equal(len(scans), 1)
+            SlideRenderer._templates_version_expiry = 0
+            assert_equal(SlideRenderer.get_templates_version(), version)
+            assert_equal(len(scans), 2)
+        finally:
+            SlideRenderer._compute_templates_version = compute_templates_version
+
+
+class ThemeDefaultsTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests that the slide defaults of themes are resolved once and merged with slides without being modified. """
+        themes = {'base': {'slide_defaults': {'title-1': {'color': 'black', 'font': {'size': 10}}, 'logo-1': {'src': 'a'}}},
+                  'child': {'parent': 'base', 'slide_defaults': {'title-1': {'font': {'size': 12}}}},
+                  'grandchild': {'parent': 'child', 'slide_defaults': {'logo-1': {'src': 'b'}}}}
+        slide_defaults = compute_slide_defaults(themes)
+        assert_equal(slide_defaults['grandchild'], {'title-1': {'color': 'black', 'font': {'size': 12}},
+                                                    'logo-1': {'src': 'b'}})
+        assert_equal(themes['base']['slide_defaults']['title-1']['font']['size'], 10)
+        with assert_raises(TypeError):
+            slide_defaults['child']['title-1']['color'] = 'white'
+
+        content = {'title-1': {'text': 'Title', 'font': {'family': 'serif'}}, 'text-1': {'text': 'Text'}}
+        merged = deep_overlay(slide_defaults['grandchild'], content)
+        assert_equal(merged, deep_update({'title-1': {'color': 'black', 'font': {'size': 12}}, 'logo-1': {'src': 'b'}},
+                                         content))
+        assert_true(merged['logo-1'] is slide_defaults['grandchild']['logo-1'])
+        assert_equal(deep_overlay({'title-1': 'text'}, {'title-1': {'text': 'Title'}}), {'title-1': {'text': 'Title'}})
+        assert_equal(slide_defaults['grandchild']['title-1'], {'color': 'black', 'font': {'size': 12}})
+
+        # The public defaults remain a modifiable copy
+        defaults = renderer.Themes.get_slide_defaults('ictv')
+        defaults['title-1'] = {'text': 'Changed'}
+        assert_not_equal(renderer.Themes.get_slide_defaults('ictv'), defaults)
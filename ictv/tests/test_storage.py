@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import hashlib
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from concurrent import futures
+from datetime import datetime, timedelta
+from functools import partial
+from io import BytesIO
+from threading import Condition, Event, Lock, Semaphore
+
+from nose.tools import *
+from sqlobject import sqlhub
+
+from ictv.common import get_root_path
+from ictv.models.asset import Asset
+from ictv.models.asset_download import AssetDownload
+from ictv.models.channel import PluginChannel
+from ictv.models.plugin import Plugin
+from ictv.models.transcoding_job import TranscodingJob
+from ictv.storage import transcoding_queue
+from ictv.storage.blob_store import BlobStore
+from ictv.storage.cache_manager import CacheManager, CleanupScheduler
+from ictv.storage.download_manager import DownloadTooLarge
+from ictv.storage.storage_manager import StorageManager
+from ictv.storage.storage_reconciler import StorageReconciler
+from ictv.storage.transcoding_queue import TranscodingQueue, _serialize_callback, read_progress
+from ictv.tests import ICTVTestCase, FakePluginTestCase, BackgroundHTTPServer, QuietHTTPRequestHandler
+
+
+def get_process_names():
+    """ Returns the names of another process of this host that is running and of one that is over. """
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return '%s:%d' % (socket.gethostname(), os.getppid()), '%s:%d' % (socket.gethostname(), process.pid)
+
+
+class DownloadManagerTest(ICTVTestCase):
+    config = dict(ICTVTestCase.config, download_manager={'max_connections': 4, 'max_connections_per_host': 2,
+                                                         'timeout': 5, 'retries': 2, 'backoff': 0})
+
+    def runTest(self):
+        """ Tests that the downloads share bounded connections and that transient failures are retried. """
+        state = {'running': 0, 'max_running': 0, 'flaky': 0}
+        lock = Lock()
+        received, release = Semaphore(0), Event()
+
+        class Handler(QuietHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    state['running'] += 1
+                    state['max_running'] = max(state['max_running'], state['running'])
+                received.release()
+                release.wait(10)
+                with lock:
+                    state['running'] -= 1
+                    if self.path == '/flaky':
+                        state['flaky'] += 1
+                status = 503 if self.path == '/flaky' and state['flaky'] < 3 else 200
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(self.path)))
+                self.end_headers()
+                self.wfile.write(self.path.encode())
+
+        download_manager = self.ictv_app.download_manager
+        with BackgroundHTTPServer(Handler) as server:
+            def download(path):
+                return asyncio.run_coroutine_threadsafe(download_manager._get_content(server.url + '/' + path),
+                                                        download_manager._loop)
+
+            tasks = [download(str(i)) for i in range(6)]
+            assert_true(received.acquire(timeout=10) and received.acquire(timeout=10))
+            assert_equal(download_manager.get_statistics()['in_flight'], 2)
+            assert_equal(download_manager.get_statistics()['queued'], 4)
+            release.set()
+            assert_equal([t.result(timeout=10) for t in tasks], [('/%d' % i).encode() for i in range(6)])
+            assert_equal(state['max_running'], 2)
+
+            assert_equal(download('flaky').result(timeout=10), b'/flaky')
+            assert_equal(state['flaky'], 3)
+            assert_equal(download_manager.get_statistics(), {'queued': 0, 'in_flight': 0, 'retried': 2, 'failed': 0})
+
+
+class DownloadStreamingTest(ICTVTestCase):
+    config = dict(ICTVTestCase.config, download_manager={'max_size_megabytes': 1})
+
+    def runTest(self):
+        """ Tests that the downloaded assets are streamed to their file and that oversized downloads are aborted. """
+        files = {'/small.gif': b'GIF89a' + os.urandom(300 * 1024), '/large': b'0' * 2 * 1024 * 1024}
+
+        class Handler(QuietHTTPRequestHandler):
+            def do_GET(self):
+                content = files[self.path.split('?')[0]]
+                self.send_response(200)
+                if not self.path.endswith('?chunked'):
+                    self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        download_manager = self.ictv_app.download_manager
+        directory = os.path.join('static', 'storage', 'download_test')
+        try:
+            with BackgroundHTTPServer(Handler) as server:
+                def cache(path, file):
+                    return asyncio.run_coroutine_threadsafe(
+                        download_manager._cache_asset(server.url + path, os.path.join(directory, file)),
+                        download_manager._loop).result(timeout=10)
+
+                content = files['/small.gif']
+                assert_equal(cache('/small.gif', 'small.gif'),
+                             ('image/gif', len(content), hashlib.sha256(content).hexdigest()))
+                with open(os.path.join(get_root_path(), directory, 'small.gif'), 'rb') as f:
+                    assert_equal(f.read(), content)
+                umask = os.umask(0)
+                os.umask(umask)
+                assert_equal(os.stat(os.path.join(get_root_path(), directory, 'small.gif')).st_mode & 0o777,
+                             0o666 & ~umask)
+
+                with assert_raises(DownloadTooLarge):
+                    cache('/large', 'large')
+                with assert_raises(DownloadTooLarge):
+                    cache('/large?chunked', 'large')
+                assert_equal(os.listdir(os.path.join(get_root_path(), directory)), ['small.gif'])
+        finally:
+            shutil.rmtree(os.path.join(get_root_path(), directory), ignore_errors=True)
+
+
+class DownloadQueueTest(FakePluginTestCase):
+    config = dict(ICTVTestCase.config, download_manager={'retries': 0, 'failure_delay': 60})
+
+    def runTest(self):
+        """ Tests that the downloads are persisted, resumed and not attempted again too soon after a failure. """
+        state = {'status': 503}
+
+        class Handler(QuietHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(state['status'])
+                self.send_header('Content-Length', '6')
+                self.end_headers()
+                self.wfile.write(b'GIF89a')
+
+        download_manager = self.ictv_app.download_manager
+        channel = PluginChannel(name='Downloads', plugin=Plugin.byName('fake_plugin'), subscription_right='public')
+
+        def wait_for_download(asset):
+            futures.wait([download_manager.get_pending_task_for_asset(asset.id)], timeout=10)
+            download_manager._post_process_queue.join()
+
+        with BackgroundHTTPServer(Handler) as server:
+            url = server.url + '/image'
+            asset = Asset(plugin_channel=channel, filename=url, user=None, extension='.gif', is_cached=True)
+            assert_true(download_manager.enqueue_asset(asset))
+            wait_for_download(asset)
+            assert_is_none(download_manager.get_pending_task_for_asset(asset.id))
+            download = AssetDownload.selectBy(asset=asset).getOne()
+            assert_equal((download.state, download.attempts, download.url), ('failed', 1, url + '.gif'))
+            assert_true(download.error)
+            assert_true(download.next_attempt > datetime.now() + timedelta(seconds=50))
+            assert_true(asset.in_flight)
+            assert_false(download_manager.enqueue_asset(asset))
+
+            # An interrupted download is resumed at startup once it can be attempted again
+            state['status'] = 200
+            download.next_attempt = datetime.now()
+            download_manager.resume_downloads()
+            wait_for_download(asset)
+            asset.sync()
+            assert_false(asset.in_flight)
+            assert_equal((asset.mime_type, asset.file_size), ('image/gif', 6))
+            assert_equal(AssetDownload.selectBy(asset=asset).count(), 0)
+            assert_equal(download_manager._pending_tasks, {})
+            with open(os.path.join(get_root_path(), asset.path), 'rb') as f:
+                assert_equal(f.read(), b'GIF89a')
+            asset.destroySelf()
+
+            # A download run by another process is only resumed once this process is over
+            running_process, ended_process = get_process_names()
+            asset = Asset(plugin_channel=channel, filename=url, user=None, extension='.gif', is_cached=True,
+                          in_flight=True)
+            download = AssetDownload(asset=asset, url=url + '.gif', state='running', owner=running_process)
+            download_manager.resume_downloads()
+            assert_false(download_manager.has_pending_task_for_asset(asset.id))
+            assert_false(download_manager.enqueue_asset(asset))
+            download.owner = ended_process
+            download_manager.resume_downloads()
+            wait_for_download(asset)
+            asset.sync()
+            assert_false(asset.in_flight)
+            asset.destroySelf()
+
+
+class CacheIndexTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the cached assets of a channel are found without querying the database once indexed. """
+        class FakeDownloadManager(object):
+            enqueued = []
+
+            def enqueue_asset(self, asset):
+                self.enqueued.append(asset.filename)
+
+            def has_pending_task_for_asset(self, asset_id):
+                return False
+
+        channel = PluginChannel(name='Index', plugin=Plugin.byName('fake_plugin'), subscription_right='public')
+        assets = [Asset(plugin_channel=channel, filename='http://localhost/%d' % i, extension='.png', user=None,
+                        is_cached=True) for i in range(5)]
+        for asset in assets:
+            os.makedirs(os.path.dirname(os.path.join(get_root_path(), asset.get_storage_path())), exist_ok=True)
+            open(os.path.join(get_root_path(), asset.get_storage_path()), 'wb').close()
+        cache_manager = CacheManager(channel.id, FakeDownloadManager())
+        assert_equal(cache_manager.cache_file_at_url('http://localhost/0.png').id, assets[0].id)
+
+        queries = []
+        conn = sqlhub.processConnection
+        execute = conn._executeRetry
+        conn._executeRetry = lambda *args: queries.append(args[2]) or execute(*args)
+        try:
+            cache_manager = CacheManager(channel.id, FakeDownloadManager())
+            assert_equal([cache_manager.cache_file_at_url('http://localhost/%d.png' % i).id for i in range(5)],
+                         [a.id for a in assets])
+            assert_equal(cache_manager.cache_file_at_url('http://localhost/0.png').path, assets[0].path)
+        finally:
+            conn._executeRetry = execute
+        assert_equal(queries, [])
+        assert_equal(CacheManager._name_to_lock, {})
+
+        # New and deleted assets are reflected in the index
+        asset = cache_manager.cache_file_at_url('http://localhost/new.png')
+        assert_equal(FakeDownloadManager.enqueued, ['http://localhost/new'])
+        assert_equal(cache_manager.get_cached_file('http://localhost/new').id, asset.id)
+        assets[1].destroySelf()
+        assert_equal(cache_manager.get_cached_file('http://localhost/1'), None)
+        # as well as the assets deleted by other processes
+        conn.query('DELETE FROM asset WHERE id = %d' % assets[2].id)
+        os.remove(os.path.join(get_root_path(), assets[2].get_storage_path()))
+        assert_equal(cache_manager.get_cached_file('http://localhost/2'), None)
+        assert_equal(cache_manager.get_cached_file('http://localhost/3').id, assets[3].id)
+
+
+class BlobStoreTest(FakePluginTestCase):
+    config = dict(ICTVTestCase.config, asset_storage={'deduplication': True})
+
+    def runTest(self):
+        """ Tests that identical asset files are stored once and that unused blobs are removed. """
+        with tempfile.TemporaryDirectory() as storage:
+            blob_store = BlobStore(os.path.join(storage, 'blobs'))
+            for i, (channel, content) in enumerate([('1', b'logo'), ('2', b'logo'), ('3', b'logo'), ('3', b'other')]):
+                os.makedirs(os.path.join(storage, channel), exist_ok=True)
+                with open(os.path.join(storage, channel, '%d.png' % i), 'wb') as f:
+                    f.write(content)
+            assert_equal(blob_store.deduplicate_directory(storage), (4, 2, 8))
+            assert_equal(blob_store.deduplicate_directory(storage), (0, 0, 0))
+            paths = [os.path.join(storage, channel, file) for channel in '123'
+                     for file in sorted(os.listdir(os.path.join(storage, channel)))]
+            logo_blob = blob_store.get_blob_path(hashlib.sha256(b'logo').hexdigest())
+            assert_true(all(os.path.samefile(p, logo_blob) for p in paths[:3]))
+            assert_false(os.path.samefile(paths[3], logo_blob))
+
+            for path in paths[:3]:
+                os.remove(path)
+            assert_equal(blob_store.collect_garbage(), 4)
+            assert_false(os.path.exists(logo_blob))
+            with open(paths[3], 'rb') as f:
+                assert_equal(f.read(), b'other')
+
+        # Stored and cached files are deduplicated when enabled
+        fake_plugin = Plugin.byName('fake_plugin')
+        channels = [PluginChannel(name='Blobs %d' % i, plugin=fake_plugin, subscription_right='public') for i in range(2)]
+        assets = [StorageManager(c.id).store_file(b'qrcode', 'qrcode.svg') for c in channels]
+        try:
+            assert_true(os.path.samefile(*[os.path.join(get_root_path(), a.path) for a in assets]))
+            assets[0].write_to_asset_file(b'changed')
+            with open(os.path.join(get_root_path(), assets[1].path), 'rb') as f:
+                assert_equal(f.read(), b'qrcode')
+        finally:
+            for asset in assets:
+                asset.destroySelf()
+            shutil.rmtree(StorageManager.blob_store.path, ignore_errors=True)
+
+
+class CacheEvictionTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the least recently referenced cached assets are evicted when the cache exceeds its quotas. """
+        fake_plugin = Plugin.byName('fake_plugin')
+        channels = [PluginChannel(name='Eviction %d' % i, plugin=fake_plugin, subscription_right='public')
+                    for i in range(2)]
+        now = datetime.now()
+        assets = [Asset(plugin_channel=channels[i % 2], filename='asset %d' % i, user=None, is_cached=True,
+                        file_size=512 * 1024, last_reference=now - timedelta(hours=i)) for i in range(6)]
+        Asset(plugin_channel=channels[0], filename='uploaded', user=None, file_size=10 * 1024 * 1024)
+
+        def remaining_assets():
+            return sorted(a.filename for a in Asset.selectBy(is_cached=True))
+
+        cleanup_scheduler = CleanupScheduler(max_megabytes=2, max_megabytes_per_channel=1)
+        cleanup_scheduler.evict_assets()
+        assert_equal(remaining_assets(), ['asset 0', 'asset 1', 'asset 2', 'asset 3'])
+        assert_equal(cleanup_scheduler.get_statistics(),
+                     {'usage': 2 * 1024 * 1024, 'channels_usage': {channels[0].id: 1024 * 1024,
+                                                                    channels[1].id: 1024 * 1024},
+                      'max_bytes': 2 * 1024 * 1024, 'max_channel_bytes': 1024 * 1024, 'evicted_assets': 2,
+                      'evicted_bytes': 1024 * 1024})
+
+        # The eviction is run as soon as it is requested
+        assets[0].last_reference = now - timedelta(days=1)
+        cleanup_scheduler = CleanupScheduler(max_megabytes=1, eviction_interval=3600)
+        evicted = Event()
+        evict_assets = cleanup_scheduler.evict_assets
+        cleanup_scheduler.evict_assets = lambda: evict_assets() or evicted.set()
+        cleanup_scheduler.start()
+        try:
+            assert_true(evicted.wait(10))
+            assert_equal(remaining_assets(), ['asset 1', 'asset 2'])
+            evicted.clear()
+            Asset(plugin_channel=channels[0], filename='asset 6', user=None, is_cached=True, file_size=512 * 1024)
+            cleanup_scheduler.request_eviction()
+            assert_true(evicted.wait(10))
+            assert_equal(remaining_assets(), ['asset 1', 'asset 6'])
+        finally:
+            cleanup_scheduler.stop()  # Does not wait for the next cleanup, an hour from now
+
+
+class StorageReconcilerTest(FakePluginTestCase):
+    def runTest(self):
+        """ Tests that the files of the storage that do not belong to any asset are found and removed. """
+        channel = PluginChannel(name='Reconciler', plugin=Plugin.byName('fake_plugin'), subscription_right='public')
+        assets = [Asset(plugin_channel=channel, filename='asset', user=None, extension=ext) for ext in ('.png', None)]
+        Asset.deleteMany(Asset.q.id == assets[1].id)
+        with tempfile.TemporaryDirectory() as storage:
+            files = {os.path.join(str(channel.id), str(assets[0].id) + '.png'): 10,
+                     os.path.join(str(channel.id), str(assets[1].id)): 20,
+                     os.path.join(str(channel.id), '.download-1234'): 30,
+                     os.path.join(str(channel.id + 1), '1.png'): 40,
+                     os.path.join('blobs', 'ab', 'abcdef'): 50}
+            for path, size in files.items():
+                os.makedirs(os.path.dirname(os.path.join(storage, path)), exist_ok=True)
+                with open(os.path.join(storage, path), 'wb') as f:
+                    f.write(b'0' * size)
+                os.utime(os.path.join(storage, path), (time.time() - 7200, time.time() - 7200))
+            with open(os.path.join(storage, str(channel.id), 'new'), 'wb') as f:
+                f.write(b'0' * 60)
+
+            reconciler = StorageReconciler(storage, quarantine=True)
+            assert_equal(reconciler.reconcile(dry_run=True), (3, 90))
+            assert_equal(sorted(e.name for _, e in reconciler.find_orphans()), ['.download-1234', '1.png',
+                                                                                str(assets[1].id)])
+            assert_equal(reconciler.reconcile(), (3, 90))
+            quarantine = os.path.join(storage, StorageReconciler.quarantine_directory)
+            assert_equal(sum(len(files) for _, _, files in os.walk(quarantine)), 3)
+            assert_equal(sorted(os.listdir(os.path.join(storage, str(channel.id)))),
+                         sorted([str(assets[0].id) + '.png', 'new']))
+
+            assert_equal(StorageReconciler(storage).reconcile(), (0, 0))
+            assert_true(os.path.exists(os.path.join(storage, 'blobs', 'ab', 'abcdef')))
+
+
+transcoding_results = []
+transcoding_condition = Condition()
+
+
+def record_transcoding(name, success):
+    with transcoding_condition:
+        transcoding_results.append((name, success))
+        transcoding_condition.notify_all()
+
+
+class TranscodingQueueTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests the order, the cancellation and the persistence of the transcoding jobs. """
+        started = []
+        release = Event()
+
+        def fake_transcode(input_file, output_file, progress_callback, threads=None, process_callback=None,
+                           duration=None):
+            with transcoding_condition:
+                started.append((input_file, threads))
+                transcoding_condition.notify_all()
+            if input_file == 'blocker':
+                release.wait(10)
+            progress_callback(1)
+
+        def wait_for(predicate):
+            with transcoding_condition:
+                assert_true(transcoding_condition.wait_for(predicate, timeout=10))
+
+        def wait_for_results(count):
+            wait_for(lambda: len(transcoding_results) >= count)
+
+        transcode_to_webm = transcoding_queue.transcode_to_webm
+        transcoding_queue.transcode_to_webm = fake_transcode
+        try:
+            queue = TranscodingQueue(workers=1, threads=4)
+            queue.enqueue_task('blocker', 'blocker.webm', partial(record_transcoding, 'blocker'), duration=1000)
+            wait_for(lambda: started)
+            queue.enqueue_task('batch', 'batch.webm', partial(record_transcoding, 'batch'),
+                               priority=TranscodingQueue.BATCH, duration=100)
+            queue.enqueue_task('long', 'long.webm', partial(record_transcoding, 'long'), duration=5000)
+            queue.enqueue_task('short', 'short.webm', partial(record_transcoding, 'short'), duration=1000)
+            queue.enqueue_task('cancelled', 'cancelled.webm', partial(record_transcoding, 'cancelled'), duration=10)
+            assert_true(queue.cancel_task('cancelled.webm'))
+            assert_false(queue.cancel_task('unknown.webm'))
+            release.set()
+            wait_for_results(5)
+            queue.stop()
+            assert_equal([i for i, _ in started], ['blocker', 'short', 'long', 'batch'])
+            assert_true(all(threads == 4 for _, threads in started))
+            assert_in(('cancelled', False), transcoding_results)
+            assert_equal(sorted(r for r in transcoding_results if r[1]),
+                         [('batch', True), ('blocker', True), ('long', True), ('short', True)])
+            assert_equal(queue.get_progress('short.webm'), 1)
+            assert_is_none(queue.get_progress('cancelled.webm'))
+            assert_equal(TranscodingJob.select().count(), 0)
+
+            # Jobs persisted by a previous run are resumed along with their callback
+            del transcoding_results[:]
+            assert_is_none(_serialize_callback(lambda success: None))
+            # but not those run by another process that is still running
+            running_process, ended_process = get_process_names()
+            TranscodingJob(input_file='resumed', output_file='resumed.webm', state='running', owner=ended_process,
+                           callback=_serialize_callback(partial(record_transcoding, 'resumed')))
+            claimed = TranscodingJob(input_file='claimed', output_file='claimed.webm', state='running',
+                                     owner=running_process,
+                                     callback=_serialize_callback(partial(record_transcoding, 'claimed')))
+            queue = TranscodingQueue(workers=2, threads=4)
+            queue.resume_tasks()
+            wait_for_results(1)
+            queue.stop()
+            assert_equal(transcoding_results, [('resumed', True)])
+            # A job running alone is given all the threads, a job started meanwhile only those left unused
+            assert_equal(started[-1], ('resumed', 4))
+            assert_equal(list(TranscodingJob.select()), [claimed])
+            claimed.destroySelf()
+
+            # A job is not resumed twice, and a job whose callback cannot be restored is marked as failed
+            release.clear()
+            TranscodingJob(input_file='blocker', output_file='twice.webm', owner=ended_process,
+                           callback=_serialize_callback(partial(record_transcoding, 'twice')))
+            failed = TranscodingJob(input_file='failed', output_file='failed.webm', owner=ended_process)
+            queue = TranscodingQueue(workers=2, threads=4)
+            queue.resume_tasks()
+            wait_for(lambda: started[-1][0] == 'blocker')
+            queue.resume_tasks()
+            release.set()
+            wait_for_results(2)
+            queue.stop()
+            assert_equal(transcoding_results, [('resumed', True), ('twice', True)])
+            assert_equal(list(TranscodingJob.select()), [failed])
+            assert_equal((failed.error, failed.owner), ('The callback could not be restored', None))
+            failed.destroySelf()
+
+            release.clear()
+            queue = TranscodingQueue(workers=2, threads=4)
+            queue.enqueue_task('blocker', 'blocker.webm', partial(record_transcoding, 'blocker'), duration=1000)
+            wait_for(lambda: started[-1][0] == 'blocker')
+            queue.enqueue_task('concurrent', 'concurrent.webm', partial(record_transcoding, 'concurrent'), duration=1)
+            wait_for_results(2)
+            release.set()
+            wait_for_results(3)
+            queue.stop()
+            assert_equal(started[-2:], [('blocker', 4), ('concurrent', 1)])
+            assert_equal((queue._running_jobs, queue._used_threads), (0, 0))
+        finally:
+            transcoding_queue.transcode_to_webm = transcode_to_webm
+
+
+class TranscodingProgressTest(ICTVTestCase):
+    def runTest(self):
+        """ Tests that the progress of a transcoding is read from the -progress output of FFmpeg. """
+        output = b''.join(b'frame=%d\nfps=25.0\nout_time_us=%s\nout_time=00:00:00\nprogress=%s\n' % (i, t, p)
+                          for i, t, p in [(0, b'N/A', b'continue'), (1, b'500000', b'continue'),
+                                          (2, b'500000', b'continue'), (3, b'2000000', b'continue'),
+                                          (4, b'2100000', b'end')])
+        progress = []
+        read_progress(BytesIO(output), 2000, progress.append)
+        assert_equal(progress, [0.25, 1])
+        progress = []
+        read_progress(BytesIO(output), None, progress.append)
+        assert_equal(progress, [1])
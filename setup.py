@@ -43,6 +43,7 @@ retval = setup(
     setup_requires=['pytest-runner', 'pytest-env'] if not is_running_on_macos else [],
     tests_require=['pytest', 'pytest-xdist', 'pytest-cov', 'paste', 'nose', 'coverage<5'],
     dependency_links=['https://github.com/formencode/formencode.git#egg=FormEncode'],
-    scripts=['ictv-setup-database', 'ictv-webapp', 'ictv-tests'] if os.environ.get('SETUP_ENV') != 'travis' else [],
+    scripts=['ictv-setup-database', 'ictv-webapp', 'ictv-tests', 'ictv-deduplicate-storage',
+             'ictv-reconcile-storage'] if os.environ.get('SETUP_ENV') != 'travis' else [],
     include_package_data=True,
 )